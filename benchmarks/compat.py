@@ -0,0 +1,412 @@
+"""
+Compatibility layer to run the Redshift statements of sql_queries.py on a local database: an embedded SQLite
+database or a local PostgreSQL. The statements are translated on execute, so the benchmarks exercise the same
+query modules as the pipeline:
+
+- DISTSTYLE, DISTKEY, SORTKEY, ENCODE and REFERENCES are dropped, they have no local equivalent (and Redshift does
+  not enforce foreign keys either).
+- IDENTITY columns become INTEGER PRIMARY KEY (SQLite) or GENERATED BY DEFAULT AS IDENTITY (PostgreSQL).
+- Functions missing locally (STRTOL, MD5, GETDATE, EXTRACT and epoch arithmetic on SQLite) are registered or
+  rewritten.
+- COPY ... FROM <local path> is executed client side: the JSON files are parsed with the 'auto' mapping or the
+  JSONPaths file and inserted in batches. A MANIFEST lists the files to load. Bound parameters are rendered into the
+  COPY statement first.
+- UNLOAD ... TO <local directory> is executed client side as well: the select runs on the local database and the
+  rows are written as Parquet (pyarrow), one file per partition of PARTITION BY. MAXFILESIZE and PARALLEL are
+  ignored.
+- PREPARE and EXECUTE are emulated on SQLite, the statement is kept on the connection.
+- ANALYZE ... PREDICATE COLUMNS and VACUUM SORT ONLY / DELETE ONLY become a plain ANALYZE and VACUUM.
+- Materialized views are real materialized views on PostgreSQL (refreshed in full) and plain views on SQLite, which
+  are always up to date, so REFRESH does nothing there. SVV_MV_INFO is read from the local catalog.
+"""
+import datetime
+import glob
+import hashlib
+import json
+import os
+import re
+import shutil
+
+REDSHIFT_ONLY = [
+    (re.compile(r'\s+ENCODE\s+\w+', re.IGNORECASE), ''),
+    (re.compile(r'\s+DISTSTYLE\s+\w+', re.IGNORECASE), ''),
+    (re.compile(r'\s+DISTKEY\s*\(\s*\w+\s*\)', re.IGNORECASE), ''),
+    (re.compile(r'\s+(?:COMPOUND\s+|INTERLEAVED\s+)?SORTKEY\s*\([^)]*\)', re.IGNORECASE), ''),
+    (re.compile(r'\s+REFERENCES\s+\w+\s*\(\s*\w+\s*\)', re.IGNORECASE), ''),
+    (re.compile(r'\bGETDATE\(\)', re.IGNORECASE), 'CURRENT_TIMESTAMP'),
+    (re.compile(r'^\s*TRUNCATE\s+(\w+)\s*$', re.IGNORECASE), r'DELETE FROM \1'),
+    (re.compile(r'\s+PREDICATE\s+COLUMNS\s*$', re.IGNORECASE), ''),
+    (re.compile(r'^\s*VACUUM\s+(?:SORT|DELETE)\s+ONLY\s+', re.IGNORECASE), 'VACUUM '),
+    (re.compile(r'\s+AUTO\s+REFRESH\s+(?:YES|NO)\b', re.IGNORECASE), ''),
+]
+
+SQLITE_RULES = [
+    (re.compile(r'\bINT\s+IDENTITY\s*\(\s*\d+\s*,\s*\d+\s*\)\s+PRIMARY KEY', re.IGNORECASE), 'INTEGER PRIMARY KEY'),
+    (re.compile(r"TIMESTAMP\s+'epoch'\s*\+\s*(.+?)\s*\*\s*INTERVAL\s+'1 second'", re.IGNORECASE),
+     r"epoch_timestamp(\1)"),
+    (re.compile(r'\bEXTRACT\s*\(\s*(\w+)\s+FROM\s+', re.IGNORECASE), r"extract_part('\1', "),
+    (re.compile(r'\bLEFT\s*\(', re.IGNORECASE), 'left_chars('),
+    (re.compile(r'%s'), '?'),
+    (re.compile(r'%\((\w+)\)s'), r':\1'),
+    # SQLite only vacuums the whole database
+    (re.compile(r'^\s*VACUUM\b.*$', re.IGNORECASE | re.DOTALL), 'VACUUM'),
+    (re.compile(r'^\s*(CREATE|DROP)\s+MATERIALIZED\s+VIEW\b', re.IGNORECASE), r'\1 VIEW'),
+    (re.compile(r'^\s*REFRESH\s+MATERIALIZED\s+VIEW\s+\w+\s*$', re.IGNORECASE), 'SELECT 1'),
+    (re.compile(r'^\s*SELECT\s+name\s+FROM\s+svv_mv_info\b.*$', re.IGNORECASE | re.DOTALL),
+     "SELECT name FROM sqlite_master WHERE type = 'view'"),
+]
+
+POSTGRES_RULES = [
+    (re.compile(r'^\s*SELECT\s+name\s+FROM\s+svv_mv_info\b.*$', re.IGNORECASE | re.DOTALL),
+     "SELECT matviewname FROM pg_matviews WHERE schemaname = current_schema()"),
+    (re.compile(r'\bINT\s+IDENTITY\s*\(\s*\d+\s*,\s*\d+\s*\)', re.IGNORECASE), 'INT GENERATED BY DEFAULT AS IDENTITY'),
+]
+
+POSTGRES_FUNCTIONS = [
+    "CREATE OR REPLACE FUNCTION strtol(value TEXT, base INT) RETURNS BIGINT AS "
+    "$$ SELECT ('x' || LPAD(value, 16, '0'))::BIT(64)::BIGINT $$ LANGUAGE SQL IMMUTABLE",
+]
+
+COPY_STATEMENT = re.compile(r"^\s*COPY\s+(?P<table>\w+)\s*(?:\((?P<columns>[^)]*)\))?\s+FROM\s+'(?P<source>[^']+)'"
+                            r"(?P<options>.*)$", re.IGNORECASE | re.DOTALL)
+JSON_FORMAT = re.compile(r"FORMAT\s+AS\s+JSON\s+'(?P<paths>[^']+)'", re.IGNORECASE)
+JSONPATH = re.compile(r"^\$(?:\['([^']+)'\]|\.(\w+))$")
+UNLOAD_STATEMENT = re.compile(r"^\s*UNLOAD\s*\(\s*'(?P<select>(?:[^']|'')*)'\s*\)\s+TO\s+'(?P<target>[^']+)'"
+                              r"(?P<options>.*)$", re.IGNORECASE | re.DOTALL)
+PARTITION_BY = re.compile(r'\bPARTITION\s+BY\s*\((?P<columns>[^)]*)\)', re.IGNORECASE)
+NAMED_PARAMETER = re.compile(r'%\((\w+)\)s')
+PREPARE_STATEMENT = re.compile(r'^\s*PREPARE\s+(?P<name>\w+)\s+AS\s+(?P<query>.*)$', re.IGNORECASE | re.DOTALL)
+EXECUTE_STATEMENT = re.compile(r'^\s*EXECUTE\s+(?P<name>\w+)\s*(?:\((?P<arguments>.*)\))?\s*$',
+                               re.IGNORECASE | re.DOTALL)
+
+
+def extract_part(part, value):
+    """
+    EXTRACT(part FROM timestamp) for SQLite
+    """
+    if value is None:
+        return None
+    moment = datetime.datetime.fromisoformat(str(value))
+    part = part.lower()
+    if part == 'week':
+        return moment.isocalendar()[1]
+    if part in ('dow', 'weekday'):
+        return (moment.weekday() + 1) % 7
+    return getattr(moment, part)
+
+
+def epoch_timestamp(seconds):
+    """
+    TIMESTAMP 'epoch' + seconds * INTERVAL '1 second' for SQLite, keeping the fractional seconds
+    """
+    if seconds is None:
+        return None
+    return (datetime.datetime(1970, 1, 1) + datetime.timedelta(seconds=seconds)).isoformat(sep=' ')
+
+
+def register_sqlite_functions(conn):
+    """
+    Register the Redshift functions that SQLite does not have
+    :param conn: sqlite3 connection
+    """
+    conn.create_function('epoch_timestamp', 1, epoch_timestamp, deterministic=True)
+    conn.create_function('extract_part', 2, extract_part, deterministic=True)
+    conn.create_function('left_chars', 2, lambda value, count: None if value is None else str(value)[:count],
+                         deterministic=True)
+    conn.create_function('md5', 1, lambda value: None if value is None else
+                         hashlib.md5(str(value).encode('utf-8')).hexdigest(), deterministic=True)
+    conn.create_function('strtol', 2, lambda value, base: None if value is None else int(value, base),
+                         deterministic=True)
+
+
+def render_parameters(query, params):
+    """
+    Render named parameters into a statement as string literals, the COPY statements are parsed client side
+    :param query: Statement with %(name)s placeholders
+    :param params: Dictionary with the values
+    :return: Statement with the values
+    """
+    return NAMED_PARAMETER.sub(lambda match: "'{}'".format(str(params[match.group(1)]).replace("'", "''")), query)
+
+
+def translate(query, dialect):
+    """
+    Translate a Redshift statement to the local dialect
+    :param query: Redshift SQL statement
+    :param dialect: sqlite or postgres
+    :return: Translated statement
+    """
+    for pattern, replacement in REDSHIFT_ONLY:
+        query = pattern.sub(replacement, query)
+    for pattern, replacement in (SQLITE_RULES if dialect == 'sqlite' else POSTGRES_RULES):
+        query = pattern.sub(replacement, query)
+    return query
+
+
+def iter_json_objects(text):
+    """
+    Parse a file with one or more concatenated JSON objects, as accepted by Redshift COPY
+    :param text: Content of the file
+    :return: Generator of the objects
+    """
+    decoder = json.JSONDecoder()
+    index = 0
+    while True:
+        while index < len(text) and text[index].isspace():
+            index += 1
+        if index >= len(text):
+            return
+        record, index = decoder.raw_decode(text, index)
+        yield record
+
+
+def source_files(source, manifest=False):
+    """
+    Files loaded by a COPY statement
+    :param source: Local file, directory or prefix, or a manifest when manifest is True
+    :param manifest: The source is a manifest
+    :return: Sorted list of file paths
+    """
+    if manifest:
+        with open(source) as f:
+            return [entry['url'] for entry in json.load(f)['entries']]
+    if os.path.isdir(source):
+        return sorted(path for path in glob.glob(os.path.join(source, '**', '*'), recursive=True)
+                      if os.path.isfile(path))
+    # A COPY source is a prefix, e.g. log_data/2018/11/2018-11-12
+    return sorted(path for path in glob.glob(source + '*') if os.path.isfile(path))
+
+
+class CompatCursor:
+    """
+    DB-API cursor that translates the Redshift statements and executes COPY client side
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self._cursor = connection.raw.cursor()
+        self.rowcount = -1
+
+    def execute(self, query, params=None):
+        if isinstance(params, dict) and (COPY_STATEMENT.match(render_parameters(query, params)) or
+                                         UNLOAD_STATEMENT.match(render_parameters(query, params))):
+            query, params = render_parameters(query, params), None
+        match = COPY_STATEMENT.match(query)
+        if match is not None:
+            self.rowcount = self.connection.copy(self._cursor, match)
+            return
+        match = UNLOAD_STATEMENT.match(query)
+        if match is not None:
+            self.rowcount = self.connection.unload(self._cursor, match)
+            return
+
+        if self.connection.dialect == 'sqlite':
+            prepare = PREPARE_STATEMENT.match(query)
+            if prepare is not None:
+                self.connection.prepared[prepare.group('name').lower()] = prepare.group('query')
+                self.rowcount = -1
+                return
+            execute = EXECUTE_STATEMENT.match(query)
+            if execute is not None:
+                # $1, $2, ... become the positional parameters of the EXECUTE
+                query = re.sub(r'\$\d+', '%s', self.connection.prepared[execute.group('name').lower()])
+
+        query = translate(query, self.connection.dialect)
+        if self.connection.dialect == 'sqlite' and params and not isinstance(params, dict):
+            # IN %s with a tuple parameter is expanded to one placeholder per value
+            expanded, values = [], []
+            parts = query.split('?')
+            for index, value in enumerate(params):
+                expanded.append(parts[index])
+                if isinstance(value, tuple):
+                    expanded.append('(' + ', '.join('?' * len(value)) + ')')
+                    values.extend(value)
+                else:
+                    expanded.append('?')
+                    values.append(value)
+            query = ''.join(expanded) + '?'.join(parts[len(params):])
+            params = values
+
+        if params is None:
+            self._cursor.execute(query)
+        else:
+            self._cursor.execute(query, params)
+        self.rowcount = self._cursor.rowcount
+
+    def fetchone(self):
+        return self._cursor.fetchone()
+
+    def fetchall(self):
+        return self._cursor.fetchall()
+
+    def close(self):
+        self._cursor.close()
+
+
+class CompatConnection:
+    """
+    DB-API connection on a local database that accepts the Redshift statements of sql_queries.py
+    """
+
+    def __init__(self, raw, dialect, batch_size=10000):
+        """
+        Initialize the connection
+        :param raw: sqlite3 or psycopg2 connection
+        :param dialect: sqlite or postgres
+        :param batch_size: Number of rows inserted per batch by COPY
+        """
+        self.raw = raw
+        self.dialect = dialect
+        self.batch_size = batch_size
+        self.prepared = {}
+        self.closed = 0
+
+        if dialect == 'sqlite':
+            register_sqlite_functions(raw)
+        else:
+            cur = raw.cursor()
+            for function in POSTGRES_FUNCTIONS:
+                cur.execute(function)
+            raw.commit()
+
+    @classmethod
+    def sqlite(cls, path=':memory:'):
+        import sqlite3
+        return cls(sqlite3.connect(path, check_same_thread=False), 'sqlite')
+
+    @classmethod
+    def postgres(cls, dsn):
+        import psycopg2
+        return cls(psycopg2.connect(dsn), 'postgres')
+
+    def cursor(self):
+        return CompatCursor(self)
+
+    def commit(self):
+        self.raw.commit()
+
+    def rollback(self):
+        self.raw.rollback()
+
+    @property
+    def autocommit(self):
+        return self.raw.isolation_level is None if self.dialect == 'sqlite' else self.raw.autocommit
+
+    @autocommit.setter
+    def autocommit(self, value):
+        # VACUUM has to run outside a transaction block
+        if self.dialect == 'sqlite':
+            self.raw.isolation_level = None if value else ''
+        else:
+            self.raw.autocommit = value
+
+    def cancel(self):
+        # Abort the statement running on this connection from another thread
+        if self.dialect == 'sqlite':
+            self.raw.interrupt()
+        else:
+            self.raw.cancel()
+
+    def close(self):
+        self.closed = 1
+        self.raw.close()
+
+    def table_columns(self, cur, table):
+        if self.dialect == 'sqlite':
+            cur.execute(f"PRAGMA table_info({table})")
+            return [row[1] for row in cur.fetchall()]
+        cur.execute("SELECT column_name FROM information_schema.columns WHERE table_name = %s "
+                    "ORDER BY ordinal_position", (table,))
+        return [row[0] for row in cur.fetchall()]
+
+    def copy(self, cur, match):
+        """
+        Execute a COPY statement client side
+        :param cur: Cursor of the local database
+        :param match: Match of COPY_STATEMENT
+        :return: Number of rows loaded
+        """
+        table = match.group('table')
+        options = match.group('options')
+        format_match = JSON_FORMAT.search(options)
+        json_paths = format_match.group('paths') if format_match else 'auto'
+        manifest = re.search(r'\bMANIFEST\b', options, re.IGNORECASE) is not None
+
+        if match.group('columns'):
+            columns = [column.strip() for column in match.group('columns').split(',')]
+        else:
+            columns = self.table_columns(cur, table)
+
+        if json_paths.lower() == 'auto':
+            keys = [column.lower() for column in columns]
+
+            def to_row(record):
+                lowered = {key.lower(): value for key, value in record.items()}
+                return [lowered.get(key) for key in keys]
+        else:
+            with open(json_paths) as f:
+                paths = json.load(f)['jsonpaths']
+            keys = []
+            for path in paths:
+                path_match = JSONPATH.match(path)
+                keys.append(path_match.group(1) or path_match.group(2))
+            columns = columns[:len(keys)]
+
+            def to_row(record):
+                return [record.get(key) for key in keys]
+
+        placeholder = '?' if self.dialect == 'sqlite' else '%s'
+        insert = f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join([placeholder] * len(columns))})"
+
+        loaded = 0
+        batch = []
+        for path in source_files(match.group('source'), manifest):
+            with open(path) as f:
+                for record in iter_json_objects(f.read()):
+                    batch.append(to_row(record))
+                    if len(batch) >= self.batch_size:
+                        cur.executemany(insert, batch)
+                        loaded += len(batch)
+                        batch = []
+        if batch:
+            cur.executemany(insert, batch)
+            loaded += len(batch)
+
+        return loaded
+
+    def unload(self, cur, match):
+        """
+        Execute an UNLOAD statement client side
+        :param cur: Cursor of the local database
+        :param match: Match of UNLOAD_STATEMENT
+        :return: Number of rows unloaded
+        """
+        import pyarrow
+        import pyarrow.parquet
+
+        target = match.group('target')
+        options = match.group('options')
+        partition_match = PARTITION_BY.search(options)
+        partition_columns = [column.strip() for column in partition_match.group('columns').split(',')] \
+            if partition_match else []
+
+        if re.search(r'\bCLEANPATH\b', options, re.IGNORECASE) and os.path.isdir(target):
+            shutil.rmtree(target)
+
+        cur.execute(translate(match.group('select').replace("''", "'"), self.dialect))
+        columns = [description[0] for description in cur.description]
+
+        # PARTITION BY writes the rows of a partition under <target>/<column>=<value>/ without the partition columns
+        partitions = {}
+        for row in cur.fetchall():
+            record = dict(zip(columns, row))
+            values = tuple(record.pop(column) for column in partition_columns)
+            partitions.setdefault(values, []).append(record)
+
+        for values, records in sorted(partitions.items()):
+            directory = os.path.join(target, *(f"{column}={value}" for column, value in zip(partition_columns, values)))
+            os.makedirs(directory, exist_ok=True)
+            path = os.path.join(directory, '0000_part_00.parquet')
+            pyarrow.parquet.write_table(pyarrow.Table.from_pylist(records), path)
+
+        return sum(len(records) for records in partitions.values())
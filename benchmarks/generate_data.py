@@ -0,0 +1,273 @@
+"""
+Synthetic song_data and log_data in the shape of the course dataset, at any scale:
+
+- song_data/A/B/C/TR....json with one song per file, keys as loaded by COPY staging_songs ... JSON 'auto'
+- log_data/YYYY/MM/YYYY-MM-DD-events.json with one event per line, keys as mapped by the LOG_JSONPATH file
+- log_json_path.json, the JSONPaths file for staging_events
+- expected_counts.json, the number of records every table holds after the pipeline has run
+
+Every record is derived from the seed and its index, so the songs, users and days are generated in parallel by a
+process pool and streamed to disk without keeping the data in memory. Songs and users are drawn with a Zipf-like
+skew, a share of the songs is written twice and a share of the events is written twice.
+
+Usage: python benchmarks/generate_data.py OUT_DIR [--songs N] [--events N] [--users N] [--artists N] [--days N]
+                                          [--seed N] [--workers N] ...
+"""
+import argparse
+import datetime
+import hashlib
+import json
+import os
+import random
+import shutil
+from multiprocessing import Pool
+
+LOG_COLUMNS = ['artist', 'auth', 'firstName', 'gender', 'itemInSession', 'lastName', 'length', 'level', 'location',
+               'method', 'page', 'registration', 'sessionId', 'song', 'status', 'ts', 'userAgent', 'userId']
+PAGES = ['Home', 'Login', 'Logout', 'Settings', 'Help', 'About', 'Upgrade', 'Downgrade']
+USER_AGENTS = ['Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko)',
+               'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_9_4) AppleWebKit/537.78.2 (KHTML, like Gecko)',
+               'Mozilla/5.0 (X11; Linux x86_64; rv:31.0) Gecko/20100101 Firefox/31.0']
+LOCATIONS = ['San Francisco-Oakland-Hayward, CA', 'Portland-South Portland, ME', 'Atlanta-Sandy Springs, GA',
+             'Chicago-Naperville-Elgin, IL-IN-WI', 'New York-Newark-Jersey City, NY-NJ-PA']
+SONGS_PER_DIRECTORY = 1000
+
+# Everything generate writes to OUT_DIR, removed before a dataset is written over an earlier one
+GENERATED = ['song_data', 'log_data', 'log_json_path.json', 'expected_counts.json']
+
+
+class Settings:
+    """
+    Parameters of a generated dataset
+    """
+
+    def __init__(self, songs=1000, artists=300, users=100, events=8000, days=30, start_date='2018-11-01', seed=42,
+                 song_skew=1.0, user_skew=0.8, duplicate_song_rate=0.01, duplicate_event_rate=0.0,
+                 next_song_rate=0.85, unknown_song_rate=0.8):
+        self.songs = songs
+        self.artists = artists
+        self.users = users
+        self.events = events
+        self.days = days
+        self.start_date = start_date
+        self.seed = seed
+        self.song_skew = song_skew
+        self.user_skew = user_skew
+        self.duplicate_song_rate = duplicate_song_rate
+        self.duplicate_event_rate = duplicate_event_rate
+        self.next_song_rate = next_song_rate
+        self.unknown_song_rate = unknown_song_rate
+
+
+def seeded(*parts):
+    """
+    Random generator for one record, derived from the seed and the index of the record
+    """
+    return random.Random(int(hashlib.md5(':'.join(map(str, parts)).encode()).hexdigest()[:16], 16))
+
+
+def skewed_index(rng, count, skew):
+    """
+    Draw an index in [0, count) with a power law skew: 0 is uniform, 1 is Zipf-like with a few very popular items
+    """
+    if skew <= 0:
+        return rng.randrange(count)
+    u = rng.random()
+    if abs(skew - 1.0) < 1e-9:
+        value = (count + 1) ** u
+    else:
+        value = ((((count + 1) ** (1 - skew)) - 1) * u + 1) ** (1 / (1 - skew))
+    return min(count - 1, int(value) - 1)
+
+
+def artist_record(settings, index):
+    rng = seeded(settings.seed, 'artist', index)
+    located = rng.random() < 0.4
+    return {'artist_id': f"AR{index:016X}",
+            'artist_name': f"Artist {index}",
+            'artist_location': rng.choice(LOCATIONS) if located else '',
+            'artist_latitude': round(rng.uniform(-60, 60), 5) if located else None,
+            'artist_longitude': round(rng.uniform(-150, 150), 5) if located else None}
+
+
+def song_record(settings, index):
+    rng = seeded(settings.seed, 'song', index)
+    record = {'num_songs': 1}
+    record.update(artist_record(settings, rng.randrange(settings.artists)))
+    record.update({'song_id': f"SO{index:016X}",
+                   'title': f"Song {index}",
+                   'duration': round(rng.uniform(90, 600), 5),
+                   'year': rng.choice([0, rng.randint(1960, 2018)])})
+    return record
+
+
+def user_record(settings, index):
+    rng = seeded(settings.seed, 'user', index)
+    return {'userId': str(index + 1),
+            'firstName': f"First{index}",
+            'lastName': f"Last{index}",
+            'gender': rng.choice('MF'),
+            'level': rng.choice(['free', 'paid']),
+            'location': rng.choice(LOCATIONS),
+            'userAgent': rng.choice(USER_AGENTS),
+            'registration': float(1540000000000 + rng.randrange(10 ** 9))}
+
+
+def song_path(out_dir, index):
+    """
+    Path of a song file, the songs are spread over nested directories like the course dataset
+    """
+    letters = f"{index // SONGS_PER_DIRECTORY:06d}"
+    return os.path.join(out_dir, 'song_data', letters[:2], letters[2:4], letters[4:], f"TR{index:016X}.json")
+
+
+def write_songs(task):
+    """
+    Write the song files of the indexes [start, end)
+    :return: Dictionary with the number of song records and the artist ids used
+    """
+    settings, out_dir, start, end = task
+    records = 0
+    artist_ids = set()
+    for index in range(start, end):
+        record = song_record(settings, index)
+        artist_ids.add(record['artist_id'])
+        copies = 2 if seeded(settings.seed, 'duplicate song', index).random() < settings.duplicate_song_rate else 1
+
+        path = song_path(out_dir, index)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write('\n'.join(json.dumps(record) for _ in range(copies)))
+        records += copies
+
+    return {'staging_songs': records, 'artist_ids': artist_ids}
+
+
+def events_per_day(settings):
+    base, extra = divmod(settings.events, settings.days)
+    return [base + (1 if day < extra else 0) for day in range(settings.days)]
+
+
+def write_day(task):
+    """
+    Write the log file of one day
+    :return: Dictionary with the number of events, matched songplays and the users seen on that day
+    """
+    settings, out_dir, day, count = task
+    rng = seeded(settings.seed, 'day', day)
+    date = datetime.date.fromisoformat(settings.start_date) + datetime.timedelta(days=day)
+    day_start = int(datetime.datetime(date.year, date.month, date.day, tzinfo=datetime.timezone.utc).timestamp()) * 1000
+    step = 86400000 // max(count, 1)
+
+    path = os.path.join(out_dir, 'log_data', f"{date:%Y}", f"{date:%m}", f"{date:%Y-%m-%d}-events.json")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    lines = 0
+    songplays = 0
+    user_ids = set()
+    with open(path, 'w') as f:
+        for index in range(count):
+            user = user_record(settings, skewed_index(rng, settings.users, settings.user_skew))
+            event = {column: None for column in LOG_COLUMNS}
+            event.update({'auth': 'Logged In', 'firstName': user['firstName'], 'gender': user['gender'],
+                          'itemInSession': index % 100, 'lastName': user['lastName'], 'level': user['level'],
+                          'location': user['location'], 'method': 'PUT', 'registration': user['registration'],
+                          'sessionId': day * 10000 + index // 20, 'status': 200,
+                          # Strictly increasing within the day, so every event has its own timestamp
+                          'ts': day_start + index * step + rng.randrange(max(step, 1)),
+                          'userAgent': user['userAgent'], 'userId': user['userId']})
+
+            matched = False
+            if rng.random() < settings.next_song_rate:
+                event['page'] = 'NextSong'
+                if rng.random() < settings.unknown_song_rate:
+                    event.update({'artist': f"Unknown Artist {rng.randrange(10 ** 6)}",
+                                  'song': f"Unknown Song {rng.randrange(10 ** 6)}",
+                                  'length': round(rng.uniform(90, 600), 5)})
+                else:
+                    song = song_record(settings, skewed_index(rng, settings.songs, settings.song_skew))
+                    event.update({'artist': song['artist_name'], 'song': song['title'],
+                                  'length': song['duration']})
+                    matched = True
+            else:
+                event['page'] = rng.choice(PAGES)
+                event['method'] = 'GET'
+
+            copies = 2 if rng.random() < settings.duplicate_event_rate else 1
+            line = json.dumps(event) + '\n'
+            for _ in range(copies):
+                f.write(line)
+            lines += copies
+            songplays += copies if matched else 0
+            user_ids.add(user['userId'])
+
+    return {'staging_events': lines, 'songplays': songplays, 'times': count, 'user_ids': user_ids}
+
+
+def clear_generated(out_dir):
+    """
+    Remove the files of an earlier dataset, so that they are not loaded together with the new one. Other files in
+    the directory are kept.
+    :param out_dir: Directory the dataset is written to
+    """
+    for name in GENERATED:
+        path = os.path.join(out_dir, name)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+
+
+def generate(settings, out_dir, workers=None, chunk_size=1000):
+    """
+    Generate a dataset, an earlier dataset in the directory is replaced
+    :param settings: Settings of the dataset
+    :param out_dir: Directory the dataset is written to
+    :param workers: Number of processes, the number of CPUs when not given
+    :param chunk_size: Number of songs written per task
+    :return: Dictionary with the expected number of records per table
+    """
+    clear_generated(out_dir)
+    os.makedirs(out_dir, exist_ok=True)
+    song_tasks = [(settings, out_dir, start, min(start + chunk_size, settings.songs))
+                  for start in range(0, settings.songs, chunk_size)]
+    day_tasks = [(settings, out_dir, day, count) for day, count in enumerate(events_per_day(settings))]
+
+    expected = {'staging_events': 0, 'staging_songs': 0, 'songplays': 0, 'users': 0, 'songs': settings.songs,
+                'artists': 0, 'times': 0}
+    artist_ids, user_ids = set(), set()
+    with Pool(workers) as pool:
+        for result in pool.imap_unordered(write_songs, song_tasks):
+            expected['staging_songs'] += result['staging_songs']
+            artist_ids |= result['artist_ids']
+        for result in pool.imap_unordered(write_day, day_tasks):
+            for table in ['staging_events', 'songplays', 'times']:
+                expected[table] += result[table]
+            user_ids |= result['user_ids']
+    expected['artists'] = len(artist_ids)
+    expected['users'] = len(user_ids)
+
+    with open(os.path.join(out_dir, 'log_json_path.json'), 'w') as f:
+        json.dump({'jsonpaths': [f"$['{column}']" for column in LOG_COLUMNS]}, f, indent=1)
+    with open(os.path.join(out_dir, 'expected_counts.json'), 'w') as f:
+        json.dump(expected, f, indent=2)
+
+    return expected
+
+
+def main():
+    defaults = Settings()
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('out_dir')
+    for name, value in vars(defaults).items():
+        parser.add_argument(f"--{name.replace('_', '-')}", type=type(value), default=value)
+    parser.add_argument('--workers', type=int, default=None)
+    args = vars(parser.parse_args())
+
+    out_dir, workers = args.pop('out_dir'), args.pop('workers')
+    expected = generate(Settings(**args), out_dir, workers)
+    print(f"\n Dataset written to {out_dir}\n Expected counts: {expected}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,221 @@
+"""
+Offline benchmark of the full pipeline: drop -> create -> load -> insert -> verify, against an embedded SQLite
+database or a local PostgreSQL, loaded from local JSON files. The statements come from sql_queries.py and are run
+by the functions of create_tables.py and etl.py; compat.py translates the Redshift-only syntax.
+
+Every data directory is one scale and holds song_data/, log_data/ and optionally log_json_path.json, e.g. as written
+by generate_data.py. When the directory has an expected_counts.json, the table counts are checked against it. The
+results are stored per commit in <results dir>/<commit>-<engine>.json so runs can be compared across commits. The
+results dir defaults to benchmarks/results/, which is not tracked: results of a dirty tree or of scratch data are
+only meant for local comparisons.
+
+Usage: python benchmarks/pipeline.py DATA_DIR [DATA_DIR ...] [--engine sqlite|postgres] [--dsn DSN]
+                                     [--compare COMMIT] [--results-dir DIR]
+"""
+import argparse
+import configparser
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVICES_DIR = os.path.join(os.path.dirname(BENCHMARKS_DIR), 'services')
+RESULTS_DIR = os.path.join(BENCHMARKS_DIR, 'results')
+
+STAGING_TABLES = ['staging_events', 'staging_songs']
+STAR_TABLES = ['songplays', 'users', 'songs', 'artists', 'times']
+LOG_COLUMNS = ['artist', 'auth', 'firstName', 'gender', 'itemInSession', 'lastName', 'length', 'level', 'location',
+               'method', 'page', 'registration', 'sessionId', 'song', 'status', 'ts', 'userAgent', 'userId']
+
+
+def current_commit():
+    """
+    Short hash of the checked out commit, with -dirty when the tree has local changes
+    """
+    def git(*args):
+        return subprocess.run(['git', *args], cwd=BENCHMARKS_DIR, capture_output=True, text=True).stdout.strip()
+
+    commit = git('rev-parse', '--short', 'HEAD') or 'unknown'
+    return commit + ('-dirty' if git('status', '--porcelain', '--untracked-files=no') else '')
+
+
+def prepare_workdir(workdir):
+    """
+    Write a dwh.cfg that points the S3 paths to the local data directory, linked as workdir/data. The links are
+    swapped per scale, so sql_queries.py only has to be imported once.
+    :param workdir: Working directory of the benchmark
+    """
+    config = configparser.ConfigParser()
+    config.optionxform = str
+    config['AWS'] = {'KEY': 'local', 'SECRET': 'local'}
+    config['CLUSTERSETUP'] = {'CLUSTER_TYPE': 'single-node', 'NUM_NODES': '1', 'NODE_TYPE': 'dc2.large'}
+    config['CLUSTER'] = {'HOST': 'localhost', 'DB_IDENTIFIER': 'local', 'DB_NAME': 'local', 'DB_USER': 'local',
+                         'DB_PASSWORD': 'local', 'DB_PORT': '5432'}
+    config['IAM_ROLE'] = {'ARN': 'local'}
+    data = os.path.join(workdir, 'data')
+    config['S3'] = {'LOG_DATA': f"'{os.path.join(data, 'log_data')}'",
+                    'LOG_JSONPATH': f"'{os.path.join(data, 'log_json_path.json')}'",
+                    'SONG_DATA': f"'{os.path.join(data, 'song_data')}'"}
+    with open(os.path.join(workdir, 'dwh.cfg'), 'w') as f:
+        config.write(f)
+    os.makedirs(data, exist_ok=True)
+
+
+def link_data(workdir, data_dir):
+    """
+    Point workdir/data to the data directory of a scale
+    :param workdir: Working directory of the benchmark
+    :param data_dir: Data directory with song_data/ and log_data/
+    """
+    data = os.path.join(workdir, 'data')
+    for name in ['song_data', 'log_data', 'log_json_path.json']:
+        link = os.path.join(data, name)
+        if os.path.lexists(link):
+            os.remove(link)
+    os.symlink(os.path.abspath(os.path.join(data_dir, 'song_data')), os.path.join(data, 'song_data'))
+    os.symlink(os.path.abspath(os.path.join(data_dir, 'log_data')), os.path.join(data, 'log_data'))
+
+    json_path = os.path.join(data_dir, 'log_json_path.json')
+    if os.path.exists(json_path):
+        os.symlink(os.path.abspath(json_path), os.path.join(data, 'log_json_path.json'))
+    else:
+        with open(os.path.join(data, 'log_json_path.json'), 'w') as f:
+            json.dump({'jsonpaths': [f"$['{column}']" for column in LOG_COLUMNS]}, f)
+
+
+def measure(name, function, results):
+    """
+    Run one stage and record its wall time and peak Python memory
+    """
+    tracemalloc.start()
+    start_time = time.perf_counter()
+    value = function()
+    seconds = time.perf_counter() - start_time
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    results[name] = {'seconds': round(seconds, 6), 'peak_memory_mb': round(peak / 2 ** 20, 3)}
+    return value
+
+
+def run_scale(data_dir, connect):
+    """
+    Run the pipeline once on a data directory
+    :param data_dir: Data directory of the scale
+    :param connect: Callable returning a new CompatConnection
+    :return: Dictionary with the per stage timings, rows per second and table counts
+    """
+    from create_tables import create_tables, drop_tables
+    from etl import data_exists, insert_tables, load_staging_tables
+
+    conn = connect()
+    cur = conn.cursor()
+    stages = {}
+
+    measure('drop', lambda: drop_tables(cur, conn), stages)
+    measure('create', lambda: create_tables(cur, conn), stages)
+    measure('load', lambda: load_staging_tables(cur, conn), stages)
+    measure('insert', lambda: insert_tables(cur, conn), stages)
+    counts = measure('verify', lambda: data_exists(cur), stages)
+    conn.close()
+
+    loaded_rows = sum(counts[table] for table in STAGING_TABLES)
+    inserted_rows = sum(counts[table] for table in STAR_TABLES)
+    stages['load']['rows_per_second'] = round(loaded_rows / max(stages['load']['seconds'], 1e-9), 1)
+    stages['insert']['rows_per_second'] = round(inserted_rows / max(stages['insert']['seconds'], 1e-9), 1)
+
+    result = {
+        'data_dir': os.path.basename(os.path.normpath(data_dir)),
+        'total_seconds': round(sum(stage['seconds'] for stage in stages.values()), 6),
+        'max_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'stages': stages,
+        'counts': counts,
+    }
+
+    expected_path = os.path.join(data_dir, 'expected_counts.json')
+    if os.path.exists(expected_path):
+        with open(expected_path) as f:
+            expected = json.load(f)
+        result['mismatches'] = {table: {'expected': count, 'actual': counts.get(table)}
+                                for table, count in expected.items() if counts.get(table) != count}
+
+    return result
+
+
+def print_comparison(results, baseline):
+    """
+    Print the stage timings next to the timings of an earlier commit
+    """
+    previous = {scale['data_dir']: scale for scale in baseline['scales']}
+    print(f"\n========== Compared with {baseline['commit']} ==========")
+    for scale in results['scales']:
+        if scale['data_dir'] not in previous:
+            continue
+        for name, stage in scale['stages'].items():
+            before = previous[scale['data_dir']]['stages'].get(name)
+            if before:
+                ratio = stage['seconds'] / max(before['seconds'], 1e-9)
+                print(f" {scale['data_dir']:<15} {name:<8} {before['seconds']:10.3f}s -> {stage['seconds']:10.3f}s "
+                      f"({ratio:5.2f}x)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('data_dirs', nargs='+', help="Data directories, one per scale")
+    parser.add_argument('--engine', choices=['sqlite', 'postgres'], default='sqlite')
+    parser.add_argument('--dsn', default='dbname=postgres', help="PostgreSQL connection string")
+    parser.add_argument('--compare', help="Commit of earlier results to compare with")
+    parser.add_argument('--results-dir', default=RESULTS_DIR, help="Directory the results are written to and "
+                                                                   "compared from")
+    args = parser.parse_args()
+    results_dir = os.path.abspath(args.results_dir)
+
+    data_dirs = [os.path.abspath(data_dir) for data_dir in args.data_dirs]
+    workdir = tempfile.mkdtemp(prefix='pipeline-benchmark-')
+    prepare_workdir(workdir)
+    os.chdir(workdir)
+    sys.path.insert(0, SERVICES_DIR)
+    sys.path.insert(0, BENCHMARKS_DIR)
+    from compat import CompatConnection
+
+    if args.engine == 'sqlite':
+        database = os.path.join(workdir, 'benchmark.db')
+
+        def connect():
+            return CompatConnection.sqlite(database)
+    else:
+        def connect():
+            return CompatConnection.postgres(args.dsn)
+
+    results = {'commit': current_commit(), 'engine': args.engine, 'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+               'scales': []}
+    for data_dir in data_dirs:
+        link_data(workdir, data_dir)
+        scale = run_scale(data_dir, connect)
+        results['scales'].append(scale)
+
+        print(f"\n========== {scale['data_dir']} ==========")
+        for name, stage in scale['stages'].items():
+            rate = f" {stage['rows_per_second']:>12.1f} rows/s" if 'rows_per_second' in stage else ''
+            print(f" {name:<8} {stage['seconds']:10.3f}s  peak {stage['peak_memory_mb']:8.2f} MB{rate}")
+        print(f" counts   {scale['counts']}")
+        if 'mismatches' in scale:
+            print(f" expected {'OK' if not scale['mismatches'] else scale['mismatches']}")
+
+    os.makedirs(results_dir, exist_ok=True)
+    path = os.path.join(results_dir, f"{results['commit']}-{args.engine}.json")
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"\n Results: {path}")
+
+    if args.compare:
+        with open(os.path.join(results_dir, f"{args.compare}-{args.engine}.json")) as f:
+            print_comparison(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""
+Benchmark of the songplays join on synthetic data: the join on title only against the join on the song match key.
+The tables are built in an in-memory SQLite database, the song match key is computed with the same normalization
+as sql_queries.song_key_expression.
+
+Usage: python benchmarks/song_match_key.py [number of songs] [number of events]
+"""
+import hashlib
+import random
+import sqlite3
+import sys
+import time
+
+
+def song_key(title, artist_name, duration):
+    """
+    Python version of sql_queries.song_key_expression
+    :return: Integer key, None when one of the values is None
+    """
+    if title is None or artist_name is None or duration is None:
+        return None
+    # ROUND in Redshift rounds halves away from zero
+    rounded = int(duration + 0.5) if duration >= 0 else -int(-duration + 0.5)
+    value = f"{title.strip().upper()}|{artist_name.strip().upper()}|{rounded}"
+    return int(hashlib.md5(value.encode('utf-8')).hexdigest()[:15], 16)
+
+
+def build_database(num_songs, num_events, seed=42):
+    """
+    Build the staging tables with synthetic data. Titles are drawn from a small pool, so different songs share a
+    title, and some songs are listed twice in the song data.
+    :param num_songs: Number of songs in staging_songs
+    :param num_events: Number of NextSong events in staging_events
+    :param seed: Seed of the random generator
+    :return: SQLite connection
+    """
+    rng = random.Random(seed)
+    conn = sqlite3.connect(':memory:')
+    conn.create_function('song_key', 3, song_key, deterministic=True)
+    conn.execute("CREATE TABLE staging_songs (song_id TEXT, title TEXT, artist_id TEXT, artist_name TEXT, "
+                 "duration REAL, song_key INTEGER)")
+    conn.execute("CREATE TABLE staging_events (song TEXT, artist TEXT, length REAL, ts INTEGER, userId TEXT, "
+                 "sessionId INTEGER, song_key INTEGER)")
+
+    titles = [f"Title {index}" for index in range(max(1, num_songs // 4))]
+    songs = []
+    for index in range(num_songs):
+        song = (f"SO{index:016d}", rng.choice(titles), f"AR{index % 1000:016d}", f"Artist {index % 1000}",
+                round(rng.uniform(60, 600), 5))
+        songs.append(song)
+    duplicates = rng.sample(songs, num_songs // 20)
+    conn.executemany("INSERT INTO staging_songs (song_id, title, artist_id, artist_name, duration) "
+                     "VALUES (?, ?, ?, ?, ?)", songs + duplicates)
+
+    events = []
+    for index in range(num_events):
+        song = rng.choice(songs)
+        events.append((song[1], song[3], song[4], 1541000000000 + index, str(rng.randint(1, 100)), index // 10))
+    conn.executemany("INSERT INTO staging_events (song, artist, length, ts, userId, sessionId) "
+                     "VALUES (?, ?, ?, ?, ?, ?)", events)
+    conn.commit()
+    return conn
+
+
+SONGPLAYS_CREATE = "CREATE TABLE songplays (start_time INTEGER, user_id TEXT, song_id TEXT, artist_id TEXT, " \
+                   "session_id INTEGER)"
+
+SONGPLAYS_INSERT = "INSERT INTO songplays (start_time, user_id, song_id, artist_id, session_id) " \
+                   "SELECT se.ts, se.userId, ss.song_id, ss.artist_id, se.sessionId "
+
+TITLE_JOIN = SONGPLAYS_INSERT + "FROM staging_events se JOIN staging_songs ss ON ss.title = se.song"
+
+KEY_JOIN = SONGPLAYS_INSERT + "FROM staging_events se " \
+           "JOIN (SELECT song_key, song_id, artist_id, " \
+           "ROW_NUMBER() OVER (PARTITION BY song_key ORDER BY song_id) AS song_rank " \
+           "FROM staging_songs) ss " \
+           "ON ss.song_key = se.song_key " \
+           "AND ss.song_rank = 1"
+
+
+def timed(conn, query):
+    """
+    Insert the songplays with the given query into an empty songplays table
+    :return: Number of songplays and the time taken in seconds
+    """
+    conn.execute("DROP TABLE IF EXISTS songplays")
+    conn.execute(SONGPLAYS_CREATE)
+    start_time = time.perf_counter()
+    conn.execute(query)
+    conn.commit()
+    elapsed = time.perf_counter() - start_time
+    return conn.execute("SELECT COUNT(*) FROM songplays").fetchone()[0], elapsed
+
+
+def main():
+    num_songs = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    num_events = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+    conn = build_database(num_songs, num_events)
+
+    # Index the join columns in both variants, SQLite would otherwise build a temporary index per query
+    conn.execute("CREATE INDEX staging_songs_title ON staging_songs (title)")
+    title_rows, title_time = timed(conn, TITLE_JOIN)
+
+    start_time = time.perf_counter()
+    conn.execute("UPDATE staging_songs SET song_key = song_key(title, artist_name, duration)")
+    conn.execute("UPDATE staging_events SET song_key = song_key(song, artist, length)")
+    conn.execute("CREATE INDEX staging_songs_key ON staging_songs (song_key)")
+    key_build_time = time.perf_counter() - start_time
+    key_rows, key_time = timed(conn, KEY_JOIN)
+
+    print(f"\n========== songplays join ==========\n"
+          f"\n Songs: {num_songs}, events: {num_events}"
+          f"\n Join on title:       {title_rows:>10} rows in {title_time:.3f} seconds"
+          f"\n Join on song key:    {key_rows:>10} rows in {key_time:.3f} seconds"
+          f" (+ {key_build_time:.3f} seconds to compute the keys)")
+
+
+if __name__ == "__main__":
+    main()
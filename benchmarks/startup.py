@@ -0,0 +1,137 @@
+"""
+Startup benchmark: how long it takes before the pipeline can run its first statement. Every measurement runs in a
+fresh interpreter, so nothing is cached between runs:
+
+- import: import sql_queries.py
+- build: first use of the statements that need the dwh.cfg file (the COPY statements and the stage graphs)
+- modules: import the orchestration modules (scheduler, etl, create_tables, ...)
+
+The number of times a configuration file is parsed is counted as well. With --compare the services of another commit
+are extracted with git archive and measured the same way.
+
+Usage: python benchmarks/startup.py [--runs N] [--compare COMMIT]
+"""
+import argparse
+import configparser
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVICES_DIR = os.path.join(os.path.dirname(BENCHMARKS_DIR), 'services')
+
+# Modules that import without boto3 or psycopg2, so the benchmark also runs offline
+ORCHESTRATION_MODULES = ['scheduler', 'async_scheduler', 'etl', 'create_tables', 'incremental', 'stats', 'quality',
+                         'plans', 'manifest', 'convert']
+
+MEASURE = """
+import configparser, json, sys, time
+
+reads = []
+original_read = configparser.ConfigParser.read
+
+
+def read(self, filenames, *args, **kwargs):
+    reads.append(filenames)
+    return original_read(self, filenames, *args, **kwargs)
+
+
+configparser.ConfigParser.read = read
+sys.path.insert(0, sys.argv[1])
+
+start = time.perf_counter()
+import sql_queries
+imported = time.perf_counter()
+reads_at_import = len(reads)
+sql_queries.copy_table_queries, sql_queries.load_stage_graph
+built = time.perf_counter()
+for module in sys.argv[2].split(','):
+    try:
+        __import__(module)
+    except ImportError:
+        pass
+loaded = time.perf_counter()
+
+print(json.dumps({'import': imported - start, 'build': built - imported, 'modules': loaded - built,
+                  'reads_at_import': reads_at_import, 'reads': len(reads)}))
+"""
+
+
+def write_config(workdir):
+    """
+    Write a dwh.cfg with local values, the statements only need the S3 paths and the IAM role
+    :param workdir: Directory the measurements run in
+    """
+    config = configparser.ConfigParser()
+    config.optionxform = str
+    config['IAM_ROLE'] = {'ARN': 'local'}
+    config['S3'] = {'LOG_DATA': "'log_data'", 'LOG_JSONPATH': "'log_json_path.json'", 'SONG_DATA': "'song_data'"}
+    with open(os.path.join(workdir, 'dwh.cfg'), 'w') as f:
+        config.write(f)
+
+
+def measure(services_dir, workdir, runs):
+    """
+    Measure the startup of the services in a directory
+    :param services_dir: Directory with sql_queries.py and the orchestration modules
+    :param workdir: Directory with the dwh.cfg file
+    :param runs: Number of fresh interpreters, the median is reported
+    :return: Dictionary with the median seconds of import, build and modules, and the configuration reads
+    """
+    results = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, '-B', '-c', MEASURE, services_dir, ','.join(ORCHESTRATION_MODULES)],
+                                cwd=workdir, capture_output=True, text=True, check=True).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+
+    summary = {key: statistics.median(result[key] for result in results) for key in ['import', 'build', 'modules']}
+    summary['total'] = summary['import'] + summary['build'] + summary['modules']
+    summary['reads_at_import'] = results[0]['reads_at_import']
+    summary['reads'] = results[0]['reads']
+    return summary
+
+
+def extract_services(commit, target_dir):
+    """
+    Extract the services directory of a commit
+    :param commit: Commit, branch or tag
+    :param target_dir: Directory the tree is extracted to
+    :return: Path of the extracted services directory
+    """
+    archive = subprocess.run(['git', 'archive', commit, 'services'], cwd=os.path.dirname(SERVICES_DIR),
+                             capture_output=True, check=True).stdout
+    subprocess.run(['tar', '-x', '-C', target_dir], input=archive, check=True)
+    return os.path.join(target_dir, 'services')
+
+
+def print_summary(name, summary):
+    print(f" {name:<10} import {summary['import'] * 1000:8.1f} ms  build {summary['build'] * 1000:6.1f} ms  "
+          f"modules {summary['modules'] * 1000:7.1f} ms  total {summary['total'] * 1000:8.1f} ms  "
+          f"config reads {summary['reads_at_import']} at import, {summary['reads']} in total")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=10, help='Number of fresh interpreters per measurement')
+    parser.add_argument('--compare', help='Commit to compare the startup with')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        write_config(workdir)
+        summaries = {'current': measure(SERVICES_DIR, workdir, args.runs)}
+        if args.compare:
+            summaries[args.compare] = measure(extract_services(args.compare, workdir), workdir, args.runs)
+
+    print(f"\n========== startup (median of {args.runs} runs) ==========")
+    for name, summary in summaries.items():
+        print_summary(name, summary)
+    if args.compare:
+        speedup = summaries[args.compare]['total'] / summaries['current']['total']
+        print(f"\n current vs {args.compare}: {speedup:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
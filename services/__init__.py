@@ -1,113 +1,332 @@
 # Standard python packages
-import psycopg2
-import configparser
+import os
 import time
 
 # Custom python packages
 from redshift import RedshiftCluster
-from sql_queries import create_table_queries, drop_table_queries
+from registry import load_config
+import sql_queries
+from sql_queries import create_stage_graph, drop_stage_graph, staging_events_derived_insert, \
+    staging_songs_song_key_insert
 from create_tables import create_tables, drop_tables
-from etl import insert_tables, load_staging_tables, data_exists
-
-def set_up_redshift_cluster(redshift_cluster):
+from scheduler import run_stages, print_stage_timings, select_stages
+from async_scheduler import run_async, run_stages_async
+from incremental import load_incremental
+from checkpoint import completed_stages, reset_checkpoints, resume_plan, stage_fingerprints, with_checkpoints, \
+    write_state
+from manifest import prepare_song_manifests
+from convert import copy_statement
+from prefilter import commit_keys
+from pool import ConnectionPool
+from stats import TableStats
+from provisioning import provision_cluster, resize_and_wait
+from instrumentation import end_run, stage, start_run
+from plans import capture_plans, check_plans, print_plan_results
+from quality import format_quality_report, run_quality_checks
+from maintenance import Thresholds, plan_maintenance, print_maintenance, run_maintenance
+from analytics import refresh_views
+from export import export_tables
+from manifest import cluster_slices
+from sizing import SOURCES, SizingModel, elastic_range, estimate_inputs, print_sizing, resize_pays_off
+
+def set_up_redshift_cluster(redshift_cluster, local_work=None, timeout=1800):
     """
     Set up a Redshift cluster and wait for it to be available. The cluster properties are stored in the dwh.cfg file.
-    :param redshift_cluster:
-    :return: Not applicable
+    The status is checked with jittered exponential backoff in the background, the local work runs in the meantime.
+    :param redshift_cluster: Redshift cluster to create
+    :param local_work: Callable run while the cluster comes up, e.g. preparing the stage graph
+    :param timeout: Maximum number of seconds to wait for the cluster
+    :return: The result of the local work
     """
+    redshift_cluster_props, local_result = provision_cluster(redshift_cluster, local_work, timeout)
+    print(f"\n Redshift cluster is available!\n {redshift_cluster_props}")
 
-    # Create a Redshift cluster
-    redshift_cluster.create_redshift_cluster()
+    return local_result
 
-    # wait for the redshift cluster to be available
-    while True:
-        redshift_cluster_props = redshift_cluster.get_redshift_cluster_props()
-        cluster_status = redshift_cluster_props['Clusters'][0]['ClusterStatus']
-        if cluster_status == 'available':
-            print(f"\n Redshift cluster is available!\n {redshift_cluster_props}")
-            break
-        else:
-            print(f"\n Redshift cluster is not available yet!\n Status: {cluster_status}")
-        time.sleep(60)
+def check_cluster_size(redshift_cluster, model, inputs, config, mode='full', current_nodes=None):
+    """
+    This check estimates the load time of this run per number of nodes, from the size of the input and the throughput
+    of earlier runs, and picks the smallest number of nodes that loads within TARGET_SECONDS. An existing cluster is
+    only resized when that pays off and within the range of an elastic resize.
+    :param redshift_cluster: Redshift cluster, used for the node type and the configured number of nodes
+    :param model: SizingModel with the history of earlier runs
+    :param inputs: Dictionary returned by estimate_inputs
+    :param config: ConfigParser with the dwh.cfg file loaded
+    :param mode: Load mode of the run: full or merge
+    :param current_nodes: Number of nodes of the existing cluster, None when the cluster is created by this run
+    :return: Number of nodes to load with
+    """
+    stages = sql_queries.merge_stage_graph if mode == 'merge' else sql_queries.load_stage_graph
+    node_type = redshift_cluster.NODE_TYPE
+    min_nodes = config.getint('SIZING', 'MIN_NODES', fallback=2)
+    max_nodes = config.getint('SIZING', 'MAX_NODES', fallback=redshift_cluster.NUM_NODES * 4)
+    if current_nodes is not None:
+        low, high = elastic_range(node_type, current_nodes)
+        min_nodes, max_nodes = max(min_nodes, low), min(max_nodes, high)
+    max_nodes = max(min_nodes, max_nodes)
+
+    predictions = {num_nodes: model.predict(stages, inputs, cluster_slices(node_type, num_nodes))
+                   for num_nodes in range(min_nodes, max_nodes + 1)}
+    recommendation = model.recommend(stages, inputs, node_type,
+                                     config.getfloat('SIZING', 'TARGET_SECONDS', fallback=900.0), min_nodes, max_nodes)
+    print_sizing(inputs, predictions, recommendation)
+
+    if current_nodes is None or resize_pays_off(model, stages, inputs, node_type, current_nodes, recommendation[0],
+                                                config.getfloat('SIZING', 'RESIZE_SECONDS', fallback=600.0)):
+        return recommendation[0]
+    return current_nodes
+
+def check_for_cluster_resize(redshift_cluster, num_nodes, current_nodes, local_work=None, timeout=1800):
+    """
+    Resize the existing Redshift cluster before the load. The resize is awaited in the background, the local work runs
+    in the meantime.
+    :param redshift_cluster: Redshift cluster to resize
+    :param num_nodes: Number of nodes to load with
+    :param current_nodes: Current number of nodes, kept when the resize is refused
+    :param local_work: Callable run while the cluster is resized, e.g. preparing the stage graph
+    :param timeout: Maximum number of seconds to wait for the resize
+    :return: The result of the local work
+    """
+    redshift_cluster_props, local_result = resize_and_wait(redshift_cluster, num_nodes, local_work, timeout)
+    if redshift_cluster_props is None:
+        print(f"\n Resize to {num_nodes} nodes refused, loading with {current_nodes} nodes")
+        redshift_cluster.NUM_NODES = current_nodes
+    else:
+        print(f"\n Redshift cluster resized to {num_nodes} nodes")
+
+    return local_result
 
-def check_for_table_creation(props):
+def check_for_table_creation(pool, backend='threads', workers=4):
     """
     This check will create the tables in the Redshift cluster.
-    :param props: Redshift cluster properties
+    :param pool: Connection pool to the Redshift cluster
+    :param backend: threads creates the tables one by one, asyncio creates the independent tables at the same time
+    :param workers: Number of tables created at the same time by the asyncio backend
     :return:
     """
-    # Connect to the Redshift cluster
-    conn = psycopg2.connect("host={} dbname={} user={} password={} port={}".format(*props))
-    cur = conn.cursor()
-
-    create_tables(cur, conn)
+    if backend == 'asyncio':
+        run_async(run_stages_async(pool, create_stage_graph, workers))
+        return
 
-    # Close connection to the Redshift cluster
-    conn.close()
+    # Borrow a connection to the Redshift cluster
+    with pool.session() as conn, stage('create'):
+        cur = conn.cursor()
+        create_tables(cur, conn)
 
-def check_for_table_drops(props):
+def check_for_table_drops(pool, backend='threads', workers=4):
     """
     This check will create the tables in the Redshift cluster. Seperate in case we want to drop tables before
     creating them. In some cases the tables have been create but the data is not loaded yet. Therefore we want to
     keep the tables that are already created. Therefore we have a seperate check for dropping tables.
-    :param props: Redshift cluster properties
+    :param pool: Connection pool to the Redshift cluster
+    :param backend: threads drops the tables one by one, asyncio drops the independent tables at the same time
+    :param workers: Number of tables dropped at the same time by the asyncio backend
     :return:
     """
-    # Connect to the Redshift cluster
-    conn = psycopg2.connect("host={} dbname={} user={} password={} port={}".format(*props))
-    cur = conn.cursor()
+    if backend == 'asyncio':
+        run_async(run_stages_async(pool, drop_stage_graph, workers))
+        return
 
-    drop_tables(cur, conn)
+    # Borrow a connection to the Redshift cluster
+    with pool.session() as conn, stage('drop'):
+        cur = conn.cursor()
+        drop_tables(cur, conn)
 
-    # Close connection to the Redshift cluster
-    conn.close()
+def prepare_stage_graph(redshift_cluster, config, mode='full'):
+    """
+    Build the stage graph for this run. In merge mode the staging tables are reloaded and the dimensions merged.
+    When a MANIFEST_PREFIX is configured, the song files are split in batches for the slices of the cluster and
+    staging_songs is loaded with one COPY per manifest. When a CONVERTED_FORMAT is configured, the staging tables
+    are loaded from the gzip CSV or Parquet files written by convert.py.
+    :param redshift_cluster: Redshift cluster, used for the node type and number of nodes
+    :param config: ConfigParser with the dwh.cfg file loaded
+    :param mode: Load mode of the run: full, incremental or merge
+    :return: Dictionary with stage name -> (query or list of queries, list of stage names it depends on)
+    """
+    stages = dict(sql_queries.merge_stage_graph if mode == 'merge' else sql_queries.load_stage_graph)
+    if config.has_option('S3', 'MANIFEST_PREFIX'):
+        song_copies = prepare_song_manifests(config.get('S3', 'SONG_DATA'), config.get('S3', 'MANIFEST_PREFIX'),
+                                             redshift_cluster.NODE_TYPE, redshift_cluster.NUM_NODES,
+                                             config.getint('ETL', 'FILES_PER_SLICE', fallback=1000))
+        stages['staging_songs'] = (song_copies + staging_songs_song_key_insert, stages['staging_songs'][1])
+    if config.has_option('S3', 'CONVERTED_FORMAT'):
+        # The files were converted by convert.py and uploaded to the CONVERTED_* prefixes
+        output_format = config.get('S3', 'CONVERTED_FORMAT')
+        for table_name, option, key_insert in [('staging_events', 'CONVERTED_LOG_DATA', staging_events_derived_insert),
+                                               ('staging_songs', 'CONVERTED_SONG_DATA', staging_songs_song_key_insert)]:
+            if config.has_option('S3', option):
+                stages[table_name] = ([copy_statement(table_name, output_format, config.get('S3', option))] +
+                                      key_insert, stages[table_name][1])
+
+    return stages
+
+def check_for_data_insertion(pool, workers=4, stages=None, backend='threads', timeout=None):
+    """
+    This check will insert data into the tables in the Redshift cluster. The COPY and INSERT statements are run as a
+    DAG, independent statements run at the same time on separate connections borrowed from the pool.
+    :param pool: Connection pool to the Redshift cluster
+    :param workers: Number of worker connections to the Redshift cluster
+    :param stages: Stage graph to run, the stage graph of sql_queries.py when not given
+    :param backend: threads or asyncio. The asyncio backend prints the progress and cancels stages on a timeout.
+    :param timeout: Maximum number of seconds per stage with the asyncio backend, None waits forever
+    :return: Dictionary with the timings per stage
+    """
+    if backend == 'asyncio':
+        timings = run_async(run_stages_async(pool, stages, workers, timeout))
+    else:
+        timings = run_stages(pool, stages, workers)
+    print_stage_timings(timings)
+
+    return timings
 
-def check_for_data_insertion(props):
+def check_for_resumable_load(pool, stages):
     """
-    This check will insert data into the tables in the Redshift cluster.
-    :param props: Redshift cluster properties
-    :return:
+    This check compares the stages of this run with the stages committed by earlier runs. When a load failed part way
+    with the same statements and inputs, only the stages that are missing have to run again.
+    :param pool: Connection pool to the Redshift cluster
+    :param stages: Stage graph of this run
+    :return: Tuple of the fingerprint per stage, the committed stages and the stage graph to resume with, which is
+    None when the load has to start from scratch
     """
+    fingerprints = stage_fingerprints(stages)
+    with pool.session() as conn, stage('checkpoints'):
+        completed = completed_stages(conn.cursor())
+        conn.commit()
+
+    return fingerprints, completed, resume_plan(stages, fingerprints, completed)
 
-    # Connect to the Redshift cluster
-    conn = psycopg2.connect("host={} dbname={} user={} password={} port={}".format(*props))
-    cur = conn.cursor()
+def check_for_checkpointed_insertion(pool, stages, fingerprints, state_path, workers=4, backend='threads',
+                                     timeout=None):
+    """
+    This check will run the stages with a checkpoint per stage. Whether the run succeeds or fails, the committed
+    stages are written to the local state file afterwards.
+    :param pool: Connection pool to the Redshift cluster
+    :param stages: Stages that still have to run
+    :param fingerprints: Fingerprint per stage, returned by check_for_resumable_load
+    :param state_path: Path of the local state file
+    :param workers: Number of worker connections to the Redshift cluster
+    :param backend: threads or asyncio
+    :param timeout: Maximum number of seconds per stage with the asyncio backend, None waits forever
+    :return: Dictionary with the timings per stage
+    """
+    status = 'failed'
+    try:
+        timings = check_for_data_insertion(pool, workers, with_checkpoints(stages, fingerprints), backend, timeout)
+        status = 'loaded'
+    finally:
+        with pool.session() as conn, stage('checkpoints'):
+            completed = completed_stages(conn.cursor())
+            conn.commit()
+        write_state(state_path, fingerprints, completed, status)
+
+    return timings
+
+def check_for_incremental_insertion(pool, table_stats, log_data, manifest_prefix, workers=4, stages=None):
+    """
+    This check will only load the log files that are not loaded yet. The song data is loaded once, when the
+    staging_songs table is still empty.
+    :param pool: Connection pool to the Redshift cluster
+    :param table_stats: Statistics of the pipeline tables
+    :param log_data: S3 uri or local directory with the log data
+    :param manifest_prefix: S3 uri or local directory the manifest of the new log files is written to
+    :param workers: Number of worker connections to the Redshift cluster
+    :param stages: Stage graph to take the song stages from, the stage graph of sql_queries.py when not given
+    :return: Dictionary with partition key -> number of log files loaded
+    """
+    if stages is None:
+        stages = sql_queries.load_stage_graph
+    if check_existing_data(table_stats)['staging_songs'] == 0:
+        timings = run_stages(pool, select_stages(stages, ['staging_songs', 'songs', 'artists']), workers)
+        print_stage_timings(timings)
 
-    load_staging_tables(cur, conn)
-    insert_tables(cur, conn)
+    with pool.session() as conn, stage('incremental'):
+        cur = conn.cursor()
+        loaded_files = load_incremental(cur, conn, log_data, manifest_prefix)
 
-    # Close connection to the Redshift cluster
-    conn.close()
+    return loaded_files
 
-def check_existing_data(props):
+def check_existing_data(table_stats, refresh=False):
     """
     This check will check if data is already loaded in the tables in the Redshift cluster. It returns a dictionary
     with the table names and the number of records in the table. This gives an indication if the data is loaded.
-    :param props: Redshift cluster properties
+    All tables are counted in a single round trip, or at the same time with the asyncio backend of the table
+    statistics, and the result is cached until refresh is asked for.
+    :param table_stats: Statistics of the pipeline tables
+    :param refresh: Count the records again instead of using the cached counts
     :return: Dictionary with table names and number of records
     """
-    # Connect to the Redshift cluster
-    conn = psycopg2.connect("host={} dbname={} user={} password={} port={}".format(*props))
-    cur = conn.cursor()
+    with stage('counts'):
+        return table_stats.counts(refresh)
 
-    if_data_exists = data_exists(cur)
+def check_table_maintenance(pool, table_stats, thresholds, budget=600.0):
+    """
+    This check reads the health of the fact and dimension tables from SVV_TABLE_INFO after the load, and analyzes or
+    vacuums the tables that are over a threshold, within a time budget
+    :param pool: Connection pool to the Redshift cluster
+    :param table_stats: Statistics of the pipeline tables
+    :param thresholds: Thresholds of the maintenance
+    :param budget: Number of seconds the maintenance may take
+    :return: List of the actions with their status
+    """
+    # The staging tables are reloaded by every run, maintaining them is wasted work
+    details = {table: detail for table, detail in table_stats.details(refresh=True).items()
+               if not table.startswith('staging_')}
+    results = run_maintenance(pool, plan_maintenance(details, thresholds), budget)
+    print_maintenance(results)
+
+    return results
 
-    # Close connection to the Redshift cluster
-    conn.close()
+def check_for_analytics_refresh(pool):
+    """
+    This check will create or refresh the materialized views of the analytics after the load. The views are refreshed
+    incrementally from the rows the load added and the watermark moves, so the result caches of the dashboards are
+    cleared.
+    :param pool: Connection pool to the Redshift cluster
+    :return: Dictionary with view name -> created or refreshed
+    """
+    results = refresh_views(pool)
+    print(f"\n Materialized views: {results}")
 
-    return if_data_exists
+    return results
 
-def check_result_of_data_insertion(data_stored):
+def check_for_export(pool, prefix, incremental=True, max_file_size=256):
     """
-    Check if data is already loaded according to expected results
-    :param data_stored: The data stored by the ETL pipeline
-    :return: True if the data is loaded, False if the data is not loaded
+    This check will unload the fact and dimension tables as partitioned Parquet to the export prefix. Every slice
+    writes its own files, so the downstream teams read the files instead of the tables through the leader node.
+    :param pool: Connection pool to the Redshift cluster
+    :param prefix: S3 uri of the export
+    :param incremental: Only export the new and changed partitions of songplays and times
+    :param max_file_size: Maximum size of an unloaded file in MB
+    :return: Dictionary with table name -> 'all' or the list of exported partitions
     """
+    with pool.session() as conn, stage('export'):
+        exported = export_tables(conn.cursor(), conn, prefix, incremental, max_file_size)
+    print(f"\n Exported: {exported}")
 
-    expected_results = {'staging_events': 8056, 'staging_songs': 14896, 'songplays': 1144, 'users': 107, 'songs': 14896,
-                        'artists': 10025, 'times': 8023}
+    return exported
 
-    return expected_results == data_stored
+def check_query_plans(pool, snapshot_dir):
+    """
+    This check will explain the insert and analytic queries and compare their plans with the stored snapshots, so
+    a DDL change that makes a join broadcast or redistribute its data is noticed.
+    :param pool: Connection pool to the Redshift cluster
+    :param snapshot_dir: Directory with one plan snapshot per query
+    :return: Number of queries of which the plan got worse
+    """
+    with pool.session() as conn, stage('plans'):
+        plans = capture_plans(conn.cursor())
+    return print_plan_results(check_plans(plans, snapshot_dir))
+
+def check_data_quality(pool, workers=4):
+    """
+    This check will run the data quality checks on the star schema: not null and unique keys, referential integrity
+    from songplays to the dimensions and value ranges. Every table is scanned once and the tables are checked at
+    the same time.
+    :param pool: Connection pool to the Redshift cluster
+    :param workers: Number of tables checked at the same time
+    :return: Dictionary with passed and the result of every check per table
+    """
+    return run_quality_checks(pool, workers=workers)
 
 def main():
     """
@@ -119,9 +338,43 @@ def main():
     redshift_cluster = RedshiftCluster()
     get_redshift_cluster_props = redshift_cluster.get_redshift_cluster_props()
 
+    # Number of worker connections used to load the data
+    config = load_config()
+    workers = config.getint('ETL', 'WORKERS', fallback=4)
+    mode = config.get('ETL', 'MODE', fallback='full')
+    backend = config.get('ETL', 'BACKEND', fallback='threads')
+    timeout = config.getfloat('ETL', 'STAGE_TIMEOUT', fallback=None)
+    report_dir = config.get('ETL', 'REPORT_DIR', fallback='reports')
+    state_path = config.get('ETL', 'STATE_FILE', fallback=os.path.join(report_dir, 'run_state.json'))
+
+    # Size the cluster for the input of this run. The incremental mode only loads the new log files, it runs on the
+    # cluster as it is.
+    base_nodes = redshift_cluster.NUM_NODES
+    sizing = config.getboolean('SIZING', 'ENABLED', fallback=False) and mode != 'incremental'
+    if sizing:
+        history_path = config.get('SIZING', 'HISTORY', fallback=os.path.join(report_dir, 'sizing_history.json'))
+        sizing_model = SizingModel.load(history_path)
+        inputs = estimate_inputs({table: config.get('S3', option) for table, option in SOURCES.items()},
+                                 sizing_model.bytes_per_row())
+        current_nodes = get_redshift_cluster_props['Clusters'][0]['NumberOfNodes'] \
+            if get_redshift_cluster_props else None
+        redshift_cluster.NUM_NODES = check_cluster_size(redshift_cluster, sizing_model, inputs, config, mode,
+                                                        current_nodes)
+
+    # The stage graph only needs local work and S3 listings, it is prepared while a new cluster comes up or while the
+    # cluster is resized
     if not get_redshift_cluster_props:
         print("Setting up a new server on the cluster")
-        set_up_redshift_cluster(redshift_cluster)
+        stages = set_up_redshift_cluster(redshift_cluster,
+                                         lambda: prepare_stage_graph(redshift_cluster, config, mode),
+                                         config.getint('CLUSTERSETUP', 'TIMEOUT', fallback=1800))
+    elif sizing and redshift_cluster.NUM_NODES != current_nodes:
+        print(f"\n Resizing the cluster from {current_nodes} to {redshift_cluster.NUM_NODES} nodes")
+        stages = check_for_cluster_resize(redshift_cluster, redshift_cluster.NUM_NODES, current_nodes,
+                                          lambda: prepare_stage_graph(redshift_cluster, config, mode),
+                                          config.getint('SIZING', 'RESIZE_TIMEOUT', fallback=1800))
+    else:
+        stages = prepare_stage_graph(redshift_cluster, config, mode)
 
     print(redshift_cluster)
 
@@ -132,28 +385,102 @@ def main():
              redshift_cluster.DB_PASSWORD,
              redshift_cluster.DB_PORT]
 
-    # Drop existing table and create new tables
-    print(f"\n Checking for table creation...")
-    check_for_table_drops(props)
-    check_for_table_creation(props)
+    # Every statement of the run is recorded in a JSON run report
+    run_report = start_run()
 
-    print(f"\n Checking for data insertion...")
-    # Check if data is already loaded
-    if_data_exists = check_existing_data(props)
-    print(f"\n Data already loaded: {if_data_exists}")
-
-    # sum the values in the dictionary of the keys 'songplays', 'users', 'songs', 'artists', 'times'
-    if_data_exists_sum = sum(
-        if_data_exists[key_dict] for key_dict in ['songplays', 'users', 'songs', 'artists', 'times'])
-    if if_data_exists_sum == 0:
-        print(f"\n Not all data loaded yet. Loading data...")
+    # All stages borrow their connections from one pool, so the handshakes are only paid once per connection
+    pool = ConnectionPool.from_props(props, max_size=workers)
+    table_stats = TableStats(pool, exact=config.get('ETL', 'COUNT_MODE', fallback='exact') == 'exact',
+                             prepared=config.getboolean('ETL', 'PREPARED_STATEMENTS', fallback=False),
+                             backend=backend, workers=workers)
+
+    if mode == 'incremental':
+        # Keep the loaded tables and only load the log files that arrived since the previous run
+        print("\n Checking for table creation...")
+        check_for_table_creation(pool, backend, workers)
+
+        print("\n Checking for new log data...")
         start_time = time.time()
-        check_for_data_insertion(props)
+        loaded_files = check_for_incremental_insertion(pool, table_stats, config.get('S3', 'LOG_DATA'),
+                                                       config.get('S3', 'MANIFEST_PREFIX', fallback=None), workers,
+                                                       stages)
         end_time = time.time()
+        print(f"\n Log files loaded per partition: {loaded_files}")
         print(f"\n Time taken to load data: {end_time - start_time} seconds")
+    elif mode == 'merge':
+        # Keep the tables, reload the staging tables and merge the changed keys into the dimensions
+        print("\n Checking for table creation...")
+        check_for_table_creation(pool, backend, workers)
+
+        print("\n Merging data...")
+        start_time = time.time()
+        check_for_data_insertion(pool, workers, stages, backend, timeout)
+        end_time = time.time()
+        print(f"\n Time taken to merge data: {end_time - start_time} seconds")
+
+        # The song records pre-filtered for this run are loaded, the next run skips them
+        if config.has_option('ETL', 'PREFILTER_KEYS'):
+            print(f"\n Pre-filter keys committed: {commit_keys(config.get('ETL', 'PREFILTER_KEYS'))}")
+    else:
+        # Resume a load that failed part way, otherwise drop the existing tables and create new tables
+        print("\n Checking for committed stages...")
+        fingerprints, completed, remaining = check_for_resumable_load(pool, stages)
+        if remaining is None or not config.getboolean('ETL', 'RESUME', fallback=True):
+            print("\n Checking for table creation...")
+            check_for_table_drops(pool, backend, workers)
+            check_for_table_creation(pool, backend, workers)
+            with pool.session() as conn:
+                reset_checkpoints(conn.cursor(), conn)
+            remaining = stages
+        else:
+            print(f"\n Stages already committed: {sorted(completed)}")
+
+        if remaining:
+            print(f"\n Loading data: {list(remaining)}")
+            start_time = time.time()
+            check_for_checkpointed_insertion(pool, remaining, fingerprints, state_path, workers, backend, timeout)
+            end_time = time.time()
+            print(f"\n Time taken to load data: {end_time - start_time} seconds")
+        else:
+            print("\n All stages are loaded already")
 
     # Check if data is already loaded
-    data_stored = check_existing_data(props)
+    data_stored = check_existing_data(table_stats, refresh=True)
+
+    # The throughput of this load sizes the next runs
+    if sizing:
+        stage_seconds = run_report.to_dict()['stages']
+        sizing_model.record_run(history_path, redshift_cluster.NODE_TYPE, redshift_cluster.NUM_NODES, inputs,
+                                {table: data_stored[table] for table in SOURCES},
+                                {name: stage_seconds[name]['seconds'] for name in stages if name in stage_seconds})
+
+    # Refresh the statistics and sort the tables the load left unsorted, before the plans are checked
+    if config.getboolean('MAINTENANCE', 'ENABLED', fallback=True):
+        check_table_maintenance(pool, table_stats, Thresholds.from_config(config),
+                                config.getfloat('MAINTENANCE', 'BUDGET', fallback=600.0))
+    if config.getboolean('ANALYTICS', 'ENABLED', fallback=True):
+        check_for_analytics_refresh(pool)
+    if config.has_option('EXPORT', 'PREFIX'):
+        check_for_export(pool, config.get('EXPORT', 'PREFIX'),
+                         config.getboolean('EXPORT', 'INCREMENTAL', fallback=True),
+                         config.getint('EXPORT', 'MAX_FILE_SIZE', fallback=256))
+    quality_report = check_data_quality(pool, workers)
+
+    # Compare the query plans with the snapshots of earlier runs
+    if config.has_option('ETL', 'PLAN_SNAPSHOTS'):
+        check_query_plans(pool, config.get('ETL', 'PLAN_SNAPSHOTS'))
+
+    pool.close()
+    print(pool)
+
+    # Shrink the cluster back to the configured size once the heavy work is done, without waiting for it
+    if sizing and redshift_cluster.NUM_NODES != base_nodes:
+        print(f"\n Resizing the cluster back to {base_nodes} nodes: "
+              f"{redshift_cluster.resize_cluster(base_nodes) is not None}")
+
+    report_path = end_run().write(report_dir)
+    print(f"\n Run report: {report_path}")
+    print(f"\n Redshift API calls: {redshift_cluster.calls}")
 
     # Print results
     database_statement = f"\n========== Redshift database ==========\n" \
@@ -167,8 +494,9 @@ def main():
     # Test if data is loaded
     test_statement = f"\n========== Test results ==========\n"\
                      f"\n Goal: Load data into the Redshift cluster and store it in the database"\
-                     f"\n Result: {len(data_stored.keys())} out of 7 tables loaded " \
-                     f"\n Test passed: {check_result_of_data_insertion(data_stored)}"
+                     f"\n Result: {len(data_stored.keys())} out of 7 tables loaded \n" \
+                     f"{format_quality_report(quality_report)}" \
+                     f"\n Test passed: {quality_report['passed']}"
     print(test_statement)
 
     # save result in a file (etl.log)
@@ -0,0 +1,220 @@
+import sys
+import time
+from collections import OrderedDict
+
+from registry import load_config
+from sql_queries import analytics_reads, analytics_watermark_select, analytics_watermark_update, \
+    control_table_queries, materialized_view_create, materialized_view_refresh, materialized_views, \
+    materialized_views_select
+from instrumentation import execute, stage
+
+
+class ResultCache:
+    """
+    Local cache of query results, least recently used entries are evicted first and an entry expires after ttl
+    seconds. The cache is cleared when the load watermark moves, the ttl only bounds how stale a result gets when the
+    watermark cannot be read.
+    """
+
+    def __init__(self, max_entries=128, ttl=300.0, clock=time.monotonic):
+        """
+        Initialize the result cache
+        :param max_entries: Maximum number of results kept
+        :param ttl: Number of seconds a result is served from the cache
+        :param clock: Callable returning the current time in seconds
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.clock = clock
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        """
+        Look up a result
+        :param key: Hashable key of the result
+        :return: Tuple of (found, result)
+        """
+        entry = self._entries.get(key)
+        if entry is None or self.clock() - entry[0] > self.ttl:
+            self._entries.pop(key, None)
+            self.misses += 1
+            return False, None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return True, entry[1]
+
+    def put(self, key, result):
+        """
+        Store a result, the least recently used result is evicted when the cache is full
+        :param key: Hashable key of the result
+        :param result: Result of the query
+        """
+        self._entries[key] = (self.clock(), result)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __repr__(self):
+        return f"ResultCache(entries={len(self)}, hits={self.hits}, misses={self.misses}, evictions={self.evictions})"
+
+
+def refresh_views(pool):
+    """
+    Create the missing materialized views and refresh the others, then move the watermark. Redshift refreshes the
+    views incrementally from the rows the load changed, a view on a table that was dropped and loaded again is
+    created from scratch.
+    :param pool: Connection pool to the Redshift cluster
+    :return: Dictionary with view name -> created or refreshed
+    """
+    results = {}
+    # REFRESH MATERIALIZED VIEW cannot run inside a transaction block
+    with pool.autocommit_session() as conn, stage('analytics'):
+        cur = conn.cursor()
+        for query in control_table_queries:
+            execute(cur, query)
+        execute(cur, materialized_views_select)
+        existing = {row[0].strip() for row in cur.fetchall()}
+
+        for name, select in materialized_views.items():
+            if name in existing:
+                execute(cur, materialized_view_refresh.format(name))
+                results[name] = 'refreshed'
+            else:
+                execute(cur, materialized_view_create.format(name, select))
+                results[name] = 'created'
+
+    # The watermark is replaced in one transaction, a reader never sees it missing
+    with pool.session() as conn:
+        cur = conn.cursor()
+        for query in analytics_watermark_update:
+            execute(cur, query)
+        conn.commit()
+
+    return results
+
+
+class Analytics:
+    """
+    Read path of the dashboards: the common aggregates read from the materialized views, served from a local result
+    cache until the pipeline refreshes the views again
+    """
+
+    def __init__(self, pool, cache=None, watermark_interval=30.0, clock=time.monotonic):
+        """
+        Initialize the analytics
+        :param pool: Connection pool to the Redshift cluster
+        :param cache: ResultCache, a default cache when not given
+        :param watermark_interval: Number of seconds between two reads of the watermark, reads in between are
+        served from the cache without a round trip
+        :param clock: Callable returning the current time in seconds
+        """
+        self.pool = pool
+        self.cache = cache or ResultCache(clock=clock)
+        self.watermark_interval = watermark_interval
+        self.clock = clock
+
+        self.queries = 0
+        self._watermark = None
+        self._watermark_checked = None
+
+    @classmethod
+    def from_config(cls, pool, config=None):
+        """
+        Analytics with the [ANALYTICS] section of the dwh.cfg file, the defaults for the missing options
+        :param pool: Connection pool to the Redshift cluster
+        :param config: ConfigParser with the dwh.cfg file loaded, the dwh.cfg file when not given
+        :return: Analytics
+        """
+        config = config or load_config()
+        cache = ResultCache(config.getint('ANALYTICS', 'CACHE_SIZE', fallback=128),
+                            config.getfloat('ANALYTICS', 'CACHE_TTL', fallback=300.0))
+        return cls(pool, cache, config.getfloat('ANALYTICS', 'WATERMARK_INTERVAL', fallback=30.0))
+
+    def _fetchall(self, query, params=None):
+        self.queries += 1
+        with self.pool.session() as conn:
+            cur = conn.cursor()
+            execute(cur, query, params)
+            return cur.fetchall()
+
+    def watermark(self, refresh=False):
+        """
+        Time of the last refresh of the views, the cache is cleared when it moved
+        :param refresh: Read the watermark even when it was read less than watermark_interval seconds ago
+        :return: Watermark, None before the first refresh
+        """
+        now = self.clock()
+        if refresh or self._watermark_checked is None or now - self._watermark_checked >= self.watermark_interval:
+            watermark = self._fetchall(analytics_watermark_select)[0][0]
+            if watermark != self._watermark:
+                self.cache.clear()
+            self._watermark, self._watermark_checked = watermark, now
+        return self._watermark
+
+    def read(self, name, **params):
+        """
+        Result of one of the analytics reads
+        :param name: Name of the read in sql_queries.analytics_reads
+        :param params: Parameters of the read
+        :return: List of rows
+        """
+        if name not in analytics_reads:
+            raise KeyError(f"Unknown analytics read '{name}', expected one of {sorted(analytics_reads)}")
+
+        self.watermark()
+        key = (name, tuple(sorted(params.items())))
+        found, rows = self.cache.get(key)
+        if not found:
+            rows = [tuple(row) for row in self._fetchall(analytics_reads[name], params or None)]
+            self.cache.put(key, rows)
+        return rows
+
+    def songplays_per_hour(self):
+        """
+        :return: List of (hour, songplays)
+        """
+        return self.read('songplays_per_hour')
+
+    def top_songs(self, limit=10):
+        """
+        :param limit: Number of songs
+        :return: List of (title, artist name, songplays), the most played song first
+        """
+        return self.read('top_songs', limit=limit)
+
+    def active_users_per_level(self):
+        """
+        :return: List of (level, active users, songplays)
+        """
+        return self.read('active_users_per_level')
+
+
+if __name__ == "__main__":
+    # python analytics.py [refresh]: print the aggregates, refresh the views first with refresh
+    from redshift import RedshiftCluster
+    from pool import ConnectionPool
+
+    redshift_cluster = RedshiftCluster()
+    redshift_cluster.get_redshift_cluster_props()
+    pool = ConnectionPool.from_props([redshift_cluster.HOST, redshift_cluster.DB_NAME, redshift_cluster.DB_USER,
+                                      redshift_cluster.DB_PASSWORD, redshift_cluster.DB_PORT], max_size=1)
+    if sys.argv[1:] == ['refresh']:
+        print(f"\n Materialized views: {refresh_views(pool)}")
+    analytics = Analytics.from_config(pool)
+    for name in analytics_reads:
+        print(f"\n========== {name} ==========")
+        for row in analytics.read(name, **({'limit': 10} if name == 'top_songs' else {})):
+            print(f" {row}")
+    pool.close()
@@ -0,0 +1,159 @@
+import asyncio
+import time
+
+import sql_queries
+from sql_queries import exact_count_select
+from registry import Query
+from scheduler import validate_stage_graph
+from instrumentation import execute, stage
+
+
+def print_progress(name, status, done, total, timing=None):
+    """
+    Default progress callback, prints a line when a stage starts, finishes, fails or is cancelled
+    :param name: Name of the stage
+    :param status: started, done, failed or cancelled
+    :param done: Number of stages finished so far
+    :param total: Number of stages in the run
+    :param timing: Timings of the stage when it is done
+    """
+    took = f" in {timing['seconds']:.2f}s" if timing else ''
+    print(f" [{done}/{total}] {name} {status}{took}")
+
+
+def cancel_statement(conn):
+    """
+    Ask the server to abort the statement running on a connection, e.g. a long COPY
+    :param conn: Connection borrowed from the pool
+    """
+    cancel = getattr(conn, 'cancel', None)
+    if cancel is not None:
+        try:
+            cancel()
+        except Exception:
+            pass
+
+
+def _execute_stage(conn, name, queries):
+    # Runs in a worker thread, the stage context of the run report is set per thread
+    with stage(name):
+        cur = conn.cursor()
+        for query in queries:
+            execute(cur, query)
+        conn.commit()
+
+
+async def run_stages_async(pool, stages=None, concurrency=4, timeout=None, on_progress=print_progress):
+    """
+    Run the stages of the pipeline as a DAG on the asyncio event loop. A stage starts as soon as the stages it depends
+    on are committed, at most concurrency stages run at the same time. A stage that runs longer than the timeout is
+    cancelled on the server, and when a stage fails the running stages are cancelled as well.
+    :param pool: ConnectionPool the connections are borrowed from
+    :param stages: Dictionary with stage name -> (query or list of queries, list of stage names it depends on)
+    :param concurrency: Maximum number of stages running at the same time
+    :param timeout: Maximum number of seconds per stage, None waits forever
+    :param on_progress: Callable called with (name, status, done, total, timing), None to stay silent
+    :return: Dictionary with stage name -> timings (start and end relative to the start of the run, seconds)
+    """
+    if stages is None:
+        stages = sql_queries.load_stage_graph
+    if concurrency < 1:
+        raise ValueError("At least one concurrent stage is required")
+    validate_stage_graph(stages)
+
+    run_start = time.perf_counter()
+    timings = {}
+    committed = {name: asyncio.Event() for name in stages}
+    semaphore = asyncio.Semaphore(concurrency)
+
+    def progress(name, status, timing=None):
+        if on_progress is not None:
+            on_progress(name, status, len(timings), len(stages), timing)
+
+    async def run_stage(name):
+        queries, depends_on = stages[name]
+        if isinstance(queries, (str, Query)):
+            queries = [queries]
+        for dependency in depends_on:
+            await committed[dependency].wait()
+
+        async with semaphore:
+            acquiring = asyncio.ensure_future(asyncio.to_thread(pool.acquire))
+            try:
+                conn = await asyncio.shield(acquiring)
+            except asyncio.CancelledError:
+                # Hand the connection back once the waiting thread gets it
+                acquiring.add_done_callback(lambda future: future.exception() or pool.release(future.result()))
+                raise
+            try:
+                progress(name, 'started')
+                start = time.perf_counter()
+                worker = asyncio.ensure_future(asyncio.to_thread(_execute_stage, conn, name, queries))
+                try:
+                    await asyncio.wait_for(asyncio.shield(worker), timeout)
+                except (asyncio.TimeoutError, asyncio.CancelledError) as error:
+                    # The thread keeps running until the server has aborted the statement
+                    cancel_statement(conn)
+                    await asyncio.gather(worker, return_exceptions=True)
+                    progress(name, 'cancelled')
+                    if isinstance(error, asyncio.TimeoutError):
+                        raise TimeoutError(f"Stage '{name}' did not finish within {timeout} seconds") from None
+                    raise
+                except Exception:
+                    progress(name, 'failed')
+                    raise
+                end = time.perf_counter()
+            finally:
+                pool.release(conn)
+
+        timings[name] = {'start': start - run_start, 'end': end - run_start, 'seconds': end - start}
+        progress(name, 'done', timings[name])
+        committed[name].set()
+
+    tasks = {asyncio.ensure_future(run_stage(name)): name for name in stages}
+    try:
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        for task in done:
+            if task.exception() is not None:
+                raise RuntimeError(f"Stage '{tasks[task]}' failed") from task.exception()
+    finally:
+        # Cancel the stages that are still waiting or running, e.g. after a failure or when the run is cancelled
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    return timings
+
+
+async def count_tables_async(pool, tables, concurrency=4, timeout=None):
+    """
+    Count the records of several tables at the same time, one connection per table
+    :param pool: ConnectionPool the connections are borrowed from
+    :param tables: Names of the tables
+    :param concurrency: Maximum number of counts running at the same time
+    :param timeout: Maximum number of seconds for all counts, None waits forever
+    :return: Dictionary with table name -> number of records
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    def count(table):
+        with pool.session() as conn, stage('counts'):
+            cur = conn.cursor()
+            execute(cur, exact_count_select([table]))
+            return int(cur.fetchone()[1])
+
+    async def count_table(table):
+        async with semaphore:
+            return table, await asyncio.to_thread(count, table)
+
+    counts = await asyncio.wait_for(asyncio.gather(*(count_table(table) for table in tables)), timeout)
+    return dict(counts)
+
+
+def run_async(coroutine):
+    """
+    Run a coroutine of this module from synchronous code, e.g. main()
+    :param coroutine: Coroutine returned by run_stages_async or count_tables_async
+    :return: The result of the coroutine
+    """
+    return asyncio.run(coroutine)
@@ -0,0 +1,178 @@
+import hashlib
+import json
+import os
+import re
+import sys
+from datetime import datetime, timezone
+
+from registry import Query
+from scheduler import select_stages, validate_stage_graph
+from sources import list_objects, read_text
+from sql_queries import control_table_queries, load_stage_insert, load_stages_delete, load_stages_select
+from instrumentation import execute
+
+
+MANIFEST_OPTION = re.compile(r'\bMANIFEST\b')
+
+
+def list_versions(uri):
+    # The ETag changes when an object is rewritten, also when its size stays the same
+    return list_objects(uri, with_etag=True)
+
+
+def input_listing(query, list_inputs=list_versions, read_manifest=read_text):
+    """
+    Inputs of a COPY statement. The source of a MANIFEST COPY is a manifest file, its entries are the inputs and the
+    prefixes they were listed from are not listed again. Any other source is listed with the ETags of its objects.
+    New or rewritten files change the inputs, so the stage is not taken as loaded anymore.
+    :param query: Statement of a stage
+    :param list_inputs: Callable listing an S3 uri or local directory, as list_versions
+    :param read_manifest: Callable reading a manifest file, as sources.read_text
+    :return: List of inputs, empty for statements without a source
+    """
+    if not isinstance(query, Query) or not (query.params or {}).get('source'):
+        return []
+    source = query.params['source']
+    if MANIFEST_OPTION.search(query.sql):
+        body = read_manifest(source)
+        if body is None:
+            raise FileNotFoundError(f"Manifest {source} does not exist")
+        return [[entry['url'], entry.get('meta', {}).get('content_length')] for entry in json.loads(body)['entries']]
+    return [list(item) for item in list_inputs(source)]
+
+
+def stage_fingerprints(stages, list_inputs=list_versions, read_manifest=read_text):
+    """
+    Fingerprint of every stage: its statements, their parameters, the inputs of its COPY statements and the
+    fingerprints of the stages it depends on. Every source is listed or read once, also when several stages copy it.
+    :param stages: Dictionary with stage name -> (query or list of queries, list of stage names it depends on)
+    :param list_inputs: Callable listing the source of a COPY statement
+    :param read_manifest: Callable reading the manifest of a MANIFEST COPY statement
+    :return: Dictionary with stage name -> MD5 hex digest
+    """
+    validate_stage_graph(stages)
+    fingerprints = {}
+    listings = {}
+
+    def inputs(query):
+        key = (query.sql, query.params.get('source')) if isinstance(query, Query) and query.params else None
+        if key not in listings:
+            listings[key] = input_listing(query, list_inputs, read_manifest)
+        return listings[key]
+
+    def fingerprint(name):
+        if name not in fingerprints:
+            queries, depends_on = stages[name]
+            if isinstance(queries, (str, Query)):
+                queries = [queries]
+            content = {
+                'statements': [[query.sql, query.params] if isinstance(query, Query) else [query, None]
+                               for query in queries],
+                'inputs': [inputs(query) for query in queries],
+                'depends_on': {dependency: fingerprint(dependency) for dependency in sorted(depends_on)},
+            }
+            fingerprints[name] = hashlib.md5(json.dumps(content, sort_keys=True, default=str).encode()).hexdigest()
+        return fingerprints[name]
+
+    for name in stages:
+        fingerprint(name)
+    return fingerprints
+
+
+def with_checkpoints(stages, fingerprints):
+    """
+    Add a checkpoint to every stage. The row is inserted in the transaction of the stage, so it exists exactly when
+    the stage is committed.
+    :param stages: Dictionary with stage name -> (query or list of queries, list of stage names it depends on)
+    :param fingerprints: Dictionary returned by stage_fingerprints
+    :return: Stage graph with the same dependencies
+    """
+    checkpointed = {}
+    for name, (queries, depends_on) in stages.items():
+        if isinstance(queries, (str, Query)):
+            queries = [queries]
+        checkpoint = Query(load_stage_insert, {'stage': name, 'fingerprint': fingerprints[name]})
+        checkpointed[name] = (list(queries) + [checkpoint], depends_on)
+    return checkpointed
+
+
+def completed_stages(cur):
+    """
+    Stages committed by earlier runs
+    :param cur: Cursor to the Redshift cluster
+    :return: Dictionary with stage name -> fingerprint
+    """
+    for query in control_table_queries:
+        execute(cur, query)
+    execute(cur, load_stages_select)
+    return {stage.strip(): fingerprint.strip() for stage, fingerprint in cur.fetchall()}
+
+
+def reset_checkpoints(cur, conn):
+    """
+    Forget the committed stages, e.g. after the tables have been dropped for a fresh load
+    :param cur: Cursor to the Redshift cluster
+    :param conn: Connection to the Redshift cluster
+    """
+    for query in control_table_queries:
+        execute(cur, query)
+    execute(cur, load_stages_delete)
+    conn.commit()
+
+
+def resume_plan(stages, fingerprints, completed):
+    """
+    Decide how a run continues after the stages of an earlier run. Resuming is only safe when every committed stage
+    still has the same fingerprint: a stage with other inputs has already written its rows, running the stages after
+    it again would load them twice.
+    :param stages: Dictionary with stage name -> (query or list of queries, list of stage names it depends on)
+    :param fingerprints: Dictionary returned by stage_fingerprints for this run
+    :param completed: Dictionary returned by completed_stages
+    :return: Stage graph with the stages that still have to run, None when the load has to start from scratch
+    """
+    if not completed or any(fingerprints.get(name) != fingerprint for name, fingerprint in completed.items()):
+        return None
+    return select_stages(stages, [name for name in stages if name not in completed])
+
+
+def write_state(path, fingerprints, completed, status):
+    """
+    Write the state of the run next to the run reports, so the progress of a load can be read without a connection
+    :param path: Path of the JSON state file
+    :param fingerprints: Dictionary with stage name -> fingerprint of this run
+    :param completed: Dictionary with stage name -> fingerprint of the committed stages
+    :param status: Status of the run, loaded or failed
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    state = {
+        'updated_at': datetime.now(timezone.utc).isoformat(),
+        'status': status,
+        'stages': {name: {'fingerprint': fingerprint, 'completed': completed.get(name) == fingerprint}
+                   for name, fingerprint in fingerprints.items()},
+    }
+    with open(path + '.tmp', 'w') as f:
+        json.dump(state, f, indent=2)
+    os.replace(path + '.tmp', path)
+
+
+def read_state(path):
+    """
+    Read the state file written by write_state
+    :param path: Path of the JSON state file
+    :return: Dictionary with the state, None when there is no state file
+    """
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+if __name__ == "__main__":
+    # python checkpoint.py <state_file>: print the stages of the last run
+    state = read_state(sys.argv[1])
+    if state is None:
+        print(f" No state file at {sys.argv[1]}")
+    else:
+        print(f" {state['status']} at {state['updated_at']}")
+        for name, stage in state['stages'].items():
+            print(f"   {name:<16} {'done' if stage['completed'] else 'pending':<8} {stage['fingerprint']}")
@@ -0,0 +1,211 @@
+import csv
+import gzip
+import json
+import os
+import re
+import sys
+import time
+from multiprocessing import Pool
+
+from sources import list_objects, relative_key, strip_quotes
+import sql_queries
+from sql_queries import staging_raw_tables
+
+FORMATS = {'csv': '.csv.gz', 'parquet': '.parquet'}
+# Written for NULL in the CSV files, matches NULL AS '\N' in the COPY statements
+NULL_MARKER = '\\N'
+JSONPATH = re.compile(r"^\$(?:\['([^']+)'\]|\.(\w+))$")
+
+
+def column_mapping(table_name, json_paths=None):
+    """
+    Map the columns of the raw table of a staging table to the keys of the JSON records, like COPY ... FORMAT AS JSON
+    does. The derived columns of the staging table are computed after the COPY and are not part of the files.
+    :param table_name: staging_events or staging_songs
+    :param json_paths: Local JSONPaths file, the keys are matched on the column names ('auto') when not given
+    :return: List of (column, JSON key)
+    """
+    columns = staging_raw_tables[table_name].columns
+    if json_paths is None:
+        keys = [column.name.lower() for column in columns]
+    else:
+        with open(strip_quotes(json_paths)) as f:
+            keys = []
+            for path in json.load(f)['jsonpaths']:
+                match = JSONPATH.match(path)
+                if match is None:
+                    raise ValueError(f"Unsupported JSONPath expression '{path}'")
+                keys.append(match.group(1) or match.group(2))
+        if len(keys) != len(columns):
+            raise ValueError(f"{json_paths} has {len(keys)} expressions, {table_name} loads {len(columns)} columns")
+
+    return list(zip(columns, keys))
+
+
+def coerce(value, data_type):
+    """
+    Convert a JSON value to the Python type of a staging column
+    :param value: Value from the JSON record
+    :param data_type: Redshift data type of the column, e.g. VARCHAR(100)
+    :return: int, float, str or None
+    """
+    if value is None:
+        return None
+    data_type = data_type.upper()
+    if data_type in ('BIGINT', 'INTEGER', 'INT'):
+        return None if value == '' else int(float(value)) if isinstance(value, str) else int(value)
+    if data_type in ('FLOAT', 'DOUBLE PRECISION', 'REAL'):
+        return None if value == '' else float(value)
+    return value if isinstance(value, str) else json.dumps(value)
+
+
+def iter_records(f):
+    """
+    Stream the JSON objects of a file: one or more objects per line, or objects spread over several lines
+    :param f: File opened in text mode
+    :return: Generator of the objects
+    """
+    decoder = json.JSONDecoder()
+    buffer = ''
+    for line in f:
+        buffer += line
+        while True:
+            buffer = buffer.lstrip()
+            if not buffer:
+                break
+            try:
+                record, end = decoder.raw_decode(buffer)
+            except json.JSONDecodeError:
+                # The object continues on the next line
+                break
+            yield record
+            buffer = buffer[end:]
+    if buffer.strip():
+        raise ValueError(f"Incomplete JSON object at the end of {f.name}")
+
+
+def parquet_schema(mapping):
+    """
+    Parquet schema of a raw staging table. COPY ... FORMAT AS PARQUET matches the columns by position and needs a
+    compatible type for every column.
+    :param mapping: List returned by column_mapping
+    :return: pyarrow.Schema
+    """
+    import pyarrow
+
+    types = {'BIGINT': pyarrow.int64(), 'INTEGER': pyarrow.int32(), 'INT': pyarrow.int32(),
+             'FLOAT': pyarrow.float64(), 'TIMESTAMP': pyarrow.timestamp('us')}
+    return pyarrow.schema([(column.name, types.get(column.data_type.upper(), pyarrow.string()))
+                           for column, _ in mapping])
+
+
+def convert_file(task):
+    """
+    Convert one JSON file. The records are streamed, CSV rows are written as they are read and Parquet is written in
+    row groups of batch_size rows.
+    :param task: Tuple of source path, target path, column mapping, format and batch size
+    :return: Dictionary with the number of rows and the size in bytes of the source and target file
+    """
+    source, target, mapping, output_format, batch_size = task
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+
+    def rows(f):
+        for record in iter_records(f):
+            yield [coerce(record.get(key), column.data_type) for column, key in mapping]
+
+    count = 0
+    with open(source) as f:
+        if output_format == 'csv':
+            with gzip.open(target, 'wt', newline='') as out:
+                writer = csv.writer(out)
+                for row in rows(f):
+                    writer.writerow([NULL_MARKER if value is None else value for value in row])
+                    count += 1
+        else:
+            import pyarrow
+            import pyarrow.parquet
+
+            schema = parquet_schema(mapping)
+            with pyarrow.parquet.ParquetWriter(target, schema, compression='snappy') as writer:
+                batch = []
+                for row in rows(f):
+                    batch.append(row)
+                    if len(batch) >= batch_size:
+                        writer.write_table(pyarrow.Table.from_pylist(
+                            [dict(zip(schema.names, values)) for values in batch], schema))
+                        count += len(batch)
+                        batch = []
+                if batch or count == 0:
+                    writer.write_table(pyarrow.Table.from_pylist(
+                        [dict(zip(schema.names, values)) for values in batch], schema))
+                    count += len(batch)
+
+    return {'rows': count, 'source_bytes': os.path.getsize(source), 'target_bytes': os.path.getsize(target)}
+
+
+def convert_directory(source, target, table_name, output_format='csv', json_paths=None, workers=None,
+                      batch_size=10000):
+    """
+    Convert all JSON files under a local directory to gzip compressed CSV or Parquet with a process pool. The
+    directory layout is kept, e.g. log_data/2018/11/2018-11-12-events.json -> 2018/11/2018-11-12-events.csv.gz
+    :param source: Local directory with the JSON files
+    :param target: Local directory the converted files are written to
+    :param table_name: Staging table the files are loaded into, staging_events or staging_songs
+    :param output_format: csv or parquet
+    :param json_paths: Local JSONPaths file of the table, the keys are matched on the column names when not given
+    :param workers: Number of processes, the number of CPUs when not given
+    :param batch_size: Number of rows per Parquet row group
+    :return: Dictionary with the number of files and rows, the sizes, the compression ratio and the throughput
+    """
+    if output_format not in FORMATS:
+        raise ValueError(f"Unknown format '{output_format}', expected one of {sorted(FORMATS)}")
+
+    mapping = column_mapping(table_name, json_paths)
+    tasks = []
+    for path, _ in list_objects(source):
+        key = relative_key(source, path)
+        name = key[:-len('.json')] if key.endswith('.json') else key
+        tasks.append((path, os.path.join(target, name + FORMATS[output_format]), mapping, output_format, batch_size))
+
+    report = {'files': 0, 'rows': 0, 'source_bytes': 0, 'target_bytes': 0}
+    start_time = time.perf_counter()
+    with Pool(workers) as pool:
+        for result in pool.imap_unordered(convert_file, tasks, chunksize=max(1, len(tasks) // 64)):
+            report['files'] += 1
+            for name in ['rows', 'source_bytes', 'target_bytes']:
+                report[name] += result[name]
+    seconds = time.perf_counter() - start_time
+
+    report.update({
+        'seconds': round(seconds, 3),
+        'compression_ratio': round(report['source_bytes'] / max(report['target_bytes'], 1), 2),
+        'rows_per_second': round(report['rows'] / max(seconds, 1e-9), 1),
+        'mb_per_second': round(report['source_bytes'] / 2 ** 20 / max(seconds, 1e-9), 2),
+    })
+    return report
+
+
+def copy_statement(table_name, output_format, uri):
+    """
+    COPY statement that loads the converted files
+    :param table_name: staging_events or staging_songs
+    :param output_format: csv or parquet
+    :param uri: S3 prefix the converted files are uploaded to
+    :return: COPY statement
+    """
+    return sql_queries.converted_copy_queries[output_format][table_name].bind(source=strip_quotes(uri))
+
+
+if __name__ == "__main__":
+    # Offline conversion: python convert.py <source_dir> <target_dir> <staging_events|staging_songs> [csv|parquet]
+    #                                       [json_paths]
+    source, target, table_name = sys.argv[1], sys.argv[2], sys.argv[3]
+    output_format = sys.argv[4] if len(sys.argv) > 4 else 'csv'
+    json_paths = sys.argv[5] if len(sys.argv) > 5 else None
+
+    report = convert_directory(source, target, table_name, output_format, json_paths)
+    print(f"\n Files converted: {report['files']} ({report['rows']} rows) in {report['seconds']:.3f} seconds"
+          f"\n Size: {report['source_bytes'] / 2 ** 20:.2f} MB -> {report['target_bytes'] / 2 ** 20:.2f} MB "
+          f"(compression ratio {report['compression_ratio']})"
+          f"\n Throughput: {report['rows_per_second']:.1f} rows/s, {report['mb_per_second']:.2f} MB/s"
+          f"\n COPY statement:{copy_statement(table_name, output_format, target)}")
@@ -1,6 +1,7 @@
-import configparser
-import psycopg2
+from pool import ConnectionPool
+from registry import load_config
 from sql_queries import create_table_queries, drop_table_queries
+from instrumentation import end_run, execute, start_run
 
 
 def drop_tables(cur, conn):
@@ -12,7 +13,7 @@ def drop_tables(cur, conn):
     :return: Not applicable
     """
     for query in drop_table_queries:
-        cur.execute(query)
+        execute(cur, query)
         conn.commit()
 
 
@@ -24,21 +25,22 @@ def create_tables(cur, conn):
     :return: Not applicable
     """
     for query in create_table_queries:
-        cur.execute(query)
+        execute(cur, query)
         conn.commit()
 
 
 def main():
-    config = configparser.ConfigParser()
-    config.read('dwh.cfg')
+    config = load_config()
 
-    conn = psycopg2.connect("host={} dbname={} user={} password={} port={}".format(*config['CLUSTER'].values()))
-    cur = conn.cursor()
+    start_run()
+    with ConnectionPool.from_config(config, max_size=1) as pool:
+        with pool.session() as conn:
+            cur = conn.cursor()
 
-    drop_tables(cur, conn)
-    create_tables(cur, conn)
+            drop_tables(cur, conn)
+            create_tables(cur, conn)
 
-    conn.close()
+    print(f"\n Run report: {end_run().write(config.get('ETL', 'REPORT_DIR', fallback='reports'))}")
 
 
 if __name__ == "__main__":
@@ -1,6 +1,10 @@
-import configparser
-import psycopg2
-from sql_queries import copy_table_queries, insert_table_queries
+import sql_queries
+from pool import ConnectionPool
+from registry import load_config
+from sql_queries import exact_count_select, insert_table_queries, pipeline_tables
+from scheduler import run_stages, print_stage_timings
+from export import export_tables
+from instrumentation import end_run, execute, start_run
 
 
 
@@ -13,8 +17,8 @@ def load_staging_tables(cur, conn):
     :param conn: The connection object for the database in the Redshift cluster
     :return: None
     """
-    for query in copy_table_queries:
-        cur.execute(query)
+    for query in sql_queries.copy_table_queries:
+        execute(cur, query)
         conn.commit()
 
 def insert_tables(cur, conn):
@@ -27,7 +31,7 @@ def insert_tables(cur, conn):
     :return: None
     """
     for query in insert_table_queries:
-        cur.execute(query)
+        execute(cur, query)
         conn.commit()
 
 def data_exists(cur):
@@ -37,29 +41,34 @@ def data_exists(cur):
     :param cur: The cursor object for the database in the Redshift cluster
     :return: A dictionary with the table names and the number of records in the table
     """
-    # Check if data is already loaded
-    tables = ['staging_events', 'staging_songs', 'songplays', 'users', 'songs', 'artists', 'times']
-    count_records = {}
+    # Count the records of all tables in a single round trip
+    execute(cur, exact_count_select(pipeline_tables))
+    count_records = {table: count for table, count in cur.fetchall()}
 
-    for table in tables:
-        cur.execute("SELECT COUNT(*) FROM {}".format(table))
-        result = cur.fetchone()
-        count_records[table] = result[0]
-
-    return count_records
+    return {table: count_records.get(table, 0) for table in pipeline_tables}
 
 def main():
-    config = configparser.ConfigParser()
-    config.read('dwh.cfg')
+    config = load_config()
 
     print(*config['CLUSTER'].values())
-    conn = psycopg2.connect("host={} dbname={} user={} password={} port={}".format(*config['CLUSTER'].values()))
-    cur = conn.cursor()
-    
-    load_staging_tables(cur, conn)
-    insert_tables(cur, conn)
+    workers = config.getint('ETL', 'WORKERS', fallback=4)
+
+    # Load the staging tables and insert the fact and dimension tables as a DAG of stages
+    start_run()
+    with ConnectionPool.from_config(config, max_size=workers) as pool:
+        timings = run_stages(pool, workers=workers)
+        print_stage_timings(timings)
+
+        # Unload the loaded tables for the downstream teams
+        if config.has_option('EXPORT', 'PREFIX'):
+            with pool.session() as conn:
+                exported = export_tables(conn.cursor(), conn, config.get('EXPORT', 'PREFIX'),
+                                         config.getboolean('EXPORT', 'INCREMENTAL', fallback=True),
+                                         config.getint('EXPORT', 'MAX_FILE_SIZE', fallback=256))
+            print(f"\n Exported: {exported}")
+        print(pool)
 
-    conn.close()
+    print(f"\n Run report: {end_run().write(config.get('ETL', 'REPORT_DIR', fallback='reports'))}")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,183 @@
+import json
+import re
+import sys
+from datetime import datetime, timezone
+
+from registry import Query
+from sources import join_uri, list_objects, read_text, strip_quotes, write_text
+import sql_queries
+from sql_queries import export_count_select, export_partition_counts_select, export_partition_select, \
+    export_partitioned_tables, export_partitioned_unload, export_selects, export_table_unload
+from instrumentation import execute
+
+# Written next to the exported tables, it lists the files and rows of every table and partition. A partition
+# exported again only replaces its own entry.
+EXPORT_MANIFEST = 'export_manifest.json'
+
+# Partition of an unloaded file, e.g. s3://bucket/export/songplays/year=2018/month=11/0000_part_00.parquet
+FILE_PARTITION = re.compile(r'/year=(\d+)/month=(\d+)/')
+
+
+def partition_key(year, month):
+    return f"{int(year):04d}/{int(month):02d}"
+
+
+def table_prefix(prefix, table, partition=None):
+    """
+    Prefix the files of a table or of one of its partitions are unloaded to
+    :param prefix: S3 uri or local directory of the export
+    :param table: Name of the table
+    :param partition: Partition key (YYYY/MM), None for the whole table
+    :return: Prefix ending with a slash
+    """
+    parts = [table]
+    if partition is not None:
+        year, month = partition.split('/')
+        parts += [f"year={int(year)}", f"month={int(month)}"]
+    return join_uri(strip_quotes(prefix), *parts) + '/'
+
+
+def unload_statement(table, prefix, partition=None, max_file_size=256):
+    """
+    UNLOAD statement of a table or of one of its partitions
+    :param table: Name of a table in sql_queries.export_selects
+    :param prefix: S3 uri or local directory of the export
+    :param partition: Partition key (YYYY/MM) of a partitioned table, None for the whole table
+    :param max_file_size: Maximum size of an unloaded file in MB
+    :return: Query
+    """
+    if partition is None:
+        template = export_partitioned_unload if table in export_partitioned_tables else export_table_unload
+        select = export_selects[table]
+    else:
+        template, select = export_table_unload, export_partition_select(table, *map(int, partition.split('/')))
+    return Query(template, sql_queries.copy_parameters(select=select, target=table_prefix(prefix, table, partition),
+                                                       max_file_size=max_file_size))
+
+
+def export_counts(cur):
+    """
+    Number of rows of every exported table, per partition for the partitioned tables
+    :param cur: Cursor to the Redshift cluster
+    :return: Dictionary with table name -> number of rows, or dictionary with partition key -> rows
+    """
+    counts = {}
+    for table, select in export_selects.items():
+        if table in export_partitioned_tables:
+            execute(cur, export_partition_counts_select.format(select), name=f"partitions {table}")
+            counts[table] = {partition_key(year, month): int(rows) for year, month, rows in cur.fetchall()}
+        else:
+            execute(cur, export_count_select.format(select), name=f"count {table}")
+            counts[table] = int(cur.fetchone()[0])
+    return counts
+
+
+def plan_export(previous, counts, incremental=True):
+    """
+    Decide what to unload. The dimensions are small and merged in place, they are exported whole every time. A
+    partitioned table only exports its new partitions and the partitions that got more rows since the previous
+    export, it is exported whole the first time, without incremental and when a partition disappeared (e.g. after a
+    full reload with other data).
+    :param previous: Export manifest of the previous export, None when there is none
+    :param counts: Dictionary returned by export_counts
+    :param incremental: Only export the changed partitions
+    :return: Dictionary with table name -> None to export the whole table, or the list of partition keys to export.
+    Tables without changes are left out.
+    """
+    plan = {}
+    for table in export_selects:
+        exported = (previous or {}).get('tables', {}).get(table)
+        if not incremental or table not in export_partitioned_tables or exported is None or \
+                set(exported['partitions']) - set(counts[table]):
+            plan[table] = None
+            continue
+
+        changed = [key for key, rows in sorted(counts[table].items())
+                   if exported['partitions'].get(key, {}).get('rows') != rows]
+        if changed:
+            plan[table] = changed
+    return plan
+
+
+def unloaded_files(uri, s3_client=None):
+    """
+    Files written by an UNLOAD, the prefix was emptied by CLEANPATH before
+    :param uri: Prefix returned by table_prefix
+    :param s3_client: Optional boto3 S3 client
+    :return: List of dictionaries with url and size
+    """
+    return [{'url': object_uri, 'size': size} for object_uri, size in list_objects(uri, s3_client)]
+
+
+def export_tables(cur, conn, prefix, incremental=True, max_file_size=256, s3_client=None):
+    """
+    Unload the fact and dimension tables as Parquet to an S3 prefix or a local directory, and update the export
+    manifest after every table, so a failed export keeps the tables it finished
+    :param cur: Cursor to the Redshift cluster
+    :param conn: Connection to the Redshift cluster
+    :param prefix: S3 uri or local directory of the export
+    :param incremental: Only export the new and changed partitions of the partitioned tables
+    :param max_file_size: Maximum size of an unloaded file in MB
+    :param s3_client: Optional boto3 S3 client, used for the listings and the export manifest
+    :return: Dictionary with table name -> 'all' or the list of exported partition keys
+    """
+    manifest_uri = join_uri(strip_quotes(prefix), EXPORT_MANIFEST)
+    previous = read_text(manifest_uri, s3_client)
+    manifest = json.loads(previous) if previous else {'tables': {}}
+
+    counts = export_counts(cur)
+    plan = plan_export(manifest if previous else None, counts, incremental)
+    exported = {}
+
+    for table, partitions in plan.items():
+        exported_at = datetime.now(timezone.utc).isoformat()
+        if partitions is None:
+            execute(cur, unload_statement(table, prefix, max_file_size=max_file_size), name=f"unload {table}")
+            conn.commit()
+            files = unloaded_files(table_prefix(prefix, table), s3_client)
+            if table in export_partitioned_tables:
+                entry = {'partitions': {key: {'rows': rows, 'exported_at': exported_at, 'files': []}
+                                        for key, rows in counts[table].items()}}
+                for item in files:
+                    match = FILE_PARTITION.search(item['url'].replace('\\', '/'))
+                    entry['partitions'][partition_key(*match.groups())]['files'].append(item)
+            else:
+                entry = {'rows': counts[table], 'exported_at': exported_at, 'files': files}
+            manifest['tables'][table] = entry
+            exported[table] = 'all'
+        else:
+            for key in partitions:
+                execute(cur, unload_statement(table, prefix, key, max_file_size), name=f"unload {table} {key}")
+                conn.commit()
+                manifest['tables'][table]['partitions'][key] = {
+                    'rows': counts[table][key], 'exported_at': exported_at,
+                    'files': unloaded_files(table_prefix(prefix, table, key), s3_client)}
+            exported[table] = partitions
+
+        manifest['updated_at'] = exported_at
+        write_text(manifest_uri, json.dumps(manifest, indent=1), s3_client)
+
+    return exported
+
+
+def print_export(manifest):
+    """
+    Print the exported tables with their rows, files and size
+    :param manifest: Export manifest
+    """
+    print("\n============ Export ============")
+    for table, entry in manifest['tables'].items():
+        parts = entry['partitions'].values() if 'partitions' in entry else [entry]
+        files = [item for part in parts for item in part['files']]
+        print(f" {table:<10} {sum(part['rows'] for part in parts):>10} rows {len(files):>6} files "
+              f"{sum(item['size'] for item in files) / 2 ** 20:10.2f} MB"
+              + (f" {len(entry['partitions'])} partitions" if 'partitions' in entry else ''))
+
+
+if __name__ == "__main__":
+    # python export.py <export_prefix>: print the export manifest of an S3 prefix or local directory
+    body = read_text(join_uri(strip_quotes(sys.argv[1]), EXPORT_MANIFEST))
+    if body is None:
+        print(f" No export manifest under {sys.argv[1]}")
+    else:
+        print_export(json.loads(body))
@@ -0,0 +1,105 @@
+import re
+
+import sql_queries
+from manifest import write_manifests
+from sources import list_objects, relative_key
+from sql_queries import control_table_queries, incremental_insert_table_queries, load_watermark_delete, \
+    load_watermark_insert, load_watermarks_select, staging_events_derived_insert, staging_events_truncate
+from instrumentation import execute
+
+# Log files are partitioned by year and month, e.g. 2018/11/2018-11-12-events.json
+LOG_PARTITION = re.compile(r'^(\d{4})/(\d{2})/')
+
+
+def list_log_files(log_data, s3_client=None):
+    """
+    List the log files per partition. A local directory with the same layout can be used instead of S3.
+    :param log_data: S3 uri or local directory with the log data
+    :param s3_client: Optional boto3 S3 client
+    :return: Dictionary with partition key (YYYY/MM) -> sorted list of (relative key, object uri, size in bytes)
+    """
+    partitions = {}
+    for object_uri, size in list_objects(log_data, s3_client):
+        key = relative_key(log_data, object_uri)
+        match = LOG_PARTITION.match(key)
+        if match is None:
+            continue
+        partition_key = f"{match.group(1)}/{match.group(2)}"
+        partitions.setdefault(partition_key, []).append((key, object_uri, size))
+
+    return {partition_key: sorted(files) for partition_key, files in partitions.items()}
+
+
+def get_watermarks(cur):
+    """
+    Get the watermark of every partition that has been loaded before
+    :param cur: Cursor to the Redshift cluster
+    :return: Dictionary with partition key -> relative key of the last loaded log file
+    """
+    execute(cur, load_watermarks_select)
+    return {partition_key: last_object for partition_key, last_object in cur.fetchall()}
+
+
+def new_log_files(partitions, watermarks):
+    """
+    Select the log files that are newer than the watermark of their partition. The log file names start with the
+    date, so the order of the keys is the order in which they arrived.
+    :param partitions: Dictionary returned by list_log_files
+    :param watermarks: Dictionary returned by get_watermarks
+    :return: Dictionary with partition key -> list of (relative key, object uri, size in bytes) that still have to be
+    loaded
+    """
+    new_files = {}
+    for partition_key, files in sorted(partitions.items()):
+        watermark = watermarks.get(partition_key)
+        files = [item for item in files if watermark is None or item[0] > watermark]
+        if files:
+            new_files[partition_key] = files
+
+    return new_files
+
+
+def load_incremental(cur, conn, log_data, manifest_prefix, s3_client=None):
+    """
+    Copy only the log files that are not loaded yet, merge the changed users and append the new rows to the times
+    and songplays tables. The new files are listed in a manifest and loaded with a single COPY, so all slices load
+    them in parallel. The inserts and the new watermarks are committed in one transaction after the COPY, so a failed
+    run is retried from the same watermarks.
+    :param cur: Cursor to the Redshift cluster
+    :param conn: Connection to the Redshift cluster
+    :param log_data: S3 uri or local directory with the log data
+    :param manifest_prefix: S3 uri or local directory the manifest of the new log files is written to
+    :param s3_client: Optional boto3 S3 client
+    :return: Dictionary with partition key -> number of log files loaded
+    """
+    if not manifest_prefix:
+        raise ValueError("The incremental load writes a manifest of the new log files, set MANIFEST_PREFIX in the "
+                         "[S3] section")
+
+    for query in control_table_queries:
+        execute(cur, query)
+    conn.commit()
+
+    new_files = new_log_files(list_log_files(log_data, s3_client), get_watermarks(cur))
+    if not new_files:
+        return {}
+
+    # Truncate commits in Redshift, staging_events only holds the new events afterwards
+    execute(cur, staging_events_truncate)
+    conn.commit()
+
+    batch = [(object_uri, size) for files in new_files.values() for _, object_uri, size in files]
+    manifest_uri = write_manifests([batch], manifest_prefix, 'staging_events', s3_client)[0]
+    execute(cur, sql_queries.staging_events_manifest_copy.bind(source=manifest_uri))
+    for query in staging_events_derived_insert:
+        execute(cur, query)
+
+    for query in incremental_insert_table_queries:
+        execute(cur, query)
+
+    for partition_key, files in new_files.items():
+        execute(cur, load_watermark_delete, (partition_key,))
+        execute(cur, load_watermark_insert, (partition_key, files[-1][0]))
+    conn.commit()
+
+    return {partition_key: len(files) for partition_key, files in new_files.items()}
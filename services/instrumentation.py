@@ -0,0 +1,260 @@
+import json
+import os
+import re
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+from registry import Query
+
+# First words of a statement -> short name, e.g. COPY staging_events ... -> copy staging_events
+STATEMENT_NAME = re.compile(r'^\s*(CREATE TABLE IF NOT EXISTS|CREATE TABLE|DROP TABLE IF EXISTS|DROP TABLE|COPY|'
+                            r'INSERT INTO|UPDATE|DELETE FROM|TRUNCATE|SELECT .*? FROM|CREATE MATERIALIZED VIEW|'
+                            r'REFRESH MATERIALIZED VIEW|DROP MATERIALIZED VIEW IF EXISTS)\s+(\w+)',
+                            re.IGNORECASE | re.DOTALL)
+STATEMENT_VERBS = {'CREATE': 'create', 'DROP': 'drop', 'COPY': 'copy', 'INSERT': 'insert', 'UPDATE': 'update',
+                   'DELETE': 'delete', 'TRUNCATE': 'truncate', 'SELECT': 'select', 'REFRESH': 'refresh'}
+# Queries of the session after a query id, in order. DDL and utility statements (e.g. TRUNCATE) are not logged in
+# STL_QUERY and keep no query id.
+QUERY_IDS_SELECT = "SELECT query, querytxt FROM stl_query WHERE pid = pg_backend_pid() AND query > %s ORDER BY query"
+
+
+def statement_name(query):
+    """
+    Short name of a statement for the run report
+    :param query: SQL statement or Query
+    :return: Name like 'copy staging_events' or 'insert songplays', the first words of the statement otherwise
+    """
+    if isinstance(query, Query):
+        query = query.sql
+    match = STATEMENT_NAME.match(query)
+    if match is None:
+        return ' '.join(query.split()[:2]).lower()
+    return f"{STATEMENT_VERBS[match.group(1).split()[0].upper()]} {match.group(2)}"
+
+
+class RunReport:
+    """
+    Record of every statement of a run: name, stage, wall time, rowcount and the Redshift query id
+    """
+
+    def __init__(self):
+        self.started_at = datetime.now(timezone.utc)
+        self.statements = []
+        self._start = time.perf_counter()
+        self._end = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        # Connection -> whether it is a Redshift connection and the last query id looked up. Weak keys, a closed
+        # connection is dropped with its entry and a new connection at the same address is probed again.
+        self._connections = weakref.WeakKeyDictionary()
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Attribute the statements executed in the with block (on this thread) to a stage. The Redshift query ids of
+        the statements are looked up once per connection when the block is done.
+        :param name: Name of the stage, e.g. drop, create or songplays
+        """
+        previous = getattr(self._local, 'stage', None), getattr(self._local, 'pending', None)
+        self._local.stage, self._local.pending = name, {}
+        try:
+            yield
+            # A failed stage keeps no query ids, its transaction refuses other statements until it is rolled back
+            self._resolve_query_ids(self._local.pending)
+        finally:
+            self._local.stage, self._local.pending = previous
+
+    def _connection_state(self, conn):
+        """
+        Check once per connection whether it is a Redshift connection, only Redshift has query ids. The last query
+        id of the session is read with it, the later lookups only return the queries after it.
+        :param conn: Connection to the database
+        :return: Dictionary with redshift and last_query
+        """
+        with self._lock:
+            state = self._connections.get(conn)
+        if state is None:
+            state = {'redshift': False, 'last_query': None}
+            try:
+                probe = conn.cursor()
+                probe.execute("SELECT version()")
+                if 'redshift' in str(probe.fetchone()[0]).lower():
+                    probe.execute("SELECT pg_last_query_id()")
+                    state = {'redshift': True, 'last_query': probe.fetchone()[0]}
+            except Exception:
+                # e.g. SQLite has no version() function
+                pass
+            with self._lock:
+                self._connections[conn] = state
+        return state
+
+    def _resolve_query_ids(self, pending):
+        """
+        Look up the query ids of the recorded statements, one STL_QUERY lookup per connection. The logged queries are
+        matched to the statements in order on their statement name.
+        :param pending: Dictionary with connection -> list of (statement record, statement name)
+        """
+        for conn, records in pending.items():
+            state = self._connection_state(conn)
+            cur = conn.cursor()
+            cur.execute(QUERY_IDS_SELECT, (state['last_query'],))
+            rows = cur.fetchall()
+
+            position = 0
+            with self._lock:
+                for record, name in records:
+                    for index in range(position, len(rows)):
+                        if statement_name(rows[index][1]) == name:
+                            record['query_id'] = rows[index][0]
+                            position = index + 1
+                            break
+                if rows:
+                    state['last_query'] = rows[-1][0]
+
+    def execute(self, cur, query, params=None, name=None):
+        """
+        Execute a statement and record it
+        :param cur: Cursor to the database
+        :param query: SQL statement
+        :param params: Parameters of the statement
+        :param name: Name in the report, derived from the statement when not given
+        :return: Not applicable
+        """
+        conn = getattr(cur, 'connection', None)
+        redshift = conn is not None and self._connection_state(conn)['redshift']
+        start = time.perf_counter()
+        cur.execute(query, params)
+        end = time.perf_counter()
+
+        record = {
+            'name': name or statement_name(query),
+            'stage': getattr(self._local, 'stage', None),
+            'start': round(start - self._start, 6),
+            'seconds': round(end - start, 6),
+            'rowcount': cur.rowcount,
+            'query_id': None,
+        }
+        with self._lock:
+            self.statements.append(record)
+
+        if redshift:
+            pending = getattr(self._local, 'pending', None)
+            if pending is None:
+                # Outside a stage the query id is looked up right away
+                self._resolve_query_ids({conn: [(record, statement_name(query))]})
+            else:
+                pending.setdefault(conn, []).append((record, statement_name(query)))
+
+    def finish(self):
+        """
+        Stop the clock of the run
+        """
+        self._end = time.perf_counter()
+
+    def to_dict(self):
+        """
+        Machine-readable report with the per statement, per stage and total timings
+        :return: Dictionary that can be written as JSON
+        """
+        end = self._end if self._end is not None else time.perf_counter()
+        stages = {}
+        for statement in self.statements:
+            stage = stages.setdefault(statement['stage'] or 'other', {'seconds': 0.0, 'statements': 0})
+            stage['seconds'] = round(stage['seconds'] + statement['seconds'], 6)
+            stage['statements'] += 1
+
+        return {
+            'started_at': self.started_at.isoformat(),
+            'total_seconds': round(end - self._start, 6),
+            'stages': stages,
+            'statements': list(self.statements),
+        }
+
+    def write(self, report_dir):
+        """
+        Write the report as JSON, one file per run
+        :param report_dir: Directory of the run reports
+        :return: Path of the report
+        """
+        os.makedirs(report_dir, exist_ok=True)
+        path = os.path.join(report_dir, f"run-{self.started_at.strftime('%Y%m%dT%H%M%S')}.json")
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+        return path
+
+
+# The report of the current run. Statements are only recorded while a run is active.
+active_report = None
+
+
+def start_run():
+    """
+    Start recording the statements of a run
+    :return: RunReport of the run
+    """
+    global active_report
+    active_report = RunReport()
+    return active_report
+
+
+def end_run():
+    """
+    Stop recording the statements of the run
+    :return: RunReport of the run, None when no run was active
+    """
+    global active_report
+    report, active_report = active_report, None
+    if report is not None:
+        report.finish()
+    return report
+
+
+def execute(cur, query, params=None, name=None):
+    """
+    Execute a statement, recorded in the report of the active run
+    :param cur: Cursor to the database
+    :param query: SQL statement or Query with its bound parameters
+    :param params: Parameters of the statement, the bound parameters of a Query when not given
+    :param name: Name in the report, derived from the statement when not given
+    :return: Not applicable
+    """
+    if isinstance(query, Query):
+        query, params = query.sql, query.params if params is None else params
+    if active_report is None:
+        cur.execute(query, params)
+    else:
+        active_report.execute(cur, query, params, name)
+
+
+def execute_prepared(cur, prepared, name, query, params=None):
+    """
+    Execute a statement that runs often as a prepared statement. The statement is parsed and planned once per
+    connection, afterwards only EXECUTE is sent.
+    :param cur: Cursor to the database
+    :param prepared: Set with the names of the statements prepared on the connection of the cursor
+    :param name: Name of the prepared statement
+    :param query: SQL statement without parameters
+    :param params: Values for the $1, $2, ... placeholders of the statement
+    :return: Not applicable
+    """
+    if name not in prepared:
+        execute(cur, f"PREPARE {name} AS {query}", name=f"prepare {name}")
+        prepared.add(name)
+    arguments = f" ({', '.join(['%s'] * len(params))})" if params else ''
+    execute(cur, f"EXECUTE {name}{arguments}", params or None, name=f"execute {name}")
+
+
+@contextmanager
+def stage(name):
+    """
+    Attribute the statements in the with block to a stage of the active run
+    :param name: Name of the stage
+    """
+    if active_report is None:
+        yield
+    else:
+        with active_report.stage(name):
+            yield
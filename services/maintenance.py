@@ -0,0 +1,149 @@
+import json
+import sys
+import threading
+import time
+
+from async_scheduler import cancel_statement
+from instrumentation import execute, stage
+from stats import parse_table_info
+
+# Relative cost of an action per MB of the table: ANALYZE PREDICATE COLUMNS samples the columns used in filters and
+# joins, a VACUUM rewrites the unsorted or deleted part of the table, VACUUM FULL does both in one pass.
+ACTION_COST = {'analyze': 0.05, 'vacuum_sort': 1.0, 'vacuum_delete': 1.0, 'vacuum_full': 1.5}
+ACTION_STATEMENTS = {
+    'analyze': "ANALYZE {} PREDICATE COLUMNS",
+    'vacuum_sort': "VACUUM SORT ONLY {}",
+    'vacuum_delete': "VACUUM DELETE ONLY {}",
+    'vacuum_full': "VACUUM FULL {}",
+}
+
+
+class Thresholds:
+    """
+    Health limits of a table, a table over a limit gets the cheapest action that brings it back under the limit
+    """
+
+    def __init__(self, stats_off=10.0, unsorted=20.0, deleted=10.0, min_rows=1000, mb_per_second=50.0):
+        """
+        Initialize the thresholds
+        :param stats_off: Percentage of stale statistics from which the table is analyzed
+        :param unsorted: Percentage of unsorted rows from which the table is sorted
+        :param deleted: Percentage of rows marked as deleted from which the space is reclaimed
+        :param min_rows: Smaller tables are left alone, scanning them is cheap anyway
+        :param mb_per_second: Throughput used to estimate how long an action takes
+        """
+        self.stats_off = stats_off
+        self.unsorted = unsorted
+        self.deleted = deleted
+        self.min_rows = min_rows
+        self.mb_per_second = mb_per_second
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Thresholds from the [MAINTENANCE] section of the dwh.cfg file, the defaults for the missing options
+        :param config: ConfigParser with the dwh.cfg file loaded
+        :return: Thresholds
+        """
+        defaults = cls()
+        options = {name: config.getfloat('MAINTENANCE', name.upper(), fallback=getattr(defaults, name))
+                   for name in ['stats_off', 'unsorted', 'deleted', 'mb_per_second']}
+        return cls(min_rows=config.getint('MAINTENANCE', 'MIN_ROWS', fallback=defaults.min_rows), **options)
+
+
+def plan_maintenance(details, thresholds=None):
+    """
+    Pick the actions for the tables over a threshold. Statistics are cheap to refresh and drive every plan, so the
+    ANALYZE actions come first, the VACUUM actions follow with the table that is in the worst shape first.
+    :param details: Dictionary returned by TableStats.details or parse_table_info
+    :param thresholds: Thresholds, the defaults when not given
+    :return: List of dictionaries with table, action, statement, reason and estimated_seconds
+    """
+    thresholds = thresholds or Thresholds()
+    analyzes, vacuums = [], []
+    for table, detail in sorted(details.items()):
+        if detail['rows'] < thresholds.min_rows:
+            continue
+
+        def action(name, reason, share=1.0, severity=0.0):
+            seconds = ACTION_COST[name] * detail['size_mb'] * share / thresholds.mb_per_second
+            return {'table': table, 'action': name, 'statement': ACTION_STATEMENTS[name].format(table),
+                    'reason': reason, 'estimated_seconds': round(seconds, 2), 'severity': severity}
+
+        # Missing statistics (stats_off is NULL) count as stale
+        stats_off = 100.0 if detail['stats_off'] is None else detail['stats_off']
+        if stats_off >= thresholds.stats_off:
+            reason = 'no statistics' if detail['stats_off'] is None else f"stats_off {stats_off:.1f}%"
+            analyzes.append(action('analyze', reason, severity=stats_off))
+
+        unsorted = detail['unsorted'] or 0.0
+        deleted = detail.get('deleted') or 0.0
+        needs_sort, needs_delete = unsorted >= thresholds.unsorted, deleted >= thresholds.deleted
+        if needs_sort and needs_delete:
+            vacuums.append(action('vacuum_full', f"unsorted {unsorted:.1f}%, deleted {deleted:.1f}%",
+                                  min((unsorted + deleted) / 100, 1.0), unsorted + deleted))
+        elif needs_sort:
+            vacuums.append(action('vacuum_sort', f"unsorted {unsorted:.1f}%", unsorted / 100, unsorted))
+        elif needs_delete:
+            vacuums.append(action('vacuum_delete', f"deleted {deleted:.1f}%", deleted / 100, deleted))
+
+    return (sorted(analyzes, key=lambda item: -item['severity']) +
+            sorted(vacuums, key=lambda item: -item['severity']))
+
+
+def run_maintenance(pool, actions, budget=600.0):
+    """
+    Run the actions one after the other within a time budget. An action that is not expected to finish in the
+    remaining time is skipped, a cheaper one after it may still fit. A statement still running when the budget is used
+    up is cancelled, a cancelled VACUUM keeps the part it has sorted.
+    :param pool: Connection pool to the Redshift cluster
+    :param actions: List returned by plan_maintenance
+    :param budget: Number of seconds the maintenance may take
+    :return: List of the actions with their status (done, skipped, cancelled or failed) and seconds
+    """
+    results = []
+    start = time.perf_counter()
+    # VACUUM cannot run inside a transaction block
+    with pool.autocommit_session() as conn, stage('maintenance'):
+        cur = conn.cursor()
+        for action in actions:
+            remaining = budget - (time.perf_counter() - start)
+            if action['estimated_seconds'] > remaining:
+                results.append({**action, 'status': 'skipped', 'seconds': 0.0})
+                continue
+
+            timer = threading.Timer(remaining, cancel_statement, [conn])
+            timer.start()
+            action_start = time.perf_counter()
+            try:
+                execute(cur, action['statement'], name=f"{action['action']} {action['table']}")
+                status = 'done'
+            except Exception:
+                status = 'cancelled' if time.perf_counter() - start >= budget else 'failed'
+            finally:
+                timer.cancel()
+            results.append({**action, 'status': status, 'seconds': round(time.perf_counter() - action_start, 3)})
+
+    return results
+
+
+def print_maintenance(results):
+    """
+    Print the actions and their status
+    :param results: List returned by run_maintenance, or the plan returned by plan_maintenance
+    """
+    print("\n============ Maintenance ============")
+    if not results:
+        print(" All tables are within the thresholds")
+    for result in results:
+        status = result.get('status', 'planned')
+        print(f" {result['table']:<16} {result['action']:<14} {status:<10} {result['reason']}"
+              f" (~{result['estimated_seconds']:.1f}s)")
+
+
+if __name__ == "__main__":
+    # python maintenance.py <catalog.json>: the actions for recorded SVV_TABLE_INFO rows, as a list of
+    # [table, estimated_visible_rows, size, unsorted, stats_off, tbl_rows], without a cluster
+    with open(sys.argv[1]) as f:
+        rows = json.load(f)
+    print_maintenance(plan_maintenance(parse_table_info(rows, [row[0] for row in rows])))
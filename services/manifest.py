@@ -0,0 +1,134 @@
+import json
+import sys
+import time
+
+from sources import join_uri, list_objects, strip_quotes, write_text
+import sql_queries
+
+# Number of slices per node for every Redshift node type. COPY loads one file per slice at a time.
+SLICES_PER_NODE = {
+    'dc2.large': 2,
+    'dc2.8xlarge': 16,
+    'ds2.xlarge': 2,
+    'ds2.8xlarge': 16,
+    'ra3.xlplus': 2,
+    'ra3.4xlarge': 4,
+    'ra3.16xlarge': 16,
+}
+
+
+def cluster_slices(node_type, num_nodes):
+    """
+    Number of slices of the cluster
+    :param node_type: Node type of the cluster, e.g. dc2.large
+    :param num_nodes: Number of nodes of the cluster
+    :return: Total number of slices
+    """
+    if node_type not in SLICES_PER_NODE:
+        raise ValueError(f"Unknown node type '{node_type}', expected one of {sorted(SLICES_PER_NODE)}")
+    return SLICES_PER_NODE[node_type] * num_nodes
+
+
+def batch_objects(objects, slices, files_per_slice=1000):
+    """
+    Group the objects into batches of at most slices * files_per_slice files, so every slice of the cluster gets
+    work in every COPY. The number of files per batch is rounded up to a multiple of the slices, only the last batch
+    holds fewer, so no slice waits for the others within a COPY. The files are dealt over the batches from large to
+    small, so the batches hold about the same number of bytes.
+    :param objects: List of (object uri, size in bytes)
+    :param slices: Number of slices of the cluster
+    :param files_per_slice: Number of files per slice in one batch
+    :return: List of batches, every batch is a list of (object uri, size in bytes)
+    """
+    if slices < 1 or files_per_slice < 1:
+        raise ValueError("slices and files_per_slice have to be at least 1")
+
+    if not objects:
+        return []
+
+    ordered = sorted(objects, key=lambda item: item[1], reverse=True)
+    batch_count = -(-len(ordered) // (slices * files_per_slice))
+    # An even share of the files per batch, rounded up to a multiple of the slices
+    batch_size = slices * -(-len(ordered) // (batch_count * slices))
+    batch_count = -(-len(ordered) // batch_size)
+    capacities = [batch_size] * (batch_count - 1) + [len(ordered) - batch_size * (batch_count - 1)]
+
+    # Deal the files round robin over the batches that are not full yet, so the batches hold about the same bytes
+    batches = [[] for _ in range(batch_count)]
+    index = 0
+    for item in ordered:
+        while len(batches[index % batch_count]) == capacities[index % batch_count]:
+            index += 1
+        batches[index % batch_count].append(item)
+        index += 1
+
+    return [sorted(batch) for batch in batches if batch]
+
+
+def manifest_entries(batch):
+    """
+    Build the content of a COPY manifest
+    :param batch: List of (object uri, size in bytes)
+    :return: Dictionary with the manifest entries
+    """
+    return {'entries': [{'url': object_uri, 'mandatory': True, 'meta': {'content_length': size}}
+                        for object_uri, size in batch]}
+
+
+def write_manifests(batches, manifest_prefix, name, s3_client=None):
+    """
+    Write one manifest per batch. A local directory can be used instead of an S3 prefix.
+    :param batches: List of batches returned by batch_objects
+    :param manifest_prefix: S3 uri or local directory the manifests are written to
+    :param name: Name used in the manifest file names, e.g. staging_songs
+    :param s3_client: Optional boto3 S3 client, only used for S3 uris
+    :return: List with the uri of every manifest
+    """
+    manifest_prefix = strip_quotes(manifest_prefix)
+    manifests = []
+
+    for index, batch in enumerate(batches):
+        manifest_uri = join_uri(manifest_prefix, f"{name}-{index:04d}.manifest")
+        if manifest_uri.startswith('s3://') and s3_client is None:
+            # One client for all manifests of the run
+            import boto3
+            s3_client = boto3.client('s3', region_name="us-west-2")
+        write_text(manifest_uri, json.dumps(manifest_entries(batch), indent=1), s3_client)
+        manifests.append(manifest_uri)
+
+    return manifests
+
+
+def prepare_song_manifests(song_data, manifest_prefix, node_type, num_nodes, files_per_slice=1000, s3_client=None):
+    """
+    List the song files, split them in batches for the slices of the cluster and write the manifests.
+    :param song_data: S3 uri or local directory with the song data
+    :param manifest_prefix: S3 uri or local directory the manifests are written to
+    :param node_type: Node type of the cluster
+    :param num_nodes: Number of nodes of the cluster
+    :param files_per_slice: Number of files per slice in one batch
+    :param s3_client: Optional boto3 S3 client
+    :return: List of COPY statements, one per manifest
+    """
+    objects = list_objects(song_data, s3_client)
+    batches = batch_objects(objects, cluster_slices(node_type, num_nodes), files_per_slice)
+    manifests = write_manifests(batches, manifest_prefix, 'staging_songs', s3_client)
+
+    return [sql_queries.staging_songs_manifest_copy.bind(source=manifest_uri) for manifest_uri in manifests]
+
+
+if __name__ == "__main__":
+    # Offline benchmark of the listing and batching: python manifest.py <song_data_dir> <manifest_dir> [<slices>]
+    song_data, manifest_prefix = sys.argv[1], sys.argv[2]
+    slices = int(sys.argv[3]) if len(sys.argv) > 3 else cluster_slices('dc2.large', 4)
+
+    start_time = time.perf_counter()
+    objects = list_objects(song_data)
+    listed_time = time.perf_counter()
+    batches = batch_objects(objects, slices, files_per_slice=100)
+    write_manifests(batches, manifest_prefix, 'staging_songs')
+    end_time = time.perf_counter()
+
+    print(f"\n Files listed: {len(objects)} in {listed_time - start_time:.3f} seconds"
+          f"\n Manifests written: {len(batches)} in {end_time - listed_time:.3f} seconds"
+          f"\n Files per manifest: {[len(batch) for batch in batches]}")
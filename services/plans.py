@@ -0,0 +1,245 @@
+import json
+import os
+import re
+import sys
+from datetime import datetime, timezone
+
+from sql_queries import analytic_queries, insert_table_queries
+from instrumentation import execute, statement_name
+
+# Plan step, e.g. "  ->  XN Hash Join DS_BCAST_INNER  (cost=0.00..1234.56 rows=100 width=64)"
+PLAN_STEP = re.compile(r'^(?P<indent>\s*)(?:->\s*)?(?P<operation>.+?)(?:\s+(?P<distribution>DS_[A-Z_]+))?'
+                       r'\s+\(cost=(?P<startup_cost>[\d.]+)\.\.(?P<total_cost>[\d.]+)\s+rows=(?P<rows>\d+)'
+                       r'\s+width=(?P<width>\d+)\)')
+
+# How much data a join step moves between the nodes. DS_DIST_NONE and DS_DIST_ALL_NONE are collocated.
+DISTRIBUTION_SEVERITY = {
+    'DS_DIST_NONE': 0,
+    'DS_DIST_ALL_NONE': 0,
+    'DS_DIST_INNER': 1,
+    'DS_DIST_OUTER': 1,
+    'DS_DIST_ALL_INNER': 2,
+    'DS_BCAST_INNER': 2,
+    'DS_DIST_BOTH': 3,
+}
+NESTED_LOOP_SEVERITY = 3
+
+
+class PlanStep:
+    """
+    Step of a query plan with its distribution, estimated cost and rows, and the steps it reads from
+    """
+
+    def __init__(self, operation, distribution=None, startup_cost=0.0, total_cost=0.0, rows=0, width=0, depth=0):
+        self.operation = operation
+        self.distribution = distribution
+        self.startup_cost = startup_cost
+        self.total_cost = total_cost
+        self.rows = rows
+        self.width = width
+        self.depth = depth
+        self.details = []
+        self.children = []
+
+    def walk(self):
+        """
+        This step and all steps below it, depth first
+        """
+        yield self
+        for child in self.children:
+            yield from child.walk()
+
+    def flags(self):
+        """
+        Reasons this step is expensive: data broadcast or redistributed between the nodes, or a nested loop join
+        :return: List of (flag, severity)
+        """
+        flags = []
+        severity = DISTRIBUTION_SEVERITY.get(self.distribution, 0)
+        if severity:
+            flags.append((f"{self.operation} {self.distribution}", severity))
+        if 'nested loop' in self.operation.lower():
+            flags.append((self.operation, NESTED_LOOP_SEVERITY))
+        return flags
+
+    def __repr__(self):
+        distribution = f" {self.distribution}" if self.distribution else ''
+        return f"{' ' * self.depth}{self.operation}{distribution} (cost={self.total_cost} rows={self.rows})"
+
+
+def parse_plan(text):
+    """
+    Parse the text returned by EXPLAIN into a tree of steps. Lines without a cost, e.g. Hash Cond or Filter, are kept
+    as details of the step above them.
+    :param text: EXPLAIN output, one plan line per line
+    :return: Root PlanStep, None when the text has no plan steps
+    """
+    root = None
+    stack = []
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        match = PLAN_STEP.match(line)
+        if match is None:
+            if stack:
+                stack[-1].details.append(line.strip())
+            continue
+
+        depth = len(match.group('indent'))
+        step = PlanStep(match.group('operation').strip(), match.group('distribution'),
+                        float(match.group('startup_cost')), float(match.group('total_cost')),
+                        int(match.group('rows')), int(match.group('width')), depth)
+        while stack and stack[-1].depth >= depth:
+            stack.pop()
+        if stack:
+            stack[-1].children.append(step)
+        elif root is None:
+            root = step
+        stack.append(step)
+
+    return root
+
+
+def summarize_plan(root):
+    """
+    Summary of a plan used for the snapshots: the distribution of every join, the flagged steps and a score
+    :param root: Root PlanStep returned by parse_plan
+    :return: Dictionary with distributions, flags, score and total cost
+    """
+    if root is None:
+        return {'distributions': [], 'flags': [], 'score': 0, 'total_cost': 0.0}
+
+    steps = list(root.walk())
+    flags = [flag for step in steps for flag in step.flags()]
+    return {
+        'distributions': [f"{step.operation} {step.distribution}" for step in steps if step.distribution],
+        'flags': sorted(flag for flag, _ in flags),
+        'score': sum(severity for _, severity in flags),
+        'total_cost': root.total_cost,
+    }
+
+
+def compare_plans(summary, snapshot):
+    """
+    Compare the summary of a plan with its snapshot
+    :param summary: Summary returned by summarize_plan
+    :param snapshot: Summary of the same query stored earlier
+    :return: List of regressions, empty when the plan is as good as the snapshot
+    """
+    regressions = []
+    remaining = list(snapshot['flags'])
+    for flag in summary['flags']:
+        if flag in remaining:
+            remaining.remove(flag)
+        else:
+            regressions.append(f"new step {flag}")
+    if summary['score'] > snapshot['score']:
+        regressions.append(f"score {snapshot['score']} -> {summary['score']}")
+    return regressions
+
+
+def plan_queries():
+    """
+    Queries of which the plan is checked: the insert statements and the analytic queries
+    :return: Dictionary with name -> query
+    """
+    queries = {statement_name(query).replace(' ', '_'): query for query in insert_table_queries}
+    queries.update(analytic_queries)
+    return queries
+
+
+def explain(cur, query):
+    """
+    Run EXPLAIN for a query
+    :param cur: Cursor to the Redshift cluster
+    :param query: SQL statement
+    :return: Plan text
+    """
+    execute(cur, "EXPLAIN " + query, name=f"explain {statement_name(query)}")
+    return '\n'.join(row[0] for row in cur.fetchall())
+
+
+def snapshot_path(snapshot_dir, name):
+    return os.path.join(snapshot_dir, f"{name}.json")
+
+
+def write_snapshot(snapshot_dir, name, plan, summary):
+    os.makedirs(snapshot_dir, exist_ok=True)
+    with open(snapshot_path(snapshot_dir, name), 'w') as f:
+        json.dump({'name': name, 'captured_at': datetime.now(timezone.utc).isoformat(), 'summary': summary,
+                   'plan': plan}, f, indent=2)
+
+
+def check_plans(plans, snapshot_dir, update=False):
+    """
+    Check the plans against their snapshots. A plan without a snapshot is stored as the first snapshot.
+    :param plans: Dictionary with name -> EXPLAIN text
+    :param snapshot_dir: Directory with one snapshot per query
+    :param update: Store the plans as the new snapshots, also when they got worse
+    :return: Dictionary with name -> dictionary with the summary and the regressions
+    """
+    results = {}
+    for name, plan in plans.items():
+        summary = summarize_plan(parse_plan(plan))
+        path = snapshot_path(snapshot_dir, name)
+        regressions = []
+        if os.path.exists(path) and not update:
+            with open(path) as f:
+                regressions = compare_plans(summary, json.load(f)['summary'])
+        else:
+            write_snapshot(snapshot_dir, name, plan, summary)
+        results[name] = {'summary': summary, 'regressions': regressions}
+
+    return results
+
+
+def capture_plans(cur, queries=None):
+    """
+    Run EXPLAIN for every query
+    :param cur: Cursor to the Redshift cluster
+    :param queries: Dictionary with name -> query, the insert and analytic queries when not given
+    :return: Dictionary with name -> EXPLAIN text
+    """
+    return {name: explain(cur, query) for name, query in (queries or plan_queries()).items()}
+
+
+def print_plan_results(results):
+    """
+    Print the flagged steps and regressions per query
+    :param results: Dictionary returned by check_plans
+    :return: Number of queries of which the plan got worse
+    """
+    print("\n============ Query plans ============")
+    regressed = 0
+    for name, result in results.items():
+        summary = result['summary']
+        status = 'REGRESSED' if result['regressions'] else 'ok'
+        print(f" {name:<22} score {summary['score']:>3}  {status}")
+        for flag in summary['flags']:
+            print(f"     flagged: {flag}")
+        for regression in result['regressions']:
+            print(f"     regression: {regression}")
+        regressed += bool(result['regressions'])
+    return regressed
+
+
+if __name__ == "__main__":
+    # python plans.py check|update <snapshot_dir> [<explain_dir>]
+    # The plans are taken from the cluster in dwh.cfg, or offline from recorded <name>.txt files in explain_dir
+    command, snapshot_dir = sys.argv[1], sys.argv[2]
+    if len(sys.argv) > 3:
+        explain_dir = sys.argv[3]
+        plans = {}
+        for file_name in sorted(os.listdir(explain_dir)):
+            if file_name.endswith('.txt'):
+                with open(os.path.join(explain_dir, file_name)) as f:
+                    plans[file_name[:-len('.txt')]] = f.read()
+    else:
+        from pool import ConnectionPool
+        from registry import load_config
+
+        with ConnectionPool.from_config(load_config(), max_size=1) as pool, pool.session() as conn:
+            plans = capture_plans(conn.cursor())
+
+    if print_plan_results(check_plans(plans, snapshot_dir, update=command == 'update')):
+        sys.exit(1)
@@ -0,0 +1,246 @@
+import threading
+import time
+from contextlib import contextmanager
+
+
+class ConnectionPool:
+    """
+    Pool of connections to the Redshift cluster. Connections are opened lazily up to max_size and reused by the
+    stages of the pipeline, so a run only pays for the handshakes it really needs.
+    """
+
+    def __init__(self, connect, max_size=5, health_check=True, check_idle_after=30.0, clock=time.monotonic):
+        """
+        Initialize the connection pool
+        :param connect: Callable returning a new DB-API connection
+        :param max_size: Maximum number of connections open at the same time
+        :param health_check: Run a SELECT 1 on an idle connection before it is handed out again
+        :param check_idle_after: Only connections idle for at least this many seconds are checked, a connection
+        released a moment ago is handed out without a round trip
+        :param clock: Function returning the current time in seconds, replaced in tests
+        """
+        if max_size < 1:
+            raise ValueError("The connection pool needs a max_size of at least 1")
+
+        self.connect = connect
+        self.max_size = max_size
+        self.health_check = health_check
+        self.check_idle_after = check_idle_after
+        self.clock = clock
+
+        self.opened = 0
+        self.reused = 0
+        self.discarded = 0
+
+        # Tuples of (connection, time it was released)
+        self._idle = []
+        self._prepared = {}
+        self._in_use = 0
+        self._closed = False
+        self._condition = threading.Condition()
+
+    @classmethod
+    def from_props(cls, props, max_size=5):
+        """
+        Create a connection pool for the Redshift cluster properties used by the orchestrator
+        :param props: List with host, database name, user, password and port
+        :param max_size: Maximum number of connections open at the same time
+        :return: ConnectionPool
+        """
+        # Imported here so the pool can be used with other drivers (e.g. the local benchmarks) without psycopg2
+        import psycopg2
+
+        def connect():
+            return psycopg2.connect("host={} dbname={} user={} password={} port={}".format(*props))
+
+        return cls(connect, max_size=max_size)
+
+    @classmethod
+    def from_config(cls, config, max_size=5):
+        """
+        Create a connection pool from the CLUSTER section of the dwh.cfg file
+        :param config: ConfigParser with the dwh.cfg file loaded
+        :param max_size: Maximum number of connections open at the same time
+        :return: ConnectionPool
+        """
+        props = [config.get('CLUSTER', key) for key in ['HOST', 'DB_NAME', 'DB_USER', 'DB_PASSWORD', 'DB_PORT']]
+        return cls.from_props(props, max_size=max_size)
+
+    def _is_healthy(self, conn, released_at):
+        """
+        Check if an idle connection can still be used. Runs without the lock of the pool, the SELECT 1 is a round
+        trip to the cluster.
+        :param conn: Connection taken from the idle list
+        :param released_at: Time the connection was released
+        :return: True if the connection can be handed out
+        """
+        if getattr(conn, 'closed', 0):
+            return False
+        if not self.health_check or self.clock() - released_at < self.check_idle_after:
+            return True
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1")
+            cur.fetchone()
+            conn.rollback()
+        except Exception:
+            return False
+        return True
+
+    def _discard(self, conn):
+        with self._condition:
+            self.discarded += 1
+            self._prepared.pop(id(conn), None)
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def acquire(self, timeout=None):
+        """
+        Borrow a connection from the pool. Idle connections are reused, a new one is opened while the pool is below
+        max_size and otherwise the call waits until a connection is released.
+        :param timeout: Maximum number of seconds to wait for a connection, None waits forever
+        :return: Connection to the Redshift cluster
+        """
+        while True:
+            conn = None
+            with self._condition:
+                while True:
+                    if self._closed:
+                        raise RuntimeError("The connection pool is closed")
+
+                    # Reserve the slot of an idle connection or of a new one, the health check and the handshake
+                    # are done outside of the lock
+                    if self._idle:
+                        conn, released_at = self._idle.pop()
+                        self._in_use += 1
+                        break
+
+                    if self._in_use < self.max_size:
+                        self._in_use += 1
+                        break
+
+                    if not self._condition.wait(timeout):
+                        raise TimeoutError(f"No connection available within {timeout} seconds")
+
+            if conn is None:
+                break
+            if self._is_healthy(conn, released_at):
+                with self._condition:
+                    self.reused += 1
+                return conn
+
+            # Give the slot back and try the next idle connection, or open a new one
+            self._discard(conn)
+            with self._condition:
+                self._in_use -= 1
+                self._condition.notify()
+
+        try:
+            conn = self.connect()
+        except Exception:
+            with self._condition:
+                self._in_use -= 1
+                self._condition.notify()
+            raise
+
+        with self._condition:
+            self.opened += 1
+        return conn
+
+    def release(self, conn):
+        """
+        Return a borrowed connection to the pool. An open transaction is rolled back first.
+        :param conn: Connection returned by acquire
+        :return: Not applicable
+        """
+        # The rollback is a round trip, it runs before the connection is handed back under the lock
+        try:
+            conn.rollback()
+            healthy = not getattr(conn, 'closed', 0)
+        except Exception:
+            healthy = False
+
+        with self._condition:
+            self._in_use -= 1
+            keep = healthy and not self._closed
+            if keep:
+                self._idle.append((conn, self.clock()))
+            self._condition.notify()
+
+        if not keep:
+            self._discard(conn)
+
+    @contextmanager
+    def session(self):
+        """
+        Borrow a connection for the duration of a with block
+        :return: Connection to the Redshift cluster
+        """
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    @contextmanager
+    def autocommit_session(self):
+        """
+        Borrow a connection in autocommit mode for a with block, for statements that cannot run inside a transaction
+        block such as VACUUM. The transaction opened by the health check is rolled back first.
+        :return: Connection to the Redshift cluster
+        """
+        with self.session() as conn:
+            conn.rollback()
+            autocommit = getattr(conn, 'autocommit', False)
+            conn.autocommit = True
+            try:
+                yield conn
+            finally:
+                conn.autocommit = autocommit
+
+    def close(self):
+        """
+        Close all idle connections. Connections still in use are closed when they are released.
+        :return: Not applicable
+        """
+        with self._condition:
+            self._closed = True
+            while self._idle:
+                conn, _ = self._idle.pop()
+                self._prepared.pop(id(conn), None)
+                conn.close()
+            self._condition.notify_all()
+
+    def prepared(self, conn):
+        """
+        Names of the statements prepared on a connection. Prepared statements live as long as the connection, the
+        names are forgotten when the connection is discarded.
+        :param conn: Connection borrowed from the pool
+        :return: Set with the names, updated by execute_prepared
+        """
+        with self._condition:
+            return self._prepared.setdefault(id(conn), set())
+
+    def stats(self):
+        """
+        Counters of the pool, used to confirm how many handshakes were saved by reusing connections
+        :return: Dictionary with the number of connections opened, reused, discarded, idle and in use
+        """
+        with self._condition:
+            return {'opened': self.opened, 'reused': self.reused, 'discarded': self.discarded,
+                    'idle': len(self._idle), 'in_use': self._in_use}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __repr__(self):
+        stats = self.stats()
+        return f"\n============ Connection pool ============\n" \
+               f"Opened={stats['opened']}\n" \
+               f"Reused={stats['reused']}\n" \
+               f"Discarded={stats['discarded']}"
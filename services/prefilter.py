@@ -0,0 +1,248 @@
+import hashlib
+import heapq
+import json
+import os
+import sys
+import time
+from array import array
+from bisect import bisect_left
+from multiprocessing import Pool
+
+from convert import iter_records
+from sources import list_objects, relative_key
+
+# Only these events become songplays, the other pages (Home, Login, ...) are dropped before the upload
+SONGPLAY_PAGES = ('NextSong',)
+
+# Columns of a song record that end up in each dimension. A record carries both a song and its artist, each is
+# fingerprinted on its own columns, so an artist with several songs is only kept once.
+DIMENSION_COLUMNS = {
+    # The artist name of the song record is part of the song_key kept in songs
+    'songs': ('song_id', 'title', 'artist_id', 'year', 'duration', 'artist_name'),
+    'artists': ('artist_id', 'artist_name', 'artist_location', 'artist_latitude', 'artist_longitude'),
+}
+
+
+class KeySet:
+    """
+    Persistent set of record fingerprints, stored as a sorted array of 64 bit integers (8 bytes per key on disk and in
+    memory). Lookups are a binary search, keys added during a run are kept apart until they are saved. Unlike a Bloom
+    filter there are no false positives in practice, a new record is never dropped because of a collision.
+    """
+
+    def __init__(self, keys=None):
+        """
+        Initialize the key set
+        :param keys: Sorted array('Q') with the keys of the earlier runs
+        """
+        self._keys = keys if keys is not None else array('Q')
+        self._added = set()
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load the keys saved by an earlier run
+        :param path: Path of the key file, an empty set is returned when it does not exist
+        :return: KeySet
+        """
+        keys = array('Q')
+        if path and os.path.exists(path):
+            with open(path, 'rb') as f:
+                keys.frombytes(f.read())
+        return cls(keys)
+
+    def __contains__(self, key):
+        index = bisect_left(self._keys, key)
+        return (index < len(self._keys) and self._keys[index] == key) or key in self._added
+
+    def __len__(self):
+        return len(self._keys) + len(self._added)
+
+    def add(self, key):
+        """
+        Add a key, returns False when the key was already in the set
+        """
+        if key in self:
+            return False
+        self._added.add(key)
+        return True
+
+    def save(self, path):
+        """
+        Write the keys, the file is replaced atomically so a failed run keeps the previous keys
+        :param path: Path of the key file
+        """
+        keys = array('Q', heapq.merge(self._keys, sorted(self._added)))
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path + '.tmp', 'wb') as f:
+            keys.tofile(f)
+        os.replace(path + '.tmp', path)
+
+
+def pending_path(path):
+    return path + '.pending'
+
+
+def commit_keys(path):
+    """
+    Make the keys of the last pre-filter run permanent. Call this once the filtered files have been loaded, so the
+    records of a failed load are not skipped by the next run.
+    :param path: Path of the key file
+    :return: True when pending keys were committed
+    """
+    if not os.path.exists(pending_path(path)):
+        return False
+    os.replace(pending_path(path), path)
+    return True
+
+
+def fingerprint(dimension, record):
+    """
+    64 bit fingerprint of the row a record adds to a dimension. All the columns of the dimension are hashed, so a
+    song or artist that changed (e.g. a new release year) is loaded again and merged, only unchanged rows are dropped.
+    :param dimension: Name of the dimension in DIMENSION_COLUMNS
+    :param record: JSON object
+    :return: Integer fingerprint
+    """
+    row = [dimension] + [record.get(column) for column in DIMENSION_COLUMNS[dimension]]
+    return int.from_bytes(hashlib.md5(json.dumps(row).encode()).digest()[:8], 'big')
+
+
+def filter_events_file(task):
+    """
+    Copy the events of the song plays of one log file, the other events are dropped
+    :param task: Tuple of source path, target path and the pages that are kept
+    :return: Dictionary with the number of rows and bytes read and written
+    """
+    source, target, pages = task
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    rows_in = rows_out = 0
+    with open(source) as f, open(target, 'w') as out:
+        for record in iter_records(f):
+            rows_in += 1
+            if record.get('page') in pages:
+                out.write(json.dumps(record) + '\n')
+                rows_out += 1
+    return {'files_out': 1, 'rows_in': rows_in, 'rows_out': rows_out, 'bytes_in': os.path.getsize(source),
+            'bytes_out': os.path.getsize(target)}
+
+
+def read_songs_file(path):
+    # Parsed and fingerprinted in a worker process, the key set is only used by the main process
+    with open(path) as f:
+        records = [([fingerprint(dimension, record) for dimension in DIMENSION_COLUMNS], json.dumps(record))
+                   for record in iter_records(f)]
+    return path, os.path.getsize(path), records
+
+
+def new_report():
+    return {'files_in': 0, 'files_out': 0, 'rows_in': 0, 'rows_out': 0, 'bytes_in': 0, 'bytes_out': 0}
+
+
+def finish_report(report, start_time):
+    seconds = time.perf_counter() - start_time
+    report.update({
+        'rows_saved': report['rows_in'] - report['rows_out'],
+        'bytes_saved': report['bytes_in'] - report['bytes_out'],
+        'seconds': round(seconds, 3),
+        'rows_per_second': round(report['rows_in'] / max(seconds, 1e-9), 1),
+    })
+    return report
+
+
+def filter_events(source, target, pages=SONGPLAY_PAGES, workers=None):
+    """
+    Stream the log files and keep only the events of the given pages, with a process pool. The directory layout is
+    kept, so the watermarks of the incremental load and the LOG_JSONPATH file still apply. Note that users and times
+    are then only built from the song plays.
+    :param source: Local directory with the log files
+    :param target: Local directory the filtered files are written to
+    :param pages: Pages of the events that are kept
+    :param workers: Number of processes, the number of CPUs when not given
+    :return: Dictionary with the files, rows and bytes read and written, and the rows and bytes saved
+    """
+    tasks = [(path, os.path.join(target, relative_key(source, path)), tuple(pages)) for path, _ in list_objects(source)]
+
+    report = new_report()
+    start_time = time.perf_counter()
+    with Pool(workers) as pool:
+        for result in pool.imap_unordered(filter_events_file, tasks, chunksize=max(1, len(tasks) // 64)):
+            report['files_in'] += 1
+            for name, value in result.items():
+                report[name] += value
+    return finish_report(report, start_time)
+
+
+def dedupe_songs(source, target, key_path=None, workers=None):
+    """
+    Stream the song files and drop the records whose song and artist were both seen before: in this run and, with a
+    key file, in the loads of earlier runs. The songplays of later runs are matched to the songs and artists tables,
+    so a dropped song is still found. Files without new records are not written, so they are not uploaded either.
+    The keys of this run are saved next to the key file and only become permanent with commit_keys.
+    :param source: Local directory with the song files
+    :param target: Local directory the new song records are written to
+    :param key_path: Key file of the earlier runs, None to only drop the duplicates within this run
+    :param workers: Number of processes, the number of CPUs when not given
+    :return: Dictionary with the files, rows and bytes read and written, the rows and bytes saved, the keys and the new
+    rows per dimension
+    """
+    keys = KeySet.load(key_path)
+    paths = [path for path, _ in list_objects(source)]
+
+    report = new_report()
+    report.update({f"new_{dimension}": 0 for dimension in DIMENSION_COLUMNS})
+    start_time = time.perf_counter()
+    with Pool(workers) as pool:
+        # imap keeps the order of the files, the first occurrence of a record always wins
+        for path, size, records in pool.imap(read_songs_file, paths, chunksize=max(1, len(paths) // 64)):
+            report['files_in'] += 1
+            report['bytes_in'] += size
+            report['rows_in'] += len(records)
+            lines = []
+            for record_keys, record in records:
+                # Both keys are added, a record is kept when its song or its artist is new
+                new = [dimension for dimension, key in zip(DIMENSION_COLUMNS, record_keys) if keys.add(key)]
+                for dimension in new:
+                    report[f"new_{dimension}"] += 1
+                if new:
+                    lines.append(record)
+            if not lines:
+                continue
+            target_path = os.path.join(target, relative_key(source, path))
+            os.makedirs(os.path.dirname(target_path), exist_ok=True)
+            with open(target_path, 'w') as out:
+                out.write('\n'.join(lines) + '\n')
+            report['files_out'] += 1
+            report['rows_out'] += len(lines)
+            report['bytes_out'] += os.path.getsize(target_path)
+
+    if key_path:
+        keys.save(pending_path(key_path))
+    report['keys'] = len(keys)
+    return finish_report(report, start_time)
+
+
+def print_report(name, report):
+    print(f"\n========== Pre-filter {name} ==========\n"
+          f"\n Files: {report['files_in']} -> {report['files_out']}"
+          f"\n Rows: {report['rows_in']} -> {report['rows_out']} ({report['rows_saved']} saved)"
+          f"\n Size: {report['bytes_in'] / 2 ** 20:.2f} MB -> {report['bytes_out'] / 2 ** 20:.2f} MB "
+          f"({report['bytes_saved'] / 2 ** 20:.2f} MB saved)"
+          f"\n Throughput: {report['rows_per_second']:.1f} rows/s in {report['seconds']:.3f} seconds")
+    if 'new_songs' in report:
+        print(f" New: {report['new_songs']} songs, {report['new_artists']} artists")
+
+
+if __name__ == "__main__":
+    # python prefilter.py events <log_data_dir> <target_dir>
+    # python prefilter.py songs <song_data_dir> <target_dir> [<key_file>]
+    # python prefilter.py commit <key_file>     (after the filtered song files have been loaded)
+    command = sys.argv[1]
+    if command == 'events':
+        print_report('events', filter_events(sys.argv[2], sys.argv[3]))
+    elif command == 'songs':
+        print_report('songs', dedupe_songs(sys.argv[2], sys.argv[3], sys.argv[4] if len(sys.argv) > 4 else None))
+    elif command == 'commit':
+        print(f"\n Keys committed: {commit_keys(sys.argv[2])}")
+    else:
+        raise ValueError(f"Unknown command '{command}', expected events, songs or commit")
@@ -0,0 +1,145 @@
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+def backoff_delays(base=5, cap=60, factor=2, rng=None):
+    """
+    Delays between two status checks: exponential backoff with full jitter, so the checks start fast and do not
+    hammer the API when the cluster takes long.
+    :param base: Maximum delay of the first check in seconds
+    :param cap: Maximum delay of any check in seconds
+    :param factor: Growth factor of the maximum delay per check
+    :param rng: Random generator, a new one when not given
+    :return: Generator of delays in seconds
+    """
+    rng = rng or random.Random()
+    attempt = 0
+    while True:
+        yield rng.uniform(0, min(cap, base * factor ** attempt))
+        attempt += 1
+
+
+def print_progress(status, elapsed):
+    """
+    Default progress callback of wait_for_cluster
+    :param status: Status of the cluster
+    :param elapsed: Seconds since the wait started
+    :return: Not applicable
+    """
+    print(f"\n Redshift cluster is not available yet!\n Status: {status} ({elapsed:.0f} seconds)")
+
+
+def print_resize_progress(status, elapsed):
+    """
+    Default progress callback of resize_and_wait
+    :param status: Status of the cluster
+    :param elapsed: Seconds since the wait started
+    :return: Not applicable
+    """
+    print(f"\n Redshift cluster is resizing...\n Status: {status} ({elapsed:.0f} seconds)")
+
+
+def cluster_available(cluster):
+    return cluster['ClusterStatus'] == 'available'
+
+
+def wait_for_cluster(redshift_cluster, timeout=1800, base=5, cap=60, on_progress=print_progress, sleep=None,
+                     clock=time.monotonic, rng=None, ready=cluster_available, stop=None):
+    """
+    Wait until the Redshift cluster is available, checking the status with jittered exponential backoff.
+    :param redshift_cluster: RedshiftCluster, or any object with a get_redshift_cluster_props(refresh) method
+    :param timeout: Maximum number of seconds to wait
+    :param base: Maximum delay of the first check in seconds
+    :param cap: Maximum delay of any check in seconds
+    :param on_progress: Callable called with the status and the elapsed seconds while the cluster is not available
+    :param sleep: Function used to sleep, replaced in tests. By default the wait sleeps on stop, so setting stop ends
+    it right away.
+    :param clock: Function returning the current time in seconds, replaced in tests
+    :param rng: Random generator for the jitter
+    :param ready: Callable returning True when the described cluster is ready, by default when it is available
+    :param stop: threading.Event to give up the wait from another thread
+    :return: The cluster properties once the cluster is available, None when the wait was stopped
+    """
+    if sleep is None:
+        sleep = stop.wait if stop is not None else time.sleep
+    start = clock()
+    for delay in backoff_delays(base, cap, rng=rng):
+        if stop is not None and stop.is_set():
+            return None
+        redshift_cluster_props = redshift_cluster.get_redshift_cluster_props(refresh=True)
+        status = redshift_cluster_props['Clusters'][0]['ClusterStatus'] if redshift_cluster_props else 'unknown'
+        if redshift_cluster_props and ready(redshift_cluster_props['Clusters'][0]):
+            return redshift_cluster_props
+
+        elapsed = clock() - start
+        if on_progress is not None:
+            on_progress(status, elapsed)
+        if elapsed + delay > timeout:
+            raise TimeoutError(f"Redshift cluster is not available after {elapsed:.0f} seconds (status: {status})")
+        sleep(delay)
+
+
+def wait_while(redshift_cluster, local_work, timeout, **wait_kwargs):
+    """
+    Wait for the Redshift cluster in a background thread while the local work runs. When the local work fails, the
+    wait is stopped and the error is raised right away instead of after the cluster is ready.
+    :param redshift_cluster: RedshiftCluster
+    :param local_work: Callable run while waiting, None when there is nothing to do
+    :param timeout: Maximum number of seconds to wait for the cluster
+    :param wait_kwargs: Other keyword arguments of wait_for_cluster
+    :return: Tuple with the cluster properties and the result of the local work
+    """
+    stop = threading.Event()
+    executor = ThreadPoolExecutor(max_workers=1)
+    waiting = executor.submit(wait_for_cluster, redshift_cluster, timeout, stop=stop, **wait_kwargs)
+    try:
+        local_result = local_work() if local_work is not None else None
+    except BaseException:
+        stop.set()
+        executor.shutdown(wait=False)
+        raise
+
+    try:
+        return waiting.result(), local_result
+    finally:
+        executor.shutdown()
+
+
+def provision_cluster(redshift_cluster, local_work=None, timeout=1800, on_progress=print_progress, **wait_kwargs):
+    """
+    Create the Redshift cluster and wait for it in the background, while the local work (config parsing, DDL
+    rendering, listing the input) runs in the meantime.
+    :param redshift_cluster: RedshiftCluster
+    :param local_work: Callable run while the cluster comes up, its result is returned
+    :param timeout: Maximum number of seconds to wait for the cluster
+    :param on_progress: Callable called with the status and the elapsed seconds while the cluster is not available
+    :param wait_kwargs: Other keyword arguments of wait_for_cluster
+    :return: Tuple with the cluster properties and the result of the local work
+    """
+    redshift_cluster.create_redshift_cluster()
+    return wait_while(redshift_cluster, local_work, timeout, on_progress=on_progress, **wait_kwargs)
+
+
+def resize_and_wait(redshift_cluster, num_nodes, local_work=None, timeout=1800, on_progress=print_resize_progress,
+                    **wait_kwargs):
+    """
+    Start an elastic resize and wait for it in the background, while the local work runs in the meantime. The
+    cluster is only taken as resized once it is available with the new number of nodes, the status right after the
+    request may still be the one from before the resize.
+    :param redshift_cluster: RedshiftCluster
+    :param num_nodes: Number of nodes after the resize
+    :param local_work: Callable run while the cluster is resized, its result is returned
+    :param timeout: Maximum number of seconds to wait for the resize
+    :param on_progress: Callable called with the status and the elapsed seconds while the cluster is resizing
+    :param wait_kwargs: Other keyword arguments of wait_for_cluster
+    :return: Tuple with the cluster properties (None when the resize was refused) and the result of the local work
+    """
+    if redshift_cluster.resize_cluster(num_nodes) is None:
+        return None, local_work() if local_work is not None else None
+
+    def resized(cluster):
+        return cluster_available(cluster) and cluster['NumberOfNodes'] == num_nodes
+
+    return wait_while(redshift_cluster, local_work, timeout, on_progress=on_progress, ready=resized, **wait_kwargs)
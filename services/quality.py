@@ -0,0 +1,151 @@
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+from sql_queries import accepted_values, star_schema_tables, value_ranges
+from instrumentation import execute, stage
+
+STAR_TABLES = ['songplays', 'users', 'songs', 'artists', 'times']
+REFERENCES = re.compile(r'\bREFERENCES\s+(\w+)\s*\(\s*(\w+)\s*\)', re.IGNORECASE)
+
+
+def sql_literal(value):
+    return str(value) if isinstance(value, (int, float)) else "'{}'".format(str(value).replace("'", "''"))
+
+
+class Check:
+    """
+    Data quality rule on a column, compiled to an aggregate that counts the rows breaking the rule
+    """
+
+    def __init__(self, kind, column, expression, join=None, description=''):
+        """
+        Initialize the check
+        :param kind: not_null, unique, references, range or accepted_values
+        :param column: Column the rule applies to
+        :param expression: Aggregate over the table (alias t) returning the number of failing rows
+        :param join: LEFT JOIN clause the expression needs, e.g. for referential integrity
+        :param description: Readable form of the rule for the report
+        """
+        self.kind = kind
+        self.column = column
+        self.expression = expression
+        self.join = join
+        self.description = description or f"{kind} {column}"
+
+
+def not_null(column):
+    return Check('not_null', column, f"SUM(CASE WHEN t.{column} IS NULL THEN 1 ELSE 0 END)")
+
+
+def unique(column):
+    return Check('unique', column, f"COUNT(t.{column}) - COUNT(DISTINCT t.{column})")
+
+
+def references(column, table, key, alias):
+    # The referenced keys are made distinct first, so a duplicate key cannot multiply the rows of the scan
+    return Check('references', column,
+                 f"SUM(CASE WHEN t.{column} IS NOT NULL AND {alias}.{key} IS NULL THEN 1 ELSE 0 END)",
+                 f"LEFT JOIN (SELECT DISTINCT {key} FROM {table}) {alias} ON {alias}.{key} = t.{column}",
+                 f"references {column} -> {table}.{key}")
+
+
+def value_range(column, minimum=None, maximum=None):
+    conditions = []
+    if minimum is not None:
+        conditions.append(f"t.{column} < {sql_literal(minimum)}")
+    if maximum is not None:
+        conditions.append(f"t.{column} > {sql_literal(maximum)}")
+    return Check('range', column, f"SUM(CASE WHEN {' OR '.join(conditions)} THEN 1 ELSE 0 END)",
+                 description=f"range {column} [{minimum}, {maximum}]")
+
+
+def accepted(column, values):
+    return Check('accepted_values', column,
+                 f"SUM(CASE WHEN t.{column} NOT IN ({', '.join(sql_literal(value) for value in values)}) "
+                 f"THEN 1 ELSE 0 END)",
+                 description=f"accepted_values {column} {list(values)}")
+
+
+def table_checks(table):
+    """
+    Checks of a table: NOT NULL, PRIMARY KEY and REFERENCES as declared on the columns, plus the value ranges and
+    accepted values of sql_queries.py
+    :param table: Table declared in sql_queries.py
+    :return: List of Check
+    """
+    checks = []
+    for column in table.columns:
+        constraints = column.constraints.upper()
+        if 'NOT NULL' in constraints or 'PRIMARY KEY' in constraints:
+            checks.append(not_null(column.name))
+        if 'PRIMARY KEY' in constraints:
+            checks.append(unique(column.name))
+        for referenced_table, key in REFERENCES.findall(column.constraints):
+            checks.append(references(column.name, referenced_table, key, f"r{len(checks)}"))
+
+    for column, (minimum, maximum) in value_ranges.get(table.name, {}).items():
+        checks.append(value_range(column, minimum, maximum))
+    for column, values in accepted_values.get(table.name, {}).items():
+        checks.append(accepted(column, values))
+    return checks
+
+
+def compile_checks(table_name, checks):
+    """
+    Compile all checks of a table into one statement, so the table is scanned once
+    :param table_name: Name of the table
+    :param checks: List of Check
+    :return: SELECT statement returning the row count followed by the failing rows per check
+    """
+    columns = ', '.join(['COUNT(*)'] + [check.expression for check in checks])
+    joins = ''.join(f" {check.join}" for check in checks if check.join)
+    return f"SELECT {columns} FROM {table_name} t{joins}"
+
+
+def run_quality_checks(pool, tables=None, workers=4, min_rows=1):
+    """
+    Run the data quality checks, one aggregate scan per table and the tables at the same time
+    :param pool: Connection pool to the Redshift cluster
+    :param tables: Names of the tables to check, the tables of the star schema when not given
+    :param workers: Number of tables checked at the same time
+    :param min_rows: Minimum number of rows every table has to hold
+    :return: Dictionary with passed and per table the row count and the result of every check
+    """
+    tables = list(tables or STAR_TABLES)
+
+    def check_table(table_name):
+        checks = table_checks(star_schema_tables[table_name])
+        with pool.session() as conn, stage('quality'):
+            cur = conn.cursor()
+            execute(cur, compile_checks(table_name, checks), name=f"quality {table_name}")
+            row = cur.fetchone()
+
+        rows = int(row[0])
+        results = [{'check': 'min_rows', 'column': None, 'description': f"min_rows {min_rows}",
+                    'failed_rows': 0 if rows >= min_rows else min_rows - rows, 'passed': rows >= min_rows}]
+        for check, failed in zip(checks, row[1:]):
+            failed = int(failed or 0)
+            results.append({'check': check.kind, 'column': check.column, 'description': check.description,
+                            'failed_rows': failed, 'passed': failed == 0})
+        return table_name, {'rows': rows, 'passed': all(result['passed'] for result in results), 'checks': results}
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        report = dict(executor.map(check_table, tables))
+
+    return {'passed': all(table['passed'] for table in report.values()), 'tables': report}
+
+
+def format_quality_report(report):
+    """
+    Readable form of the quality report, only the failed checks are listed
+    :param report: Dictionary returned by run_quality_checks
+    :return: Text of the report
+    """
+    lines = []
+    for table_name, table in report['tables'].items():
+        passed = sum(check['passed'] for check in table['checks'])
+        lines.append(f" {table_name:<10} rows={table['rows']:<10} {passed}/{len(table['checks'])} checks passed")
+        for check in table['checks']:
+            if not check['passed']:
+                lines.append(f"     FAILED {check['description']}: {check['failed_rows']} rows")
+    return '\n'.join(lines)
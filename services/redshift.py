@@ -1,21 +1,34 @@
 import boto3
-import configparser
 import time
 
+from provisioning import wait_for_cluster
+from registry import load_config
+
 
 ##### HELPER FUNCTIONS #####
 
+def cluster_type(num_nodes):
+    """
+    Cluster type of a number of nodes, the CLUSTER_TYPE of the dwh.cfg file does not follow a cluster sized per run
+    :param num_nodes: Number of nodes of the cluster
+    :return: single-node or multi-node
+    """
+    return 'multi-node' if num_nodes > 1 else 'single-node'
+
+
 class RedshiftCluster:
     """
     Redshift keys
     """
 
-    def __init__(self):
+    def __init__(self, redshift_client=None, iam_client=None, ttl=30):
         """
         Initialize Redshift keys
+        :param redshift_client: boto3 Redshift client, created on first use when not given (e.g. a stubbed client)
+        :param iam_client: boto3 IAM client, created on first use when not given
+        :param ttl: Number of seconds a cluster description is reused
         """
-        config = configparser.ConfigParser()
-        config.read('dwh.cfg')
+        config = load_config()
 
         self.KEY = config.get('AWS','KEY')
         self.SECRET = config.get('AWS','SECRET')
@@ -33,40 +46,98 @@ class RedshiftCluster:
 
         self.ARN = config.get("IAM_ROLE", "ARN")
 
-    def create_redshift_cluster(self):
+        self.ttl = ttl
+        self._clients = {'redshift': redshift_client, 'iam': iam_client}
+        self._description = None
+        self._described_at = None
+
+        # Counters to verify how many clients and API calls are saved by the cache
+        self.calls = {'clients_created': 0, 'describe_clusters': 0, 'cache_hits': 0}
+
+    def client(self, service):
         """
-        Create a Redshift cluster
+        Get the boto3 client of a service, the client is created once and reused
+        :param service: redshift or iam
+        :return: boto3 client
         """
-        redshift = boto3.client('redshift',
-                            region_name="us-west-2",
-                            aws_access_key_id=self.KEY,
-                            aws_secret_access_key=self.SECRET)
+        if self._clients.get(service) is None:
+            self._clients[service] = boto3.client(service,
+                                                  region_name="us-west-2",
+                                                  aws_access_key_id=self.KEY,
+                                                  aws_secret_access_key=self.SECRET)
+            self.calls['clients_created'] += 1
 
-        iam = boto3.client('iam', region_name="us-west-2",
-                           aws_access_key_id=self.KEY,
-                           aws_secret_access_key=self.SECRET)
+        return self._clients[service]
 
+    def invalidate(self):
+        """
+        Drop the cached cluster description, e.g. after the cluster is created or deleted
+        """
+        self._description = None
+        self._described_at = None
 
+    def describe(self, refresh=False):
+        """
+        Describe the Redshift cluster. The description is cached for ttl seconds.
+        :param refresh: Describe the cluster again instead of using the cache
+        :return: Response of describe_clusters
+        """
+        if not refresh and self._description is not None and time.monotonic() - self._described_at < self.ttl:
+            self.calls['cache_hits'] += 1
+            return self._description
 
-        try:
-            response = redshift.create_cluster(
-                #HW
-                ClusterType=self.CLUSTER_TYPE,
-                NodeType=self.NODE_TYPE,
-                NumberOfNodes=self.NUM_NODES,
+        self.calls['describe_clusters'] += 1
+        response = self.client('redshift').describe_clusters(ClusterIdentifier=self.DB_IDENTIFIER)
+        self._description = response
+        self._described_at = time.monotonic()
 
-                #Identifiers & Credentials
-                DBName=self.DB_NAME,
-                ClusterIdentifier=self.DB_IDENTIFIER,
-                MasterUsername=self.DB_USER,
-                MasterUserPassword=self.DB_PASSWORD,
+        return response
+
+    def create_redshift_cluster(self):
+        """
+        Create a Redshift cluster. An error is raised to the caller, which would otherwise wait for a cluster that is
+        never created.
+        :return: Response of create_cluster
+        """
+        response = self.client('redshift').create_cluster(
+            #HW
+            ClusterType=cluster_type(self.NUM_NODES),
+            NodeType=self.NODE_TYPE,
+            NumberOfNodes=self.NUM_NODES,
+
+            #Identifiers & Credentials
+            DBName=self.DB_NAME,
+            ClusterIdentifier=self.DB_IDENTIFIER,
+            MasterUsername=self.DB_USER,
+            MasterUserPassword=self.DB_PASSWORD,
+
+            #Roles (for s3 access)
 
-                #Roles (for s3 access)
+            IamRoles=[self.ARN]
+        )
+        self.invalidate()
+
+        return response
 
-                IamRoles=[self.ARN]
+    def resize_cluster(self, num_nodes):
+        """
+        Start an elastic resize of the Redshift cluster to another number of nodes of the same type. The cluster stays
+        available for reads during most of the resize, see provisioning.resize_and_wait to wait for it.
+        :param num_nodes: Number of nodes after the resize
+        :return: Response of resize_cluster, None when the resize was refused
+        """
+        response = None
+        try:
+            response = self.client('redshift').resize_cluster(
+                ClusterIdentifier=self.DB_IDENTIFIER,
+                ClusterType=cluster_type(num_nodes),
+                NodeType=self.NODE_TYPE,
+                NumberOfNodes=num_nodes,
+                Classic=False
             )
         except Exception as e:
             print(e)
+        self.invalidate()
 
         return response
 
@@ -74,24 +145,25 @@ class RedshiftCluster:
         """
         Delete a Redshift cluster
         """
-        redshift = boto3.client('redshift')
+        response = None
         try:
-            response = redshift.delete_cluster(
+            response = self.client('redshift').delete_cluster(
                 ClusterIdentifier=self.DB_IDENTIFIER,
                 SkipFinalClusterSnapshot=True
             )
         except Exception as e:
             print(e)
+        self.invalidate()
 
         return response
 
-    def get_redshift_cluster_props(self):
+    def get_redshift_cluster_props(self, refresh=False):
         """
         Get Redshift cluster properties
+        :param refresh: Describe the cluster again instead of using the cache
         """
-        redshift = boto3.client('redshift')
         try:
-            response = redshift.describe_clusters(ClusterIdentifier=self.DB_IDENTIFIER)
+            response = self.describe(refresh)
         except Exception as e:
             print(e)
             return None
@@ -102,26 +174,13 @@ class RedshiftCluster:
         """
         Get Redshift cluster endpoint
         """
-        redshift = boto3.client('redshift')
-        try:
-            response = redshift.describe_clusters(ClusterIdentifier=self.DB_IDENTIFIER)
-        except Exception as e:
-            print(e)
-
-        return response['Clusters'][0]['Endpoint']['Address']
+        return self.describe()['Clusters'][0]['Endpoint']['Address']
 
     def get_redshift_cluster_role_arn(self):
         """
         Get Redshift cluster role arn
         """
-        redshift = boto3.client('redshift')
-        try:
-            response = redshift.describe_clusters(ClusterIdentifier=self.DB_IDENTIFIER)
-        except Exception as e:
-            print(e)
-
-
-        return response['Clusters'][0]['IamRoles'][0]['IamRoleArn']
+        return self.describe()['Clusters'][0]['IamRoles'][0]['IamRoleArn']
 
     # print the redshift cluster endpoint and role arn
     def __repr__(self):
@@ -141,12 +200,8 @@ if __name__ == "__main__":
     # print(f"\n New redshift cluster created?\n {new_cluster}")
 
     # wait for the redshift cluster to be available
-    while True:
-        redshift_cluster_props = redshift_cluster.get_redshift_cluster_props()
-        if redshift_cluster_props['Clusters'][0]['ClusterStatus'] == 'available':
-            print(f"\n Redshift cluster is available!\n {redshift_cluster_props}")
-            break
-        time.sleep(60)
+    redshift_cluster_props = wait_for_cluster(redshift_cluster)
+    print(f"\n Redshift cluster is available!\n {redshift_cluster_props}")
 
     # delete the redshift cluster
     redshift_cluster.delete_redshift_cluster()
@@ -0,0 +1,87 @@
+import configparser
+from functools import lru_cache
+
+
+@lru_cache(maxsize=None)
+def load_config(path='dwh.cfg'):
+    """
+    Parse the dwh.cfg file. The file is read once per process, every module shares the same ConfigParser.
+    :param path: Path of the configuration file
+    :return: ConfigParser with the file loaded
+    """
+    config = configparser.ConfigParser()
+    config.read(path)
+    return config
+
+
+class Query:
+    """
+    SQL statement with bound parameters. The values are passed to the driver with the statement instead of being
+    formatted into the SQL, so the same statement is reused with other paths or values.
+    """
+
+    def __init__(self, sql, params=None):
+        """
+        Initialize the query
+        :param sql: SQL statement with %(name)s placeholders
+        :param params: Dictionary with the values of the placeholders
+        """
+        self.sql = sql
+        self.params = dict(params) if params else None
+
+    def bind(self, **params):
+        """
+        Bind (more) parameters
+        :return: New Query with the parameters added
+        """
+        return Query(self.sql, {**(self.params or {}), **params})
+
+    def __eq__(self, other):
+        return isinstance(other, Query) and (self.sql, self.params) == (other.sql, other.params)
+
+    def __repr__(self):
+        return f"Query({' '.join(self.sql.split())!r}, {self.params!r})"
+
+
+class QueryRegistry:
+    """
+    Statements that depend on the configuration. They are built on first use and cached, so importing the query
+    module does not read any configuration.
+    """
+
+    def __init__(self):
+        self._builders = {}
+        self._built = {}
+
+    def register(self, builder):
+        """
+        Register a builder, used as decorator. The statement is known by the name of the function without the build_
+        prefix, the function itself must not shadow the name of the statement.
+        :param builder: Function without arguments returning the statement
+        :return: The builder
+        """
+        self._builders[builder.__name__[len('build_'):] if builder.__name__.startswith('build_') else
+                       builder.__name__] = builder
+        return builder
+
+    def __contains__(self, name):
+        return name in self._builders
+
+    def get(self, name):
+        """
+        Statement built by the builder with this name, built once
+        :param name: Name of the statement
+        :return: The statement
+        """
+        if name not in self._built:
+            self._built[name] = self._builders[name]()
+        return self._built[name]
+
+    def names(self):
+        return list(self._builders)
+
+    def reset(self):
+        """
+        Forget the built statements, e.g. after the configuration has changed
+        """
+        self._built.clear()
@@ -0,0 +1,111 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import sql_queries
+from registry import Query
+from instrumentation import execute, stage
+
+
+def validate_stage_graph(stages):
+    """
+    Check that every dependency of the stage graph exists and that the graph has no cycles.
+    :param stages: Dictionary with stage name -> (query, list of stage names it depends on)
+    :return: List of stage names in a valid execution order
+    """
+    for name, (_, depends_on) in stages.items():
+        for dependency in depends_on:
+            if dependency not in stages:
+                raise ValueError(f"Stage '{name}' depends on unknown stage '{dependency}'")
+
+    order = []
+    done = set()
+    remaining = dict(stages)
+    while remaining:
+        ready = [name for name, (_, depends_on) in remaining.items() if set(depends_on) <= done]
+        if not ready:
+            raise ValueError(f"Stage graph contains a cycle between: {sorted(remaining)}")
+        for name in ready:
+            order.append(name)
+            done.add(name)
+            del remaining[name]
+
+    return order
+
+
+def select_stages(stages, names):
+    """
+    Select a part of the stage graph. Dependencies on stages that are not selected are dropped, these stages are
+    expected to be loaded already.
+    :param stages: Dictionary with stage name -> (query, list of stage names it depends on)
+    :param names: Names of the stages to select
+    :return: Dictionary with the selected stages
+    """
+    return {name: (stages[name][0], [dependency for dependency in stages[name][1] if dependency in names])
+            for name in names}
+
+
+def run_stages(pool, stages=None, workers=4):
+    """
+    Run the stages of the load pipeline as a DAG. A stage is started as soon as all stages it depends on are
+    committed, so independent COPY and INSERT statements run at the same time on separate connections.
+    :param pool: ConnectionPool the worker connections are borrowed from (psycopg2 or a stub connect)
+    :param stages: Dictionary with stage name -> (query or list of queries, list of stage names it depends on)
+    :param workers: Maximum number of worker connections used at the same time
+    :return: Dictionary with stage name -> timings (start and end relative to the start of the run, seconds)
+    """
+    if stages is None:
+        stages = sql_queries.load_stage_graph
+    if workers < 1:
+        raise ValueError("At least one worker connection is required")
+    validate_stage_graph(stages)
+
+    run_start = time.perf_counter()
+    timings = {}
+
+    def run_stage(name):
+        # A stage is a single query or a list of queries committed together, e.g. one COPY per manifest
+        queries = stages[name][0]
+        if isinstance(queries, (str, Query)):
+            queries = [queries]
+        with pool.session() as conn, stage(name):
+            start = time.perf_counter()
+            cur = conn.cursor()
+            for query in queries:
+                execute(cur, query)
+            conn.commit()
+            end = time.perf_counter()
+        timings[name] = {'start': start - run_start, 'end': end - run_start, 'seconds': end - start}
+        return name
+
+    done = set()
+    pending = set(stages)
+    running = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while pending or running:
+            for name in sorted(pending):
+                if set(stages[name][1]) <= done:
+                    pending.discard(name)
+                    running[executor.submit(run_stage, name)] = name
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                # Stop scheduling new stages when a stage fails, the running ones are allowed to finish
+                if future.exception() is not None:
+                    pending.clear()
+                    wait(running)
+                    raise RuntimeError(f"Stage '{name}' failed") from future.exception()
+                done.add(name)
+
+    return timings
+
+
+def print_stage_timings(timings):
+    """
+    Print the per stage timings of a scheduled run, ordered by start time.
+    :param timings: Dictionary returned by run_stages
+    :return: Not applicable
+    """
+    print("\n========== Stage timings ==========")
+    for name, timing in sorted(timings.items(), key=lambda item: item[1]['start']):
+        print(f" {name:<15} start={timing['start']:8.2f}s end={timing['end']:8.2f}s took={timing['seconds']:8.2f}s")
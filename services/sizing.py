@@ -0,0 +1,226 @@
+import json
+import os
+import statistics
+import sys
+from datetime import datetime, timezone
+
+from manifest import cluster_slices
+from scheduler import validate_stage_graph
+from sources import list_objects
+
+# Staging table -> option of the [S3] section with its input
+SOURCES = {'staging_events': 'LOG_DATA', 'staging_songs': 'SONG_DATA'}
+
+# Used until the history has a run with the stage: a COPY reads about 4 MB/s per slice from S3, an INSERT ... SELECT
+# processes about 200k staging rows/s per slice. The history replaces both with the measured throughput.
+DEFAULT_BYTES_PER_ROW = {'staging_events': 300.0, 'staging_songs': 250.0}
+DEFAULT_COPY_RATE = 4 * 2 ** 20
+DEFAULT_INSERT_RATE = 200000.0
+
+# Number of runs kept in the history file, the throughput is the median over these runs
+HISTORY_SIZE = 20
+
+
+def estimate_inputs(sources, bytes_per_row=None, list_inputs=list_objects):
+    """
+    Size of the input of every staging table from the listing of its source
+    :param sources: Dictionary with staging table -> S3 uri or local directory
+    :param bytes_per_row: Dictionary with staging table -> bytes per row, the defaults when not given
+    :param list_inputs: Callable listing an S3 uri or local directory, as sources.list_objects
+    :return: Dictionary with staging table -> dictionary with files, bytes and the estimated rows
+    """
+    bytes_per_row = {**DEFAULT_BYTES_PER_ROW, **(bytes_per_row or {})}
+    inputs = {}
+    for table, uri in sources.items():
+        objects = list_inputs(uri)
+        size = sum(size for _, size in objects)
+        inputs[table] = {'files': len(objects), 'bytes': size, 'rows': int(size / bytes_per_row[table])}
+    return inputs
+
+
+def stage_work(name, inputs):
+    """
+    Amount of work of a stage: the bytes a COPY stage reads, the staging rows the other stages process
+    :param name: Name of the stage
+    :param inputs: Dictionary returned by estimate_inputs
+    :return: Bytes or rows
+    """
+    if name in inputs:
+        return inputs[name]['bytes']
+    return sum(item['rows'] for item in inputs.values())
+
+
+class SizingModel:
+    """
+    Predicts the load time for a number of nodes from the throughput per slice measured by earlier runs. A stage is
+    taken to scale linearly with the slices, stages run as soon as their dependencies are committed, so the load
+    takes as long as the slowest path through the stage graph.
+    """
+
+    def __init__(self, history=None):
+        """
+        Initialize the sizing model
+        :param history: List of runs recorded by record_run, the oldest first
+        """
+        self.history = list(history or [])
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load the history file
+        :param path: Path of the JSON history file, an empty history when it does not exist
+        :return: SizingModel
+        """
+        if not path or not os.path.exists(path):
+            return cls()
+        with open(path) as f:
+            return cls(json.load(f))
+
+    def record_run(self, path, node_type, num_nodes, inputs, rows, stage_seconds):
+        """
+        Add a run to the history and write the history file
+        :param path: Path of the JSON history file
+        :param node_type: Node type of the cluster
+        :param num_nodes: Number of nodes the load ran on
+        :param inputs: Dictionary returned by estimate_inputs
+        :param rows: Dictionary with staging table -> number of rows loaded
+        :param stage_seconds: Dictionary with stage name -> seconds, e.g. the stages of the run report
+        """
+        self.history.append({
+            'recorded_at': datetime.now(timezone.utc).isoformat(),
+            'node_type': node_type,
+            'slices': cluster_slices(node_type, num_nodes),
+            'inputs': {table: {'bytes': item['bytes'], 'rows': rows.get(table, item['rows'])}
+                       for table, item in inputs.items()},
+            'stages': stage_seconds,
+        })
+        self.history = self.history[-HISTORY_SIZE:]
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self.history, f, indent=2)
+        os.replace(path + '.tmp', path)
+
+    def bytes_per_row(self):
+        """
+        :return: Dictionary with staging table -> median bytes per row of the earlier runs
+        """
+        ratios = {}
+        for run in self.history:
+            for table, item in run['inputs'].items():
+                if item['rows']:
+                    ratios.setdefault(table, []).append(item['bytes'] / item['rows'])
+        return {table: statistics.median(values) for table, values in ratios.items()}
+
+    def rates(self):
+        """
+        :return: Dictionary with stage name -> median throughput per slice of the earlier runs, in bytes per second
+        for the COPY stages and in staging rows per second for the other stages
+        """
+        rates = {}
+        for run in self.history:
+            for name, seconds in run['stages'].items():
+                work = stage_work(name, run['inputs'])
+                if seconds > 0 and work > 0:
+                    rates.setdefault(name, []).append(work / seconds / run['slices'])
+        return {name: statistics.median(values) for name, values in rates.items()}
+
+    def predict(self, stages, inputs, slices):
+        """
+        Predict the load time
+        :param stages: Dictionary with stage name -> (query or list of queries, list of stage names it depends on)
+        :param inputs: Dictionary returned by estimate_inputs
+        :param slices: Number of slices of the cluster
+        :return: Seconds until the last stage is committed
+        """
+        validate_stage_graph(stages)
+        rates = self.rates()
+        finished = {}
+
+        def finish(name):
+            if name not in finished:
+                default = DEFAULT_COPY_RATE if name in inputs else DEFAULT_INSERT_RATE
+                seconds = stage_work(name, inputs) / (rates.get(name, default) * slices)
+                finished[name] = max((finish(dependency) for dependency in stages[name][1]), default=0.0) + seconds
+            return finished[name]
+
+        return max((finish(name) for name in stages), default=0.0)
+
+    def recommend(self, stages, inputs, node_type, target_seconds, min_nodes, max_nodes):
+        """
+        Smallest number of nodes that loads the input within the target time
+        :param stages: Stage graph of the load
+        :param inputs: Dictionary returned by estimate_inputs
+        :param node_type: Node type of the cluster
+        :param target_seconds: Load time to stay within
+        :param min_nodes: Smallest number of nodes to consider
+        :param max_nodes: Largest number of nodes to consider, recommended when no size meets the target
+        :return: Tuple of (number of nodes, predicted seconds)
+        """
+        for num_nodes in range(min_nodes, max_nodes + 1):
+            seconds = self.predict(stages, inputs, cluster_slices(node_type, num_nodes))
+            if seconds <= target_seconds:
+                return num_nodes, seconds
+        return max_nodes, self.predict(stages, inputs, cluster_slices(node_type, max_nodes))
+
+
+def elastic_range(node_type, num_nodes):
+    """
+    Numbers of nodes an elastic resize can reach from the current size: a quarter to four times the nodes for RA3,
+    half to double for the other node types. Redshift refuses sizes outside the range, the cluster then keeps its size.
+    :param node_type: Node type of the cluster
+    :param num_nodes: Current number of nodes
+    :return: Tuple of (minimum, maximum) number of nodes
+    """
+    factor = 4 if node_type.startswith('ra3.') else 2
+    return max(1, -(-num_nodes // factor)), num_nodes * factor
+
+
+def resize_pays_off(model, stages, inputs, node_type, current_nodes, num_nodes, resize_seconds=600.0):
+    """
+    An elastic resize takes a while and pauses the writes, so an existing cluster is only resized before the load
+    when it grows and the predicted time saved is larger than the resize itself. A cluster with more nodes than
+    needed loads as it is and shrinks after the load.
+    :param model: SizingModel
+    :param stages: Stage graph of the load
+    :param inputs: Dictionary returned by estimate_inputs
+    :param node_type: Node type of the cluster
+    :param current_nodes: Current number of nodes
+    :param num_nodes: Recommended number of nodes
+    :param resize_seconds: Expected duration of an elastic resize
+    :return: True when the cluster should be resized before the load
+    """
+    if num_nodes <= current_nodes:
+        return False
+    saved = model.predict(stages, inputs, cluster_slices(node_type, current_nodes)) - \
+        model.predict(stages, inputs, cluster_slices(node_type, num_nodes))
+    return saved > resize_seconds
+
+
+def print_sizing(inputs, predictions, recommendation):
+    """
+    Print the estimated input, the predicted load time per number of nodes and the recommendation
+    :param inputs: Dictionary returned by estimate_inputs
+    :param predictions: Dictionary with number of nodes -> predicted seconds
+    :param recommendation: Tuple returned by SizingModel.recommend
+    """
+    print("\n============ Cluster sizing ============")
+    for table, item in inputs.items():
+        print(f" {table:<16} {item['files']:>8} files {item['bytes'] / 2 ** 20:10.1f} MB ~{item['rows']} rows")
+    for num_nodes, seconds in predictions.items():
+        print(f" {num_nodes:>3} nodes  ~{seconds:8.1f} s{'  <- recommended' if num_nodes == recommendation[0] else ''}")
+
+
+if __name__ == "__main__":
+    # python sizing.py <log_data> <song_data> [<history.json>] [<node_type>] [<target_seconds>]: the recommendation
+    # for an S3 prefix or a local directory, without a cluster
+    import sql_queries
+
+    model = SizingModel.load(sys.argv[3] if len(sys.argv) > 3 else None)
+    node_type = sys.argv[4] if len(sys.argv) > 4 else 'dc2.large'
+    target_seconds = float(sys.argv[5]) if len(sys.argv) > 5 else 900.0
+    inputs = estimate_inputs({'staging_events': sys.argv[1], 'staging_songs': sys.argv[2]}, model.bytes_per_row())
+    stages = sql_queries.load_stage_graph
+    predictions = {num_nodes: model.predict(stages, inputs, cluster_slices(node_type, num_nodes))
+                   for num_nodes in range(1, 17)}
+    print_sizing(inputs, predictions, model.recommend(stages, inputs, node_type, target_seconds, 1, 16))
@@ -0,0 +1,125 @@
+import os
+
+
+def strip_quotes(value):
+    """
+    The S3 paths in the dwh.cfg file are stored with quotes so they can be used directly in the COPY statements.
+    :param value: Value from the dwh.cfg file
+    :return: Value without the surrounding quotes
+    """
+    return value.strip().strip("'\"")
+
+
+def join_uri(uri, *parts):
+    """
+    Join an S3 uri or a local path with the given parts
+    :param uri: S3 uri (s3://bucket/prefix) or local directory
+    :param parts: Parts to add to the uri
+    :return: The joined uri
+    """
+    if uri.startswith('s3://'):
+        return '/'.join([uri.rstrip('/')] + [part.strip('/') for part in parts])
+    return os.path.join(uri, *parts)
+
+
+def list_objects(uri, s3_client=None, with_etag=False):
+    """
+    List the objects under an S3 prefix or a local directory. A local directory stands in for S3 in tests and
+    benchmarks, both return the same shape.
+    :param uri: S3 uri (s3://bucket/prefix) or local directory
+    :param s3_client: boto3 S3 client, only used for S3 uris. A new client is created when not given.
+    :param with_etag: Also return the ETag of every object, the modification time in nanoseconds for a local file.
+    A rewritten object of the same size changes it.
+    :return: List of (object uri, size in bytes) or (object uri, size in bytes, ETag) sorted by uri
+    """
+    uri = strip_quotes(uri)
+
+    if uri.startswith('s3://'):
+        bucket, _, prefix = uri[len('s3://'):].partition('/')
+        if s3_client is None:
+            import boto3
+            s3_client = boto3.client('s3', region_name="us-west-2")
+
+        objects = []
+        paginator = s3_client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+            for item in page.get('Contents', []):
+                if not item['Key'].endswith('/'):
+                    objects.append((f"s3://{bucket}/{item['Key']}", item['Size']) +
+                                   ((item['ETag'],) if with_etag else ()))
+        return sorted(objects)
+
+    objects = []
+    for root, _, files in os.walk(uri):
+        for name in files:
+            path = os.path.join(root, name)
+            stat = os.stat(path)
+            objects.append((path, stat.st_size) + ((str(stat.st_mtime_ns),) if with_etag else ()))
+    return sorted(objects)
+
+
+def relative_key(uri, object_uri):
+    """
+    Key of an object relative to the listed uri, always with forward slashes
+    :param uri: The uri that was listed
+    :param object_uri: The uri of an object returned by list_objects
+    :return: The relative key, e.g. 2018/11/2018-11-12-events.json
+    """
+    uri = strip_quotes(uri)
+    if uri.startswith('s3://'):
+        return object_uri[len(uri.rstrip('/')):].lstrip('/')
+    return os.path.relpath(object_uri, uri).replace(os.sep, '/')
+
+
+def s3_location(uri):
+    """
+    Split an S3 uri in bucket and key
+    :param uri: S3 uri, e.g. s3://bucket/prefix/key
+    :return: Tuple of (bucket, key)
+    """
+    bucket, _, key = uri[len('s3://'):].partition('/')
+    return bucket, key
+
+
+def read_text(uri, s3_client=None):
+    """
+    Read an S3 object or a local file
+    :param uri: S3 uri or local path
+    :param s3_client: boto3 S3 client, only used for S3 uris. A new client is created when not given.
+    :return: Content of the object, None when it does not exist
+    """
+    if uri.startswith('s3://'):
+        if s3_client is None:
+            import boto3
+            s3_client = boto3.client('s3', region_name="us-west-2")
+        bucket, key = s3_location(uri)
+        try:
+            return s3_client.get_object(Bucket=bucket, Key=key)['Body'].read().decode('utf-8')
+        except s3_client.exceptions.NoSuchKey:
+            return None
+
+    if not os.path.exists(uri):
+        return None
+    with open(uri) as f:
+        return f.read()
+
+
+def write_text(uri, body, s3_client=None):
+    """
+    Write an S3 object or a local file, a local file is replaced atomically
+    :param uri: S3 uri or local path
+    :param body: Content of the object
+    :param s3_client: boto3 S3 client, only used for S3 uris. A new client is created when not given.
+    """
+    if uri.startswith('s3://'):
+        if s3_client is None:
+            import boto3
+            s3_client = boto3.client('s3', region_name="us-west-2")
+        bucket, key = s3_location(uri)
+        s3_client.put_object(Bucket=bucket, Key=key, Body=body.encode('utf-8'))
+        return
+
+    os.makedirs(os.path.dirname(os.path.abspath(uri)), exist_ok=True)
+    with open(uri + '.tmp', 'w') as f:
+        f.write(body)
+    os.replace(uri + '.tmp', uri)
@@ -1,15 +1,33 @@
-import configparser
+from registry import Query, QueryRegistry, load_config
+from sources import strip_quotes
+from tables import Column, Table
 
 
 
 # CONFIG
-config = configparser.ConfigParser()
-config.read('dwh.cfg')
+# The statements that need the dwh.cfg file are registered here and built on first use, see CONFIGURED STATEMENTS
+configured_queries = QueryRegistry()
+
+
+def s3_path(option):
+    return strip_quotes(load_config().get('S3', option))
+
+
+def copy_parameters(**params):
+    """
+    Parameters of the COPY statements, bound instead of formatted into the SQL
+    :param params: Other parameters, e.g. the source of the COPY
+    :return: Dictionary with the IAM role, the region and the other parameters
+    """
+    role = strip_quotes(load_config().get('IAM_ROLE', 'ARN'))
+    return {'credentials': f"aws_iam_role={role}", 'region': 'us-west-2', **params}
 
 # DROP TABLES
 
 drop_table_queries = "DROP TABLE IF EXISTS "
 
+staging_events_raw_table_drop = drop_table_queries + "staging_events_raw"
+staging_songs_raw_table_drop = drop_table_queries + "staging_songs_raw"
 staging_events_table_drop = drop_table_queries + "staging_events"
 staging_songs_table_drop = drop_table_queries + "staging_songs"
 songplay_table_drop = drop_table_queries + "songplays"
@@ -19,163 +37,694 @@ artist_table_drop = drop_table_queries + "artists"
 time_table_drop = drop_table_queries + "times"
 
 # CREATE TABLES
+# The tables are declared with their physical design and rendered to CREATE statements by tables.py.
+# The files are copied to the raw staging tables, distributed EVEN so every slice loads its share of the rows. The
+# INSERT ... SELECT after the COPY computes song_key and moves the rows to the staging tables, which are distributed
+# on song_key, the column of the songplays join, so the join is collocated on the slices. A key that is NULL at COPY
+# time would put every row on the same slice.
+# The fact table and songs share song_id as distribution key, the small dimensions are copied to every node (ALL).
+# Sort key columns are left RAW, the other columns use AZ64 for numbers and timestamps and ZSTD or BYTEDICT for text.
+
+staging_events_columns = [
+    Column('artist', 'VARCHAR(100)', encode='ZSTD'),
+    Column('auth', 'VARCHAR(25)', encode='BYTEDICT'),
+    Column('firstName', 'VARCHAR(25)', encode='ZSTD'),
+    Column('gender', 'CHAR(1)', encode='BYTEDICT'),
+    Column('itemInSession', 'bigint', encode='AZ64'),
+    Column('lastName', 'VARCHAR(25)', encode='ZSTD'),
+    Column('length', 'FLOAT', encode='ZSTD'),
+    Column('level', 'VARCHAR(10)', encode='BYTEDICT'),
+    Column('location', 'VARCHAR(50)', encode='ZSTD'),
+    Column('method', 'VARCHAR(25)', encode='BYTEDICT'),
+    Column('page', 'VARCHAR(10)', encode='BYTEDICT'),
+    Column('registration', 'FLOAT', encode='ZSTD'),
+    Column('sessionId', 'bigint', encode='AZ64'),
+    Column('song', 'VARCHAR(100)', encode='RAW'),
+    Column('status', 'bigint', encode='AZ64'),
+    Column('ts', 'bigint', encode='AZ64'),
+    Column('userAgent', 'VARCHAR(255)', encode='ZSTD'),
+    Column('userId', 'VARCHAR(10)', encode='ZSTD'),
+]
+
+staging_songs_columns = [
+    Column('num_songs', 'bigint', 'NOT NULL', encode='AZ64'),
+    Column('artist_id', 'VARCHAR(18)', encode='ZSTD'),
+    Column('artist_latitude', 'FLOAT', encode='ZSTD'),
+    Column('artist_longitude', 'FLOAT', encode='ZSTD'),
+    Column('artist_location', 'VARCHAR(50)', encode='ZSTD'),
+    Column('artist_name', 'VARCHAR(100)', encode='ZSTD'),
+    Column('song_id', 'VARCHAR(18)', 'NOT NULL', encode='ZSTD'),
+    Column('title', 'VARCHAR(100)', encode='RAW'),
+    Column('duration', 'FLOAT', encode='ZSTD'),
+    Column('year', 'bigint', encode='AZ64'),
+]
+
+staging_events_raw_table = Table('staging_events_raw', staging_events_columns, diststyle='EVEN')
+staging_songs_raw_table = Table('staging_songs_raw', staging_songs_columns, diststyle='EVEN')
+
+staging_events_table = Table('staging_events', staging_events_columns + [
+    Column('song_key', 'BIGINT', encode='AZ64'),
+    Column('start_time', 'TIMESTAMP', encode='AZ64'),
+], distkey='song_key')
+
+staging_songs_table = Table('staging_songs', staging_songs_columns + [
+    Column('song_key', 'BIGINT', encode='AZ64'),
+], distkey='song_key')
+
+songplay_table = Table('songplays', [
+    Column('songplay_id', 'INT IDENTITY(0,1)', 'PRIMARY KEY', encode='AZ64'),
+    Column('start_time', 'TIMESTAMP', 'NOT NULL REFERENCES times(start_time)', encode='RAW'),
+    Column('user_id', 'VARCHAR(10)', 'NOT NULL REFERENCES users(user_id)', encode='ZSTD'),
+    Column('level', 'VARCHAR(10)', encode='BYTEDICT'),
+    Column('song_id', 'VARCHAR(18)', 'NOT NULL REFERENCES songs(song_id)', encode='ZSTD'),
+    Column('artist_id', 'VARCHAR(18)', 'NOT NULL REFERENCES artists(artist_id)', encode='ZSTD'),
+    Column('session_id', 'INTEGER', 'NOT NULL', encode='AZ64'),
+    Column('location', 'VARCHAR(50)', encode='ZSTD'),
+    Column('user_agent', 'VARCHAR(255)', encode='ZSTD'),
+], distkey='song_id', sortkey=['start_time'])
+
+user_table = Table('users', [
+    Column('user_id', 'VARCHAR(10)', 'PRIMARY KEY', encode='RAW'),
+    Column('first_name', 'VARCHAR(50)', encode='ZSTD'),
+    Column('last_name', 'VARCHAR(50)', encode='ZSTD'),
+    Column('gender', 'CHAR(1)', encode='BYTEDICT'),
+    Column('level', 'VARCHAR(10)', encode='BYTEDICT'),
+], diststyle='ALL', sortkey=['user_id'])
+
+song_table = Table('songs', [
+    Column('song_id', 'VARCHAR(18)', 'NOT NULL PRIMARY KEY', encode='RAW'),
+    Column('title', 'VARCHAR(100)', encode='ZSTD'),
+    Column('artist_id', 'VARCHAR(18)', 'NOT NULL', encode='ZSTD'),
+    Column('year', 'INTEGER', encode='AZ64'),
+    Column('duration', 'FLOAT', encode='ZSTD'),
+    Column('song_key', 'BIGINT', encode='AZ64'),
+], distkey='song_id', sortkey=['song_id'])
+
+artist_table = Table('artists', [
+    Column('artist_id', 'VARCHAR(18)', 'PRIMARY KEY', encode='RAW'),
+    Column('name', 'VARCHAR(100)', encode='ZSTD'),
+    Column('location', 'VARCHAR(50)', encode='ZSTD'),
+    Column('latitude', 'FLOAT', encode='ZSTD'),
+    Column('longitude', 'FLOAT', encode='ZSTD'),
+], diststyle='ALL', sortkey=['artist_id'])
+
+time_table = Table('times', [
+    Column('start_time', 'TIMESTAMP', 'PRIMARY KEY', encode='RAW'),
+    Column('hour', 'INT', 'NOT NULL', encode='AZ64'),
+    Column('day', 'INT', 'NOT NULL', encode='AZ64'),
+    Column('week', 'INT', 'NOT NULL', encode='AZ64'),
+    Column('month', 'INT', 'NOT NULL', encode='AZ64'),
+    Column('year', 'INT', 'NOT NULL', encode='AZ64'),
+    Column('weekday', 'INT', 'NOT NULL', encode='AZ64'),
+], diststyle='ALL', sortkey=['start_time'])
+
+star_schema_tables = {table.name: table for table in [staging_events_table, staging_songs_table, songplay_table,
+                                                      user_table, song_table, artist_table, time_table]}
+# Staging table -> raw table the files are copied to
+staging_raw_tables = {'staging_events': staging_events_raw_table, 'staging_songs': staging_songs_raw_table}
+
+staging_events_raw_table_create = staging_events_raw_table.create_statement()
+staging_songs_raw_table_create = staging_songs_raw_table.create_statement()
+staging_events_table_create = staging_events_table.create_statement()
+# The log files are copied with a JSONPaths file, the columns it maps to are listed explicitly
+staging_events_copy_columns = ', '.join(column.name for column in staging_events_columns)
+staging_songs_table_create = staging_songs_table.create_statement()
+songplay_table_create = songplay_table.create_statement()
+user_table_create = user_table.create_statement()
+song_table_create = song_table.create_statement()
+artist_table_create = artist_table.create_statement()
+time_table_create = time_table.create_statement()
 
-staging_events_table_create= "CREATE TABLE IF NOT EXISTS staging_events (" \
-                             "artist VARCHAR(100)," \
-                             "auth VARCHAR(25)," \
-                             "firstName VARCHAR(25)," \
-                             "gender CHAR(1)," \
-                             "itemInSession bigint  ," \
-                             "lastName VARCHAR(25)," \
-                             "length FLOAT," \
-                             "level VARCHAR(10)," \
-                             "location VARCHAR(50)," \
-                             "method VARCHAR(25)," \
-                             "page VARCHAR(10)," \
-                             "registration FLOAT," \
-                             "sessionId bigint ," \
-                             "song VARCHAR(100)," \
-                             "status bigint ," \
-                             "ts bigint ," \
-                             "userAgent VARCHAR(255)," \
-                             "userId VARCHAR(10))"
-
-staging_songs_table_create = "CREATE TABLE IF NOT EXISTS staging_songs (" \
-                             "num_songs bigint  NOT NULL," \
-                             "artist_id VARCHAR(18)," \
-                             "artist_latitude FLOAT," \
-                             "artist_longitude FLOAT," \
-                             "artist_location VARCHAR(50)," \
-                             "artist_name VARCHAR(100)," \
-                             "song_id VARCHAR(18) NOT NULL," \
-                             "title VARCHAR(100)," \
-                             "duration FLOAT," \
-                             "year bigint )"
-
-songplay_table_create = "CREATE TABLE IF NOT EXISTS songplays (" \
-                             "songplay_id INT IDENTITY(0,1) PRIMARY KEY ," \
-                             "start_time bigint  NOT NULL REFERENCES times(start_time)," \
-                             "user_id VARCHAR(10) NOT NULL REFERENCES users(user_id)," \
-                             "level VARCHAR(10)," \
-                             "song_id VARCHAR(18) NOT NULL REFERENCES songs(song_id)," \
-                             "artist_id VARCHAR(18) NOT NULL REFERENCES artists(artist_id)," \
-                             "session_id INTEGER NOT NULL," \
-                             "location VARCHAR(50)," \
-                             "user_agent VARCHAR(255))"
-
-user_table_create = """
-                    CREATE TABLE IF NOT EXISTS users (
-                        user_id VARCHAR(10)  PRIMARY KEY,
-                        first_name VARCHAR(50),
-                        last_name VARCHAR(50),
-                        gender CHAR(1),
-                        level VARCHAR(10)
-                    );
-                    """
-
-song_table_create = "CREATE TABLE IF NOT EXISTS songs (" \
-                             "song_id VARCHAR(18) NOT NULL PRIMARY KEY," \
-                             "title VARCHAR(100)," \
-                             "artist_id VARCHAR(18) NOT NULL," \
-                             "year INTEGER," \
-                             "duration FLOAT)"
-
-artist_table_create = "CREATE TABLE IF NOT EXISTS artists (" \
-                             "artist_id VARCHAR(18) PRIMARY KEY," \
-                             "name VARCHAR(100)," \
-                             "location VARCHAR(50)," \
-                             "latitude FLOAT," \
-                             "longitude FLOAT)"
-
-
-time_table_create = "CREATE TABLE IF NOT EXISTS times (" \
-                             "start_time TIMESTAMP PRIMARY KEY," \
-                             "hour INT NOT NULL ," \
-                             "day INT NOT NULL ," \
-                             "week INT NOT NULL ," \
-                             "month INT NOT NULL ," \
-                             "year INT NOT NULL ," \
-                             "weekday INT NOT NULL)"
 # STAGING TABLES
 # Data is copied from S3 to staging tables in Redshift. logs are partitioned by year and month.
 # example log_data/2018/11/2018-11-12-events.json
-staging_events_copy = """
-                        COPY staging_events FROM {} 
-                        CREDENTIALS 'aws_iam_role={}' 
-                        FORMAT AS JSON {} 
-                        REGION 'us-west-2';
-""".format(config.get('S3', 'LOG_DATA'), config.get('IAM_ROLE', 'ARN'), config.get('S3', 'LOG_JSONPATH'))
-
-staging_songs_copy = ("""
-                        COPY staging_songs FROM {} 
-                        CREDENTIALS 'aws_iam_role={}' 
+# The source, the JSONPaths file and the credentials are parameters, bind the source of a single file or manifest
+staging_events_json_copy = """
+                        COPY staging_events_raw ({}) FROM %(source)s 
+                        CREDENTIALS %(credentials)s 
+                        FORMAT AS JSON %(json_paths)s 
+                        REGION %(region)s;
+""".format(staging_events_copy_columns)
+
+staging_songs_json_copy = """
+                        COPY staging_songs_raw FROM %(source)s 
+                        CREDENTIALS %(credentials)s 
                         FORMAT AS JSON 'auto'
-                        REGION 'us-west-2';
-""").format(config.get('S3', 'SONG_DATA'), config.get('IAM_ROLE', 'ARN'))
+                        REGION %(region)s;
+"""
+
+# Bind the uri of a manifest written by manifest.py as source
+staging_events_manifest_json_copy = """
+                        COPY staging_events_raw ({}) FROM %(source)s 
+                        CREDENTIALS %(credentials)s 
+                        FORMAT AS JSON %(json_paths)s 
+                        MANIFEST
+                        REGION %(region)s;
+""".format(staging_events_copy_columns)
+
+staging_songs_manifest_json_copy = """
+                        COPY staging_songs_raw FROM %(source)s 
+                        CREDENTIALS %(credentials)s 
+                        FORMAT AS JSON 'auto'
+                        MANIFEST
+                        REGION %(region)s;
+"""
+
+# CONVERTED STAGING FILES
+# convert.py rewrites the JSON files to gzip compressed CSV or Parquet with the columns of the staging tables, which
+# Redshift parses and transfers much faster. Bind the uri of the converted files as source.
+staging_songs_copy_columns = ', '.join(column.name for column in staging_songs_columns)
+
+staging_events_csv_copy = """
+                        COPY staging_events_raw ({}) FROM %(source)s 
+                        CREDENTIALS %(credentials)s 
+                        FORMAT AS CSV NULL AS '\\N' GZIP 
+                        REGION %(region)s;
+""".format(staging_events_copy_columns)
+
+staging_songs_csv_copy = """
+                        COPY staging_songs_raw ({}) FROM %(source)s 
+                        CREDENTIALS %(credentials)s 
+                        FORMAT AS CSV NULL AS '\\N' GZIP 
+                        REGION %(region)s;
+""".format(staging_songs_copy_columns)
+
+# Parquet is matched on column position, the files hold every column of the raw table
+staging_events_parquet_copy = """
+                        COPY staging_events_raw FROM %(source)s 
+                        CREDENTIALS %(credentials)s 
+                        FORMAT AS PARQUET;
+"""
+
+staging_songs_parquet_copy = """
+                        COPY staging_songs_raw FROM %(source)s 
+                        CREDENTIALS %(credentials)s 
+                        FORMAT AS PARQUET;
+"""
+
+# SONG MATCH KEY
+# Songs in the logs are matched to the song data on title, artist name and duration rounded to seconds. The three
+# values are normalized and hashed once per row into a BIGINT, so the songplays join is a single compact equality.
+
+def song_key_expression(title, artist_name, duration):
+    """
+    SQL expression of the song match key
+    :param title: Column with the title of the song
+    :param artist_name: Column with the name of the artist
+    :param duration: Column with the duration of the song in seconds
+    :return: SQL expression returning a BIGINT, NULL when one of the values is NULL
+    """
+    return f"STRTOL(LEFT(MD5(UPPER(TRIM({title})) || '|' || UPPER(TRIM({artist_name})) || '|' || " \
+           f"CAST(ROUND({duration}) AS BIGINT)), 15), 16)"
+
+
+# The event timestamp is converted once per row as well, songplays and times share it as TIMESTAMP key.
+staging_events_start_time_expression = "TIMESTAMP 'epoch' + ts / 1000.0 * INTERVAL '1 second'"
+
+
+def derived_insert(table, derived_expressions):
+    """
+    Statements that move the copied rows from the raw table to the staging table with the derived columns computed
+    :param table: Staging Table, its columns are the columns of the raw table followed by the derived columns
+    :param derived_expressions: SQL expressions of the derived columns, in the order of the table
+    :return: List of statements: insert the rows, empty the raw table. DELETE instead of TRUNCATE, which would commit.
+    """
+    raw_table = staging_raw_tables[table.name]
+    raw_columns = ', '.join(column.name for column in raw_table.columns)
+    derived_columns = ', '.join(column.name for column in table.columns[len(raw_table.columns):])
+    return [f"INSERT INTO {table.name} ({raw_columns}, {derived_columns}) "
+            f"SELECT {raw_columns}, {', '.join(derived_expressions)} FROM {raw_table.name}",
+            f"DELETE FROM {raw_table.name}"]
+
+
+staging_events_derived_insert = derived_insert(staging_events_table,
+                                               [song_key_expression('song', 'artist', 'length'),
+                                                staging_events_start_time_expression])
+
+staging_songs_song_key_insert = derived_insert(staging_songs_table,
+                                               [song_key_expression('title', 'artist_name', 'duration')])
 
 # FINAL TABLES
 
-songplay_table_insert = "INSERT INTO songplays " \
-                        "(start_time, user_id, level, " \
-                        "song_id, artist_id,session_id, location, user_agent) " \
-                        "SELECT se.ts AS start_time," \
-                        "se.userId AS user_id, " \
-                        "se.level AS level, " \
-                        "ss.song_id AS song_id," \
-                        "ss.artist_id AS artist_id," \
-                        "se.sessionId AS session_id," \
-                        "se.location AS location, " \
-                        "se.userAgent AS user_agent " \
-                        "FROM staging_events se " \
-                        "JOIN staging_songs ss " \
-                        "ON ss.title = se.song" \
-
-user_table_insert = "INSERT INTO users (user_id, first_name, last_name, gender, level) " \
-                    "SELECT DISTINCT userId AS user_id, " \
-                    "firstName as first_name, " \
-                    "lastName as last_name," \
-                    "gender, " \
-                    "level " \
-                    "FROM staging_events" \
-
-song_table_insert = "INSERT INTO songs (song_id, title, artist_id, year, duration) " \
-                    "SELECT DISTINCT song_id, " \
-                    "title," \
-                    "artist_id," \
-                    "year," \
-                    "duration " \
-                    "FROM staging_songs"
-
-artist_table_insert = "INSERT INTO artists (artist_id, name, location, latitude, longitude) " \
-                      "SELECT DISTINCT artist_id, " \
-                      "artist_name, " \
-                      "artist_location, " \
-                      "artist_latitude, " \
-                      "artist_longitude " \
-                      "FROM staging_songs" \
+songplay_insert_template = "INSERT INTO songplays " \
+                           "(start_time, user_id, level, " \
+                           "song_id, artist_id,session_id, location, user_agent) " \
+                           "SELECT se.start_time AS start_time," \
+                           "se.userId AS user_id, " \
+                           "se.level AS level, " \
+                           "ss.song_id AS song_id," \
+                           "ss.artist_id AS artist_id," \
+                           "se.sessionId AS session_id," \
+                           "se.location AS location, " \
+                           "se.userAgent AS user_agent " \
+                           "FROM staging_events se " \
+                           "JOIN (SELECT song_key, song_id, artist_id, " \
+                           "ROW_NUMBER() OVER (PARTITION BY song_key ORDER BY song_id) AS song_rank " \
+                           "FROM {}) ss " \
+                           "ON ss.song_key = se.song_key " \
+                           "AND ss.song_rank = 1"
+
+# A full load matches the plays to the songs of this run. The later runs match them to the songs dimension: the
+# staging table only holds the songs of the current run, which are only the new and changed songs when they were
+# pre-filtered (prefilter.py), so a new play of a song loaded before would find no match there. The dimension keeps
+# the song_key computed from the artist name of the song record, the name in artists is the latest name of the artist
+# and would not match the plays of songs released under another name.
+songplay_table_insert = songplay_insert_template.format("staging_songs")
+
+dimension_songs_select = "(SELECT song_key, song_id, artist_id FROM songs) ds"
+
+# The dimensions hold one row per key. When a key has several versions in staging, the latest record wins: the last
+# event (ts) of a user, the most recent release year of a song and of an artist.
+latest_users_select = "SELECT user_id, first_name, last_name, gender, level " \
+                      "FROM (SELECT userId AS user_id, " \
+                      "firstName AS first_name, " \
+                      "lastName AS last_name, " \
+                      "gender, " \
+                      "level, " \
+                      "ROW_NUMBER() OVER (PARTITION BY userId ORDER BY ts DESC) AS user_rank " \
+                      "FROM staging_events " \
+                      "WHERE userId IS NOT NULL) latest_users " \
+                      "WHERE user_rank = 1"
 
+latest_songs_select = "SELECT song_id, title, artist_id, year, duration, song_key " \
+                      "FROM (SELECT song_id, " \
+                      "title, " \
+                      "artist_id, " \
+                      "year, " \
+                      "duration, " \
+                      "song_key, " \
+                      "ROW_NUMBER() OVER (PARTITION BY song_id ORDER BY year DESC, title, duration, song_key) " \
+                      "AS song_rank " \
+                      "FROM staging_songs) latest_songs " \
+                      "WHERE song_rank = 1"
+
+latest_artists_select = "SELECT artist_id, name, location, latitude, longitude " \
+                        "FROM (SELECT artist_id, " \
+                        "artist_name AS name, " \
+                        "artist_location AS location, " \
+                        "artist_latitude AS latitude, " \
+                        "artist_longitude AS longitude, " \
+                        "ROW_NUMBER() OVER (PARTITION BY artist_id " \
+                        "ORDER BY year DESC, artist_name, artist_location) AS artist_rank " \
+                        "FROM staging_songs " \
+                        "WHERE artist_id IS NOT NULL) latest_artists " \
+                        "WHERE artist_rank = 1"
+
+user_table_insert = "INSERT INTO users (user_id, first_name, last_name, gender, level) " + latest_users_select
+
+song_table_insert = "INSERT INTO songs (song_id, title, artist_id, year, duration, song_key) " + latest_songs_select
+
+artist_table_insert = "INSERT INTO artists (artist_id, name, location, latitude, longitude) " + latest_artists_select
+
+# Only timestamps that are not in times yet are inserted, the parts are extracted once per new timestamp
 time_table_insert = "INSERT INTO times (start_time, hour, day, week, month, year, weekday) " \
-                    "SELECT DISTINCT " \
-                    "TIMESTAMP 'epoch' + ts * INTERVAL '1 second' AS start_time, " \
-                    "EXTRACT(hour FROM TIMESTAMP 'epoch' + ts * INTERVAL '1 second') AS hour, " \
-                    "EXTRACT(day FROM TIMESTAMP 'epoch' + ts * INTERVAL '1 second') AS day, " \
-                    "EXTRACT(week FROM TIMESTAMP 'epoch' + ts * INTERVAL '1 second') AS week," \
-                    "EXTRACT(month FROM TIMESTAMP 'epoch' + ts * INTERVAL '1 second') AS month, " \
-                    "EXTRACT(year FROM TIMESTAMP 'epoch' + ts * INTERVAL '1 second') AS year, " \
-                    "EXTRACT(DOW FROM TIMESTAMP 'epoch' + ts * INTERVAL '1 second') AS weekday " \
-                    "FROM staging_events"
+                    "SELECT start_time, " \
+                    "EXTRACT(hour FROM start_time) AS hour, " \
+                    "EXTRACT(day FROM start_time) AS day, " \
+                    "EXTRACT(week FROM start_time) AS week, " \
+                    "EXTRACT(month FROM start_time) AS month, " \
+                    "EXTRACT(year FROM start_time) AS year, " \
+                    "EXTRACT(DOW FROM start_time) AS weekday " \
+                    "FROM (SELECT DISTINCT se.start_time " \
+                    "FROM staging_events se " \
+                    "WHERE se.start_time IS NOT NULL " \
+                    "AND NOT EXISTS (SELECT 1 FROM times t WHERE t.start_time = se.start_time)) new_times"
+
+# INCREMENTAL LOADING
+# The control table keeps a watermark per log partition (YYYY/MM): the last log file that has been loaded. Only files
+# after the watermark are copied, staging_events then only holds the new events.
+
+load_watermarks_table = Table('load_watermarks', [
+    Column('partition_key', 'VARCHAR(7)', 'NOT NULL PRIMARY KEY'),
+    Column('last_object', 'VARCHAR(256)', 'NOT NULL'),
+    Column('loaded_at', 'TIMESTAMP', 'NOT NULL DEFAULT GETDATE()'),
+], diststyle='ALL')
+
+load_watermarks_table_create = load_watermarks_table.create_statement()
+
+load_watermarks_select = "SELECT partition_key, last_object FROM load_watermarks"
+
+load_watermark_delete = "DELETE FROM load_watermarks WHERE partition_key = %s"
+
+load_watermark_insert = "INSERT INTO load_watermarks (partition_key, last_object) VALUES (%s, %s)"
+
+staging_events_truncate = "TRUNCATE staging_events"
+
+# CHECKPOINTS
+# One row per committed stage of the full load, inserted in the transaction of the stage. The fingerprint covers the
+# statements and inputs of the stage and of the stages before it, a rerun resumes at the stages that are missing.
+load_stages_table = Table('load_stages', [
+    Column('stage', 'VARCHAR(64)', 'NOT NULL PRIMARY KEY'),
+    Column('fingerprint', 'VARCHAR(32)', 'NOT NULL'),
+    Column('completed_at', 'TIMESTAMP', 'NOT NULL DEFAULT GETDATE()'),
+], diststyle='ALL')
+
+load_stages_table_create = load_stages_table.create_statement()
+
+load_stages_select = "SELECT stage, fingerprint FROM load_stages"
+
+load_stage_insert = "INSERT INTO load_stages (stage, fingerprint) VALUES (%(stage)s, %(fingerprint)s)"
+
+load_stages_delete = "DELETE FROM load_stages"
+
+songplay_table_insert_incremental = songplay_insert_template.format(dimension_songs_select) + " " \
+                        "WHERE NOT EXISTS (SELECT 1 FROM songplays sp " \
+                        "WHERE sp.start_time = se.start_time " \
+                        "AND sp.user_id = se.userId " \
+                        "AND sp.session_id = se.sessionId)"
+
+
+# time_table_insert only inserts new timestamps already
+time_table_insert_incremental = time_table_insert
+
+# MERGE
+# The dimensions are kept across runs and upserted from staging instead of rebuilt. Only the keys that are new or
+# have changed are collected in a temporary table, deleted from the dimension and inserted again. The statements of a
+# merge run in one transaction, so readers see the dimension before or after the merge, never in between.
+
+def merge_queries(table, latest_select):
+    """
+    Statements that upsert the latest version of every changed key into a dimension
+    :param table: Dimension Table, the first column is the key
+    :param latest_select: SELECT statement returning one row per key with the columns of the table
+    :return: List of statements: collect the changes, delete the changed keys, insert the changes, drop the changes
+    """
+    columns = [column.name for column in table.columns]
+    key = columns[0]
+    changes = f"{table.name}_changes"
+    unchanged = ' AND '.join(f"(d.{column} = l.{column} OR (d.{column} IS NULL AND l.{column} IS NULL))"
+                             for column in columns)
+
+    return [f"CREATE TEMP TABLE {changes} AS "
+            f"SELECT {', '.join(f'l.{column}' for column in columns)} "
+            f"FROM ({latest_select}) l "
+            f"WHERE NOT EXISTS (SELECT 1 FROM {table.name} d WHERE {unchanged})",
+            f"DELETE FROM {table.name} WHERE {key} IN (SELECT {key} FROM {changes})",
+            f"INSERT INTO {table.name} ({', '.join(columns)}) SELECT {', '.join(columns)} FROM {changes}",
+            f"DROP TABLE {changes}"]
+
+
+user_table_merge = merge_queries(user_table, latest_users_select)
+song_table_merge = merge_queries(song_table, latest_songs_select)
+artist_table_merge = merge_queries(artist_table, latest_artists_select)
+
+staging_songs_truncate = "TRUNCATE staging_songs"
+
+# ANALYTIC QUERIES
+# Typical questions asked of the star schema. Their plans are checked by plans.py next to the insert statements.
+analytic_queries = {
+    'songplays_per_hour': "SELECT t.hour, COUNT(*) AS songplays "
+                          "FROM songplays sp "
+                          "JOIN times t ON t.start_time = sp.start_time "
+                          "GROUP BY t.hour "
+                          "ORDER BY t.hour",
+    'top_songs': "SELECT s.title, a.name, COUNT(*) AS songplays "
+                 "FROM songplays sp "
+                 "JOIN songs s ON s.song_id = sp.song_id "
+                 "JOIN artists a ON a.artist_id = sp.artist_id "
+                 "GROUP BY s.title, a.name "
+                 "ORDER BY songplays DESC "
+                 "LIMIT 10",
+    'songplays_per_level': "SELECT u.level, COUNT(*) AS songplays "
+                           "FROM songplays sp "
+                           "JOIN users u ON u.user_id = sp.user_id "
+                           "GROUP BY u.level",
+}
+
+# ANALYTICS
+# Common aggregates of the star schema kept as materialized views. They only use GROUP BY, inner joins and COUNT, so
+# Redshift refreshes them incrementally from the changed rows of the base tables. analytics.py reads them through a
+# local result cache, the views do the heavy part and the reads only join the small dimensions or sum a few rows.
+materialized_views = {
+    'mv_songplays_per_hour': "SELECT t.hour, COUNT(*) AS songplays "
+                             "FROM songplays sp "
+                             "JOIN times t ON t.start_time = sp.start_time "
+                             "GROUP BY t.hour",
+    'mv_song_plays': "SELECT sp.song_id, sp.artist_id, COUNT(*) AS songplays "
+                     "FROM songplays sp "
+                     "GROUP BY sp.song_id, sp.artist_id",
+    'mv_user_level_plays': "SELECT sp.user_id, sp.level, COUNT(*) AS songplays "
+                           "FROM songplays sp "
+                           "GROUP BY sp.user_id, sp.level",
+}
+
+materialized_view_create = "CREATE MATERIALIZED VIEW {} AUTO REFRESH NO AS {}"
+
+materialized_view_refresh = "REFRESH MATERIALIZED VIEW {}"
+
+materialized_view_drop = "DROP MATERIALIZED VIEW IF EXISTS {}"
+
+materialized_views_select = "SELECT name FROM svv_mv_info WHERE schema_name = current_schema()"
+
+materialized_view_drop_queries = [materialized_view_drop.format(name) for name in materialized_views]
+
+analytics_reads = {
+    'songplays_per_hour': "SELECT hour, songplays FROM mv_songplays_per_hour ORDER BY hour",
+    'top_songs': "SELECT s.title, a.name, SUM(mv.songplays) AS songplays "
+                 "FROM mv_song_plays mv "
+                 "JOIN songs s ON s.song_id = mv.song_id "
+                 "JOIN artists a ON a.artist_id = mv.artist_id "
+                 "GROUP BY s.title, a.name "
+                 "ORDER BY songplays DESC "
+                 "LIMIT %(limit)s",
+    'active_users_per_level': "SELECT level, COUNT(*) AS active_users, SUM(songplays) AS songplays "
+                              "FROM mv_user_level_plays "
+                              "GROUP BY level "
+                              "ORDER BY level",
+}
+
+# The watermark moves with every refresh of the views, the result cache of analytics.py is dropped when it moves
+analytics_watermark_table = Table('analytics_watermark', [
+    Column('refreshed_at', 'TIMESTAMP', 'NOT NULL'),
+], diststyle='ALL')
+
+analytics_watermark_table_create = analytics_watermark_table.create_statement()
+
+analytics_watermark_select = "SELECT MAX(refreshed_at) FROM analytics_watermark"
+
+analytics_watermark_update = ["DELETE FROM analytics_watermark",
+                              "INSERT INTO analytics_watermark (refreshed_at) VALUES (GETDATE())"]
+
+# EXPORT
+# The star schema is unloaded to S3 as Parquet for the downstream teams, see export.py. Every slice writes its own
+# files (PARALLEL ON) of at most MAXFILESIZE MB. songplays and times are partitioned by the year and month of times,
+# the files of a partition are written under <table>/year=YYYY/month=MM/. The select is bound as a string literal.
+# CLEANPATH empties the prefix first, so listing it afterwards gives exactly the unloaded files. The MANIFEST option
+# is not used, it would write a file that is not Parquet into the data directories.
+export_unload = """
+                        UNLOAD (%(select)s)
+                        TO %(target)s
+                        CREDENTIALS %(credentials)s
+                        FORMAT AS PARQUET
+                        {}PARALLEL ON
+                        MAXFILESIZE %(max_file_size)s MB
+                        CLEANPATH
+                        REGION %(region)s;
+"""
+
+export_table_unload = export_unload.format('')
+export_partitioned_unload = export_unload.format('PARTITION BY (year, month)\n                        ')
+
+export_partition_columns = ('year', 'month')
+
+export_selects = {
+    'songplays': "SELECT {}, t.year, t.month "
+                 "FROM songplays sp "
+                 "JOIN times t ON t.start_time = sp.start_time".format(
+                     ', '.join('sp.' + column.name for column in songplay_table.columns)),
+    'times': "SELECT {} FROM times".format(', '.join(column.name for column in time_table.columns)),
+    'users': "SELECT {} FROM users".format(', '.join(column.name for column in user_table.columns)),
+    'songs': "SELECT {} FROM songs".format(', '.join(column.name for column in song_table.columns)),
+    'artists': "SELECT {} FROM artists".format(', '.join(column.name for column in artist_table.columns)),
+}
+
+export_partitioned_tables = ('songplays', 'times')
+
+# Rows per partition, a partition is exported again when its number of rows changed. Both tables are only
+# appended to, so new rows always change the count.
+export_partition_counts_select = "SELECT year, month, COUNT(*) FROM ({}) export GROUP BY year, month"
+
+export_count_select = "SELECT COUNT(*) FROM ({}) export"
+
+
+def export_partition_select(table, year, month):
+    """
+    Rows of one partition of an exported table, without the partition columns as PARTITION BY leaves them out too
+    :param table: Name of a table in export_partitioned_tables
+    :param year: Year of the partition
+    :param month: Month of the partition
+    :return: SELECT statement
+    """
+    table_columns = [column.name for column in star_schema_tables[table].columns
+                     if column.name not in export_partition_columns]
+    return "SELECT {} FROM ({}) export WHERE year = {:d} AND month = {:d}".format(
+        ', '.join(table_columns), export_selects[table], year, month)
+
+# DATA QUALITY
+# NOT NULL, PRIMARY KEY and REFERENCES are checked as declared on the tables. These value rules are checked on top,
+# see quality.py. A range is (minimum, maximum), None leaves that side open.
+value_ranges = {
+    'times': {'hour': (0, 23), 'day': (1, 31), 'week': (1, 53), 'month': (1, 12), 'year': (1970, 2100),
+              'weekday': (0, 6)},
+    'songs': {'year': (0, 2100), 'duration': (0, None)},
+    'artists': {'latitude': (-90, 90), 'longitude': (-180, 180)},
+}
+
+accepted_values = {
+    'users': {'level': ('free', 'paid'), 'gender': ('F', 'M')},
+    'songplays': {'level': ('free', 'paid')},
+}
+
+# TABLE STATISTICS
+# Row count, size in MB, the unsorted and stats off percentages and the row count including the rows marked as
+# deleted of the pipeline tables in one catalog query. SVV_TABLE_INFO has no rows for empty tables, these are reported
+# with 0 rows.
+
+table_info_select = "SELECT \"table\", estimated_visible_rows, size, unsorted, stats_off, tbl_rows " \
+                    "FROM svv_table_info " \
+                    "WHERE \"schema\" = current_schema() " \
+                    "AND \"table\" IN %s"
+
+
+def exact_count_select(tables):
+    """
+    Exact row counts of several tables in one statement
+    :param tables: List of table names
+    :return: SELECT statement returning (table name, row count) per table
+    """
+    return " UNION ALL ".join(f"SELECT '{table}', COUNT(*) FROM {table}" for table in tables)
+
 
 # QUERY LISTS
 
-create_table_queries = [staging_events_table_create, staging_songs_table_create, user_table_create, song_table_create,
-                        artist_table_create, time_table_create, songplay_table_create]
+pipeline_tables = ['staging_events', 'staging_songs', 'songplays', 'users', 'songs', 'artists', 'times']
 
-drop_table_queries = [staging_events_table_drop, staging_songs_table_drop,
-                      songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop]
+create_table_queries = [staging_events_raw_table_create, staging_songs_raw_table_create, staging_events_table_create,
+                        staging_songs_table_create, user_table_create, song_table_create, artist_table_create,
+                        time_table_create, songplay_table_create]
 
-copy_table_queries = [staging_events_copy, staging_songs_copy]
+drop_table_queries = materialized_view_drop_queries + [staging_events_raw_table_drop, staging_songs_raw_table_drop,
+                                                       staging_events_table_drop, staging_songs_table_drop,
+                                                       songplay_table_drop, user_table_drop, song_table_drop,
+                                                       artist_table_drop, time_table_drop]
+
+control_table_queries = [load_watermarks_table_create, load_stages_table_create, analytics_watermark_table_create]
+
+incremental_insert_table_queries = user_table_merge + [time_table_insert_incremental,
+                                                      songplay_table_insert_incremental]
 # staging_events_copy, staging_songs_copy
 insert_table_queries = [user_table_insert, song_table_insert, artist_table_insert,
                         time_table_insert, songplay_table_insert]
 
+# The tables without foreign keys are created and dropped at the same time, songplays references the dimensions so it
+# is created after and dropped before them. The materialized views on songplays and times are dropped first.
+create_stage_graph = {
+    'staging_events': ([staging_events_raw_table_create, staging_events_table_create], []),
+    'staging_songs': ([staging_songs_raw_table_create, staging_songs_table_create], []),
+    'users': (user_table_create, []),
+    'songs': (song_table_create, []),
+    'artists': (artist_table_create, []),
+    'times': (time_table_create, []),
+    'songplays': (songplay_table_create, ['users', 'songs', 'artists', 'times']),
+}
+
+drop_stage_graph = {
+    'materialized_views': (materialized_view_drop_queries, []),
+    'staging_events': ([staging_events_raw_table_drop, staging_events_table_drop], []),
+    'staging_songs': ([staging_songs_raw_table_drop, staging_songs_table_drop], []),
+    'songplays': (songplay_table_drop, ['materialized_views']),
+    'users': (user_table_drop, ['songplays']),
+    'songs': (song_table_drop, ['songplays']),
+    'artists': (artist_table_drop, ['songplays']),
+    'times': (time_table_drop, ['songplays']),
+}
+
+# CONFIGURED STATEMENTS
+# Built on first use from the dwh.cfg file, importing this module does not read the configuration. The statements are
+# attributes of the module like the others, e.g. from sql_queries import load_stage_graph.
+
+@configured_queries.register
+def build_staging_events_copy():
+    return Query(staging_events_json_copy, copy_parameters(source=s3_path('LOG_DATA'),
+                                                           json_paths=s3_path('LOG_JSONPATH')))
+
+
+@configured_queries.register
+def build_staging_songs_copy():
+    return Query(staging_songs_json_copy, copy_parameters(source=s3_path('SONG_DATA')))
+
+
+@configured_queries.register
+def build_staging_events_file_copy():
+    # Bind the uri of a single log file as source
+    return Query(staging_events_json_copy, copy_parameters(json_paths=s3_path('LOG_JSONPATH')))
+
+
+@configured_queries.register
+def build_staging_events_manifest_copy():
+    return Query(staging_events_manifest_json_copy, copy_parameters(json_paths=s3_path('LOG_JSONPATH')))
+
+
+@configured_queries.register
+def build_staging_songs_manifest_copy():
+    return Query(staging_songs_manifest_json_copy, copy_parameters())
+
+
+@configured_queries.register
+def build_converted_copy_queries():
+    return {
+        'csv': {'staging_events': Query(staging_events_csv_copy, copy_parameters()),
+                'staging_songs': Query(staging_songs_csv_copy, copy_parameters())},
+        'parquet': {'staging_events': Query(staging_events_parquet_copy, copy_parameters()),
+                    'staging_songs': Query(staging_songs_parquet_copy, copy_parameters())},
+    }
+
+
+@configured_queries.register
+def build_copy_table_queries():
+    return [configured_queries.get('staging_events_copy')] + staging_events_derived_insert + \
+        [configured_queries.get('staging_songs_copy')] + staging_songs_song_key_insert
+
+
+@configured_queries.register
+def build_load_stage_graph():
+    # Stage name -> (query, stages that have to be committed first). Both COPY statements are independent, the
+    # dimensions only need their staging table and the fact table is inserted last.
+    return {
+        'staging_events': ([configured_queries.get('staging_events_copy')] + staging_events_derived_insert, []),
+        'staging_songs': ([configured_queries.get('staging_songs_copy')] + staging_songs_song_key_insert, []),
+        'users': (user_table_insert, ['staging_events']),
+        'songs': (song_table_insert, ['staging_songs']),
+        'artists': (artist_table_insert, ['staging_songs']),
+        'times': (time_table_insert, ['staging_events']),
+        'songplays': (songplay_table_insert,
+                      ['staging_events', 'staging_songs', 'users', 'songs', 'artists', 'times']),
+    }
+
+
+@configured_queries.register
+def build_merge_stage_graph():
+    # Merge mode keeps the tables: both staging tables are reloaded, the dimensions are merged and only new facts and
+    # timestamps are inserted
+    return {
+        'truncate_staging': ([staging_events_truncate, staging_songs_truncate], []),
+        'staging_events': ([configured_queries.get('staging_events_copy')] + staging_events_derived_insert,
+                           ['truncate_staging']),
+        'staging_songs': ([configured_queries.get('staging_songs_copy')] + staging_songs_song_key_insert,
+                          ['truncate_staging']),
+        'users': (user_table_merge, ['staging_events']),
+        'songs': (song_table_merge, ['staging_songs']),
+        'artists': (artist_table_merge, ['staging_songs']),
+        'times': (time_table_insert, ['staging_events']),
+        'songplays': (songplay_table_insert_incremental,
+                      ['staging_events', 'staging_songs', 'users', 'songs', 'artists', 'times']),
+    }
+
+
+def __getattr__(name):
+    # PEP 562, called for the names that are not defined above
+    if name in configured_queries:
+        return configured_queries.get(name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 #
\ No newline at end of file
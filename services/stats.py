@@ -0,0 +1,111 @@
+import hashlib
+
+from sql_queries import exact_count_select, pipeline_tables, table_info_select
+from instrumentation import execute, execute_prepared
+from async_scheduler import count_tables_async, run_async
+
+
+def parse_table_info(rows, tables):
+    """
+    Statistics per table from the rows of table_info_select, also used for catalog rows recorded earlier
+    :param rows: Rows of (table, estimated_visible_rows, size, unsorted, stats_off, tbl_rows)
+    :param tables: Names of the tables, tables without a row are empty
+    :return: Dictionary with table name -> dictionary with rows, size_mb, unsorted, stats_off and deleted (percent of
+    the stored rows that are marked as deleted)
+    """
+    details = {table: {'rows': 0, 'size_mb': 0, 'unsorted': None, 'stats_off': None, 'deleted': 0.0}
+               for table in tables}
+    for table, rows_visible, size_mb, unsorted, stats_off, rows_stored in rows:
+        rows_visible, rows_stored = int(rows_visible or 0), int(rows_stored or 0)
+        details[table.strip()] = {'rows': rows_visible, 'size_mb': int(size_mb or 0),
+                                  'unsorted': None if unsorted is None else float(unsorted),
+                                  'stats_off': None if stats_off is None else float(stats_off),
+                                  'deleted': round(100.0 * max(rows_stored - rows_visible, 0) / rows_stored, 2)
+                                  if rows_stored else 0.0}
+    return details
+
+
+class TableStats:
+    """
+    Statistics of the pipeline tables. All tables are fetched in a single round trip and the result is cached for
+    the run, call invalidate after the tables have been loaded.
+    """
+
+    def __init__(self, pool, tables=None, exact=True, prepared=False, backend='threads', workers=4):
+        """
+        Initialize the table statistics
+        :param pool: Connection pool to the Redshift cluster
+        :param tables: Names of the tables, the pipeline tables when not given
+        :param exact: Count the rows with one UNION ALL of COUNT(*) statements. Otherwise the row counts are taken
+        from the SVV_TABLE_INFO catalog view, which does not scan the tables but is an estimate.
+        :param prepared: Run the exact counts as a prepared statement, it is planned once per connection instead of
+        on every refresh. The tables have to exist before the first count.
+        :param backend: threads or asyncio. The asyncio backend runs the exact counts as one COUNT(*) per table, at the
+        same time on separate connections of the pool.
+        :param workers: Number of tables counted at the same time by the asyncio backend
+        """
+        self.pool = pool
+        self.tables = list(tables or pipeline_tables)
+        self.exact = exact
+        self.prepared = prepared
+        self.backend = backend
+        self.workers = workers
+
+        self.queries = 0
+        self._counts = None
+        self._details = None
+
+    def _fetchall(self, query, params=None):
+        self.queries += 1
+        with self.pool.session() as conn:
+            cur = conn.cursor()
+            execute(cur, query, params)
+            return cur.fetchall()
+
+    def _fetchall_prepared(self, query):
+        self.queries += 1
+        name = f"counts_{hashlib.md5(query.encode()).hexdigest()[:8]}"
+        with self.pool.session() as conn:
+            cur = conn.cursor()
+            execute_prepared(cur, self.pool.prepared(conn), name, query)
+            return cur.fetchall()
+
+    def details(self, refresh=False):
+        """
+        Row count, size and health of every table from the SVV_TABLE_INFO catalog view
+        :param refresh: Fetch the statistics again instead of using the cache
+        :return: Dictionary with table name -> dictionary with rows, size_mb, unsorted, stats_off and deleted
+        """
+        if self._details is None or refresh:
+            self._details = parse_table_info(self._fetchall(table_info_select, (tuple(self.tables),)), self.tables)
+
+        return self._details
+
+    def counts(self, refresh=False):
+        """
+        Number of records per table, as returned by check_existing_data: the staging_songs count decides whether the
+        incremental load loads the song data, the refreshed counts after the load are printed and feed the sizing
+        history
+        :param refresh: Fetch the counts again instead of using the cache
+        :return: Dictionary with table name -> number of records
+        """
+        if self._counts is None or refresh:
+            if self.exact and self.backend == 'asyncio':
+                self.queries += len(self.tables)
+                counts = run_async(count_tables_async(self.pool, self.tables, self.workers))
+            elif self.exact:
+                fetchall = self._fetchall_prepared if self.prepared else self._fetchall
+                counts = {table: int(count) for table, count in fetchall(exact_count_select(self.tables))}
+            else:
+                counts = {table: detail['rows'] for table, detail in self.details(refresh).items()}
+            self._counts = {table: counts.get(table, 0) for table in self.tables}
+
+        return dict(self._counts)
+
+    def invalidate(self):
+        """
+        Drop the cached statistics, e.g. after data has been loaded
+        :return: Not applicable
+        """
+        self._counts = None
+        self._details = None
@@ -0,0 +1,294 @@
+import re
+
+DISTSTYLES = ('AUTO', 'EVEN', 'KEY', 'ALL')
+SORTKEY_STYLES = ('COMPOUND', 'INTERLEAVED')
+ENCODINGS = ('RAW', 'AZ64', 'BYTEDICT', 'DELTA', 'DELTA32K', 'LZO', 'MOSTLY8', 'MOSTLY16', 'MOSTLY32', 'RUNLENGTH',
+             'TEXT255', 'TEXT32K', 'ZSTD')
+
+
+class Column:
+    """
+    Column of a table with its type, constraints and compression encoding
+    """
+
+    def __init__(self, name, data_type, constraints='', encode=None):
+        """
+        Initialize the column
+        :param name: Name of the column
+        :param data_type: Redshift data type, e.g. VARCHAR(18)
+        :param constraints: Constraints written after the type, e.g. NOT NULL PRIMARY KEY
+        :param encode: Compression encoding of the column, Redshift picks one when not given
+        """
+        if encode is not None and encode.upper() not in ENCODINGS:
+            raise ValueError(f"Unknown encoding '{encode}' for column '{name}'")
+
+        self.name = name
+        self.data_type = data_type
+        self.constraints = constraints
+        self.encode = encode.upper() if encode else None
+
+    def definition(self):
+        """
+        Render the column for a CREATE TABLE statement
+        :return: Column definition, e.g. song_id VARCHAR(18) NOT NULL ENCODE ZSTD
+        """
+        parts = [self.name, self.data_type]
+        if self.constraints:
+            parts.append(self.constraints)
+        if self.encode:
+            parts.append(f"ENCODE {self.encode}")
+        return ' '.join(parts)
+
+
+class Table:
+    """
+    Table with its columns and physical design: distribution style, distribution key and sort key
+    """
+
+    def __init__(self, name, columns, diststyle=None, distkey=None, sortkey=None, sortkey_style='COMPOUND'):
+        """
+        Initialize the table and check that the physical design refers to its own columns
+        :param name: Name of the table
+        :param columns: List of Column
+        :param diststyle: AUTO, EVEN, KEY or ALL. KEY is used when only a distkey is given.
+        :param distkey: Name of the distribution key column
+        :param sortkey: List of sort key column names
+        :param sortkey_style: COMPOUND or INTERLEAVED
+        """
+        self.name = name
+        self.columns = columns
+        self.distkey = distkey
+        self.sortkey = list(sortkey or [])
+        self.sortkey_style = sortkey_style.upper()
+        self.diststyle = diststyle.upper() if diststyle else ('KEY' if distkey else None)
+
+        column_names = [column.name for column in columns]
+        if self.diststyle is not None and self.diststyle not in DISTSTYLES:
+            raise ValueError(f"Unknown diststyle '{diststyle}' for table '{name}'")
+        if self.sortkey_style not in SORTKEY_STYLES:
+            raise ValueError(f"Unknown sortkey style '{sortkey_style}' for table '{name}'")
+        if (self.diststyle == 'KEY') != (distkey is not None):
+            raise ValueError(f"Table '{name}' needs a distkey exactly when its diststyle is KEY")
+        for key in ([distkey] if distkey else []) + self.sortkey:
+            if key not in column_names:
+                raise ValueError(f"Key column '{key}' is not a column of table '{name}'")
+
+    def create_statement(self):
+        """
+        Render the CREATE TABLE statement
+        :return: CREATE TABLE IF NOT EXISTS statement with the physical design of the table
+        """
+        statement = f"CREATE TABLE IF NOT EXISTS {self.name} (" \
+                    f"{', '.join(column.definition() for column in self.columns)})"
+        if self.diststyle:
+            statement += f" DISTSTYLE {self.diststyle}"
+        if self.distkey:
+            statement += f" DISTKEY({self.distkey})"
+        if self.sortkey:
+            statement += f" {self.sortkey_style} SORTKEY({', '.join(self.sortkey)})"
+        return statement
+
+    def drop_statement(self):
+        """
+        Render the DROP TABLE statement
+        :return: DROP TABLE IF EXISTS statement
+        """
+        return f"DROP TABLE IF EXISTS {self.name}"
+
+
+# Table references and join conditions in the INSERT ... SELECT statements
+TABLE_REFERENCE = re.compile(r'\b(?:FROM|JOIN)\s+(\w+)(?:\s+(?:AS\s+)?(?!ON\b|WHERE\b|JOIN\b)(\w+))?', re.IGNORECASE)
+JOIN_CONDITION = re.compile(r'\bON\s+(\w+)\.(\w+)\s*=\s*(\w+)\.(\w+)', re.IGNORECASE)
+# Subquery in a FROM or JOIN clause, e.g. JOIN (SELECT song_key, song_id FROM staging_songs) ss
+DERIVED_TABLE = re.compile(r'\b(?:FROM|JOIN)\s*\(\s*SELECT\b', re.IGNORECASE)
+DERIVED_ALIAS = re.compile(r'\s*(?:AS\s+)?(?!ON\b|WHERE\b|JOIN\b|AND\b|OR\b)(\w+)', re.IGNORECASE)
+# Plain column in a select list, optionally qualified and renamed, e.g. s.song_id AS id
+SELECT_COLUMN = re.compile(r'^(?:(\w+)\.)?(\w+)(?:\s+AS\s+(\w+))?$', re.IGNORECASE)
+SELECT_ALIAS = re.compile(r'\bAS\s+(\w+)$', re.IGNORECASE)
+SELECT_KEYWORD = re.compile(r'\bSELECT\b', re.IGNORECASE)
+FROM_KEYWORD = re.compile(r'(?<!\w)FROM\b', re.IGNORECASE)
+
+
+def table_aliases(query):
+    """
+    Map the aliases of the tables in the FROM and JOIN clauses to the table names
+    :param query: SQL statement
+    :return: Dictionary with alias or table name -> table name
+    """
+    aliases = {}
+    for table, alias in TABLE_REFERENCE.findall(query):
+        aliases[table] = table
+        if alias:
+            aliases[alias] = table
+    return aliases
+
+
+def closing_parenthesis(query, start):
+    """
+    Find the parenthesis that closes the one at start
+    :param query: SQL statement
+    :param start: Index of an opening parenthesis
+    :return: Index of the closing parenthesis, None when it is missing
+    """
+    depth = 0
+    for index in range(start, len(query)):
+        if query[index] == '(':
+            depth += 1
+        elif query[index] == ')':
+            depth -= 1
+            if depth == 0:
+                return index
+    return None
+
+
+def derived_tables(query):
+    """
+    Find the subqueries used as tables in the FROM and JOIN clauses
+    :param query: SQL statement
+    :return: Dictionary with alias -> SQL of the subquery
+    """
+    derived = {}
+    for match in DERIVED_TABLE.finditer(query):
+        start = query.index('(', match.start())
+        end = closing_parenthesis(query, start)
+        alias = DERIVED_ALIAS.match(query, end + 1) if end is not None else None
+        if alias is not None:
+            derived[alias.group(1)] = query[start + 1:end]
+    return derived
+
+
+def top_level(query):
+    """
+    Leave out everything between parentheses, e.g. the subqueries and the arguments of functions
+    :param query: SQL statement
+    :return: The statement without the parenthesized parts
+    """
+    parts, depth = [], 0
+    for char in query:
+        if char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        elif depth == 0:
+            parts.append(char)
+    return ''.join(parts)
+
+
+def select_list(query):
+    """
+    Split the select list of a query on the commas that are not inside parentheses
+    :param query: SELECT statement
+    :return: List of the select items
+    """
+    start = SELECT_KEYWORD.search(query).end()
+    items, depth, item_start = [], 0, start
+    for index in range(start, len(query)):
+        char = query[index]
+        if char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        elif depth == 0 and (char == ',' or FROM_KEYWORD.match(query, index)):
+            items.append(query[item_start:index].strip())
+            item_start = index + 1
+            if char != ',':
+                break
+    return items
+
+
+def derived_column(subquery, column):
+    """
+    Find the table column behind a column of a subquery
+    :param subquery: SQL of the subquery
+    :param column: Name of the column in the result of the subquery
+    :return: (table, column), None when the column is computed, e.g. a hash of several columns, or the table is
+    ambiguous
+    """
+    # Only the tables of the subquery itself, the tables of nested subqueries are reached through their alias
+    nested = derived_tables(subquery)
+    aliases = table_aliases(top_level(subquery))
+    aliases.update({alias: alias for alias in nested})
+    for item in select_list(subquery):
+        match = SELECT_COLUMN.match(item)
+        if match is None:
+            computed = SELECT_ALIAS.search(item)
+            if computed is not None and computed.group(1) == column:
+                return None
+            continue
+
+        qualifier, source_column, alias = match.groups()
+        if (alias or source_column) != column:
+            continue
+        if qualifier is None:
+            tables = set(aliases.values())
+            if len(tables) != 1:
+                return None
+            qualifier = tables.pop()
+
+        if qualifier in nested:
+            return derived_column(nested[qualifier], source_column)
+        return aliases.get(qualifier, qualifier), source_column
+    return None
+
+
+def join_columns(queries):
+    """
+    Find the equality join conditions in the queries. A column of a subquery is traced back to its table, a join on a
+    computed column of a subquery is left out as no table column can be distributed on it.
+    :param queries: List of SQL statements
+    :return: List of ((table, column), (table, column)) pairs that are joined
+    """
+    joins = []
+    for query in queries:
+        aliases = table_aliases(query)
+        derived = derived_tables(query)
+
+        def resolve(alias, column):
+            if alias in derived:
+                return derived_column(derived[alias], column)
+            return aliases.get(alias, alias), column
+
+        for left_alias, left_column, right_alias, right_column in JOIN_CONDITION.findall(query):
+            left, right = resolve(left_alias, left_column), resolve(right_alias, right_column)
+            if left is not None and right is not None:
+                joins.append((left, right))
+
+    return joins
+
+
+def advise_keys(tables, queries):
+    """
+    Suggest distribution and sort keys from the join columns of the queries. Both sides of a join are distributed
+    on the join column, so the join runs on the slices without redistributing rows. Tables that are not joined
+    keep their design.
+    :param tables: Dictionary with table name -> Table
+    :param queries: List of SQL statements, e.g. the insert_table_queries
+    :return: Dictionary with table name -> suggestion with the current and the suggested distkey and sortkey
+    """
+    advice = {}
+    for (left_table, left_column), (right_table, right_column) in join_columns(queries):
+        for table_name, column in [(left_table, left_column), (right_table, right_column)]:
+            if table_name not in tables or table_name in advice:
+                continue
+            table = tables[table_name]
+            advice[table_name] = {
+                'distkey': table.distkey,
+                'sortkey': table.sortkey,
+                'suggested_distkey': column,
+                'suggested_sortkey': [column],
+                'matches': table.distkey == column,
+            }
+
+    return advice
+
+
+if __name__ == "__main__":
+    from sql_queries import insert_table_queries, star_schema_tables
+
+    for table in star_schema_tables.values():
+        print(f"\n{table.create_statement()}")
+
+    print("\n========== Key advice ==========")
+    for table_name, suggestion in advise_keys(star_schema_tables, insert_table_queries).items():
+        print(f" {table_name}: distkey {suggestion['distkey']} -> {suggestion['suggested_distkey']}, "
+              f"sortkey {suggestion['sortkey']} -> {suggestion['suggested_sortkey']}")
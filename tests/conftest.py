@@ -0,0 +1,83 @@
+import os
+import sys
+
+import boto3
+import pytest
+from botocore.stub import Stubber
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The modules of services/ and benchmarks/ import each other by their plain names, as when they are run as scripts
+for directory in ('services', 'benchmarks'):
+    sys.path.insert(0, os.path.join(ROOT, directory))
+
+DWH_CONFIG = """
+[AWS]
+KEY = local
+SECRET = local
+
+[CLUSTERSETUP]
+CLUSTER_TYPE = multi-node
+NUM_NODES = 2
+NODE_TYPE = dc2.large
+
+[CLUSTER]
+HOST = localhost
+DB_IDENTIFIER = local
+DB_NAME = local
+DB_USER = local
+DB_PASSWORD = local
+DB_PORT = 5439
+
+[IAM_ROLE]
+ARN = local
+
+[S3]
+LOG_DATA = '{root}/log_data'
+LOG_JSONPATH = 'auto'
+SONG_DATA = '{root}/song_data'
+"""
+
+
+@pytest.fixture
+def dwh_config(tmp_path, monkeypatch):
+    """
+    dwh.cfg file in a temporary working directory, the configured statements are built from it
+    :return: Path of the working directory
+    """
+    from registry import load_config
+    from sql_queries import configured_queries
+
+    (tmp_path / 'dwh.cfg').write_text(DWH_CONFIG.format(root=tmp_path))
+    monkeypatch.chdir(tmp_path)
+    load_config.cache_clear()
+    configured_queries.reset()
+    yield tmp_path
+    load_config.cache_clear()
+    configured_queries.reset()
+
+
+@pytest.fixture
+def sqlite_conn():
+    """
+    Connection to an in-memory SQLite database that accepts the Redshift statements
+    """
+    from compat import CompatConnection
+
+    conn = CompatConnection.sqlite()
+    yield conn
+    conn.close()
+
+
+@pytest.fixture
+def redshift_client():
+    """
+    boto3 Redshift client that never reaches AWS, wrap it in the stubber fixture
+    """
+    return boto3.client('redshift', region_name='us-west-2', aws_access_key_id='test', aws_secret_access_key='test')
+
+
+@pytest.fixture
+def stubber(redshift_client):
+    with Stubber(redshift_client) as stubber:
+        yield stubber
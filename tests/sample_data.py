@@ -0,0 +1,19 @@
+import json
+
+
+def song(song_id, title, artist_id='AR1', artist_name='Artist One', duration=200.0, year=2000):
+    return {'num_songs': 1, 'song_id': song_id, 'title': title, 'duration': duration, 'year': year,
+            'artist_id': artist_id, 'artist_name': artist_name, 'artist_location': 'Somewhere',
+            'artist_latitude': None, 'artist_longitude': None}
+
+
+def play(title, ts, artist_name='Artist One', length=200.0, user_id=7):
+    return {'artist': artist_name, 'auth': 'Logged In', 'firstName': 'Ann', 'gender': 'F', 'itemInSession': 0,
+            'lastName': 'Lee', 'length': length, 'level': 'free', 'location': 'Town', 'method': 'PUT',
+            'page': 'NextSong', 'registration': 1.5e12, 'sessionId': 11, 'song': title, 'status': 200, 'ts': ts,
+            'userAgent': 'agent', 'userId': user_id}
+
+
+def write_records(path, records):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text('\n'.join(json.dumps(record) for record in records) + '\n')
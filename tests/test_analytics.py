@@ -0,0 +1,106 @@
+from contextlib import contextmanager
+
+import pytest
+
+from analytics import Analytics, ResultCache
+from sql_queries import analytics_reads, analytics_watermark_select
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class StubCursor:
+    def __init__(self, pool):
+        self.pool = pool
+        self.rowcount = -1
+        self.rows = []
+
+    def execute(self, query, params=None):
+        self.pool.executed.append(query)
+        self.rows = [(self.pool.watermark,)] if query == analytics_watermark_select else [('free', 2, 5)]
+
+    def fetchall(self):
+        return self.rows
+
+
+class StubPool:
+    def __init__(self):
+        self.watermark = '2018-11-30 10:00:00'
+        self.executed = []
+
+    @contextmanager
+    def session(self):
+        yield self
+
+    def cursor(self):
+        return StubCursor(self)
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+def test_least_recently_used_result_is_evicted(clock):
+    cache = ResultCache(max_entries=2, clock=clock)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == (True, 1)
+
+    cache.put('c', 3)
+
+    assert cache.get('b') == (False, None)
+    assert cache.get('a') == (True, 1) and cache.get('c') == (True, 3)
+    assert (len(cache), cache.evictions, cache.hits, cache.misses) == (2, 1, 3, 1)
+
+
+def test_result_expires_after_the_ttl(clock):
+    cache = ResultCache(ttl=60, clock=clock)
+    cache.put('a', 1)
+
+    clock.now = 60
+    assert cache.get('a') == (True, 1)
+    clock.now = 60.5
+    assert cache.get('a') == (False, None)
+    assert len(cache) == 0
+
+
+def test_reads_are_cached_until_the_watermark_moves(clock):
+    pool = StubPool()
+    analytics = Analytics(pool, ResultCache(clock=clock), watermark_interval=30, clock=clock)
+    read = analytics_reads['active_users_per_level']
+
+    assert analytics.active_users_per_level() == [('free', 2, 5)]
+    assert analytics.active_users_per_level() == [('free', 2, 5)]
+    assert pool.executed == [analytics_watermark_select, read]
+
+    # The watermark is read again after the interval, the cache is kept while it stays the same
+    clock.now = 30
+    analytics.active_users_per_level()
+    assert pool.executed == [analytics_watermark_select, read, analytics_watermark_select]
+
+    # The views were refreshed: the cache is cleared and the read goes to the cluster again
+    pool.watermark = '2018-12-01 10:00:00'
+    clock.now = 60
+    analytics.active_users_per_level()
+    assert pool.executed[3:] == [analytics_watermark_select, read]
+    assert analytics.watermark() == '2018-12-01 10:00:00'
+    assert analytics.queries == 5
+
+
+def test_reads_with_other_parameters_are_cached_apart(clock):
+    pool = StubPool()
+    analytics = Analytics(pool, ResultCache(clock=clock), clock=clock)
+
+    analytics.top_songs(5)
+    analytics.top_songs(10)
+    analytics.top_songs(5)
+
+    assert pool.executed.count(analytics_reads['top_songs']) == 2
+    with pytest.raises(KeyError, match='Unknown analytics read'):
+        analytics.read('songs_per_year')
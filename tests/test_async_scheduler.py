@@ -0,0 +1,150 @@
+import asyncio
+import threading
+
+import pytest
+
+from async_scheduler import count_tables_async, run_async, run_stages_async
+from pool import ConnectionPool
+
+
+class StubCursor:
+    def __init__(self, connection):
+        self.connection = connection
+        self.rowcount = -1
+
+    def execute(self, query, params=None):
+        if query == "SELECT 1":
+            return
+        self.connection.database.execute(self.connection, query)
+
+    def fetchone(self):
+        return ('table', 3)
+
+
+class StubConnection:
+    """
+    Connection whose statements can block like a long COPY, cancel() aborts the running statement as Redshift does
+    """
+
+    def __init__(self, database):
+        self.database = database
+        self.cancelled = threading.Event()
+
+    def cursor(self):
+        return StubCursor(self)
+
+    def cancel(self):
+        self.database.cancelled.append(self)
+        self.cancelled.set()
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        self.cancelled.clear()
+
+    def close(self):
+        pass
+
+
+class StubDatabase:
+    def __init__(self, blocking=(), fail=()):
+        self.blocking = set(blocking)
+        self.fail = set(fail)
+        self.executed = []
+        self.cancelled = []
+        self.started = threading.Event()
+
+    def connect(self):
+        return StubConnection(self)
+
+    def execute(self, conn, query):
+        self.executed.append(query)
+        if query in self.blocking:
+            self.started.set()
+            # Only returns when the statement is cancelled, the test fails after 5 seconds otherwise
+            if not conn.cancelled.wait(5):
+                raise AssertionError(f"{query} was not cancelled")
+            raise RuntimeError("canceling statement due to user request")
+        if query in self.fail:
+            # Fails while the blocking statement is running
+            self.started.wait(5)
+            raise RuntimeError(f"{query} failed")
+
+
+@pytest.fixture
+def database():
+    return StubDatabase(blocking={"copy staging_events"}, fail={"insert songs"})
+
+
+@pytest.fixture
+def pool(database):
+    with ConnectionPool(database.connect, max_size=4, health_check=False) as pool:
+        yield pool
+
+
+def test_progress_is_reported_per_stage(pool):
+    progress = []
+    stages = {'staging_songs': ("copy staging_songs", []), 'artists': ("insert artists", ['staging_songs'])}
+
+    timings = run_async(run_stages_async(pool, stages, on_progress=lambda *args: progress.append(args)))
+
+    assert [args[:4] for args in progress] == [('staging_songs', 'started', 0, 2), ('staging_songs', 'done', 1, 2),
+                                               ('artists', 'started', 1, 2), ('artists', 'done', 2, 2)]
+    assert progress[-1][4] == timings['artists']
+    assert timings['artists']['start'] >= timings['staging_songs']['end']
+
+
+def test_stage_over_the_timeout_is_cancelled_on_the_server(database, pool):
+    progress = []
+    stages = {'staging_events': ("copy staging_events", []), 'times': ("insert times", ['staging_events'])}
+
+    with pytest.raises(RuntimeError, match="Stage 'staging_events' failed") as error:
+        run_async(run_stages_async(pool, stages, timeout=0.1, on_progress=lambda *args: progress.append(args[:2])))
+
+    assert isinstance(error.value.__cause__, TimeoutError)
+    assert len(database.cancelled) == 1
+    assert progress == [('staging_events', 'started'), ('staging_events', 'cancelled')]
+    assert "insert times" not in database.executed
+    assert pool.stats()['in_use'] == 0
+
+
+def test_failed_stage_cancels_the_running_stages(database, pool):
+    progress = []
+    stages = {'staging_events': ("copy staging_events", []), 'songs': ("insert songs", []),
+              'songplays': ("insert songplays", ['staging_events', 'songs'])}
+
+    with pytest.raises(RuntimeError, match="Stage 'songs' failed"):
+        run_async(run_stages_async(pool, stages, on_progress=lambda *args: progress.append(args[:2])))
+
+    assert ('songs', 'failed') in progress and ('staging_events', 'cancelled') in progress
+    assert len(database.cancelled) == 1
+    assert "insert songplays" not in database.executed
+    assert pool.stats()['in_use'] == 0
+
+
+def test_cancelled_run_cancels_the_running_statement(database, pool):
+    progress = []
+
+    async def run():
+        task = asyncio.ensure_future(run_stages_async(pool, {'staging_events': ("copy staging_events", [])},
+                                                      on_progress=lambda *args: progress.append(args[:2])))
+        await asyncio.to_thread(database.started.wait, 5)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    run_async(run())
+
+    assert len(database.cancelled) == 1
+    assert progress == [('staging_events', 'started'), ('staging_events', 'cancelled')]
+    assert pool.stats()['in_use'] == 0
+
+
+def test_invalid_concurrency_is_refused(pool):
+    with pytest.raises(ValueError, match="At least one"):
+        run_async(run_stages_async(pool, {'songs': ("insert songs", [])}, concurrency=0))
+
+
+def test_count_tables_async(pool):
+    assert run_async(count_tables_async(pool, ['songs', 'artists'])) == {'songs': 3, 'artists': 3}
@@ -0,0 +1,125 @@
+import os
+
+import pytest
+
+from checkpoint import completed_stages, input_listing, resume_plan, stage_fingerprints, with_checkpoints
+from compat import CompatConnection
+from instrumentation import execute
+from manifest import write_manifests
+from pool import ConnectionPool
+from registry import Query
+from scheduler import run_stages
+from sql_queries import load_stage_insert, staging_events_json_copy, staging_songs_manifest_json_copy
+
+
+def copy(sql, source):
+    return Query(sql, {'source': source, 'credentials': 'aws_iam_role=local', 'region': 'us-west-2'})
+
+
+def stages(song_source):
+    return {
+        'staging_songs': (copy(staging_songs_manifest_json_copy, song_source), []),
+        'songs': ("INSERT INTO played (stage) VALUES ('songs')", ['staging_songs']),
+        'artists': ("INSERT INTO played (stage) VALUES ('artists')", ['staging_songs']),
+        'songplays': ("INSERT INTO played (stage) VALUES ('songplays')", ['songs', 'artists']),
+    }
+
+
+@pytest.fixture
+def manifest(tmp_path):
+    files = [(str(tmp_path / 'songs' / 'a.json'), 10), (str(tmp_path / 'songs' / 'b.json'), 20)]
+    return write_manifests([files], str(tmp_path / 'manifests'), 'staging_songs')[0]
+
+
+def not_listed(uri):
+    raise AssertionError(f"{uri} was listed")
+
+
+def test_manifest_copy_fingerprints_the_entries(tmp_path, manifest):
+    assert input_listing(copy(staging_songs_manifest_json_copy, manifest), not_listed) == \
+        [[str(tmp_path / 'songs' / 'a.json'), 10], [str(tmp_path / 'songs' / 'b.json'), 20]]
+
+    before = stage_fingerprints(stages(manifest), not_listed)
+    write_manifests([[(str(tmp_path / 'songs' / 'a.json'), 10)]], str(tmp_path / 'manifests'), 'staging_songs')
+    after = stage_fingerprints(stages(manifest), not_listed)
+
+    # The stages after the COPY depend on it, their fingerprints change with its inputs
+    assert all(before[name] != after[name] for name in before)
+
+
+def test_rewritten_file_of_the_same_size_changes_the_fingerprint(tmp_path):
+    log_data = tmp_path / 'log_data'
+    log_data.mkdir()
+    (log_data / 'events.json').write_text('{"ts": 1}')
+    graph = {'staging_events': (copy(staging_events_json_copy, str(log_data)), [])}
+    before = stage_fingerprints(graph)
+
+    (log_data / 'events.json').write_text('{"ts": 2}')
+    os.utime(log_data / 'events.json', ns=(0, 1))
+
+    assert stage_fingerprints(graph) != before
+
+
+def test_every_source_is_listed_once(tmp_path):
+    listed = []
+    query = copy(staging_events_json_copy, str(tmp_path))
+    graph = {'first': (query, []), 'second': ([query, "SELECT 1"], ['first'])}
+
+    stage_fingerprints(graph, lambda uri: listed.append(uri) or [(uri + '/a.json', 1, 'etag')])
+
+    assert listed == [str(tmp_path)]
+
+
+def test_resume_plan(manifest):
+    graph = stages(manifest)
+    fingerprints = stage_fingerprints(graph)
+
+    assert resume_plan(graph, fingerprints, {}) is None
+    assert resume_plan(graph, fingerprints, fingerprints) == {}
+    assert resume_plan(graph, fingerprints, {name: fingerprints[name] for name in ('staging_songs', 'songs')}) == {
+        'artists': (graph['artists'][0], []),
+        'songplays': (graph['songplays'][0], ['artists']),
+    }
+    # A committed stage with other inputs has loaded other rows, the load starts from scratch
+    assert resume_plan(graph, fingerprints, {'staging_songs': 'other', 'songs': fingerprints['songs']}) is None
+
+
+def test_with_checkpoints_adds_the_insert_to_every_stage(manifest):
+    graph = stages(manifest)
+    fingerprints = stage_fingerprints(graph)
+
+    checkpointed = with_checkpoints(graph, fingerprints)
+
+    assert checkpointed['songplays'][1] == ['songs', 'artists']
+    checkpoint = checkpointed['songplays'][0][-1]
+    assert checkpoint.sql == load_stage_insert
+    assert checkpoint.params == {'stage': 'songplays', 'fingerprint': fingerprints['songplays']}
+
+
+def test_failed_load_resumes_at_the_missing_stages(tmp_path, manifest):
+    graph = stages(manifest)
+    graph['staging_songs'] = ("INSERT INTO played (stage) VALUES ('staging_songs')", [])
+    failing = dict(graph, artists=("INSERT INTO missing (stage) VALUES ('artists')", ['staging_songs']))
+    # A database file, the pool replaces the connection of the failed stage
+    conn = CompatConnection.sqlite(str(tmp_path / 'dwh.db'))
+    cur = conn.cursor()
+    execute(cur, "CREATE TABLE played (stage VARCHAR(16))")
+    completed_stages(cur)
+    conn.commit()
+    fingerprints = stage_fingerprints(graph)
+
+    with ConnectionPool(lambda: CompatConnection.sqlite(str(tmp_path / 'dwh.db')), max_size=1) as pool:
+        with pytest.raises(RuntimeError, match="Stage 'artists' failed"):
+            run_stages(pool, with_checkpoints(failing, fingerprints), workers=1)
+
+        completed = completed_stages(cur)
+        assert set(completed) <= {'staging_songs', 'songs'} and 'staging_songs' in completed
+        remaining = resume_plan(graph, fingerprints, completed)
+        assert 'artists' in remaining and 'songplays' in remaining
+        run_stages(pool, with_checkpoints(remaining, fingerprints), workers=1)
+
+    execute(cur, "SELECT stage FROM played ORDER BY stage")
+    assert cur.fetchall() == [('artists',), ('songplays',), ('songs',), ('staging_songs',)]
+    assert completed_stages(cur) == fingerprints
+    assert resume_plan(graph, fingerprints, completed_stages(cur)) == {}
+    conn.close()
@@ -0,0 +1,57 @@
+import gzip
+import json
+
+import pyarrow
+import pyarrow.parquet
+import pytest
+
+from convert import coerce, column_mapping, convert_file, parquet_schema
+
+
+def test_parquet_schema_matches_the_raw_staging_columns():
+    schema = parquet_schema(column_mapping('staging_events'))
+
+    assert schema.names[-1] == 'userId' and 'song_key' not in schema.names
+    assert schema.field('ts').type == pyarrow.int64()
+    assert schema.field('length').type == pyarrow.float64()
+    assert schema.field('userId').type == pyarrow.string()
+
+
+def test_derived_columns_are_not_mapped():
+    mapping = dict((column.name, key) for column, key in column_mapping('staging_songs'))
+
+    assert 'song_key' not in mapping
+    assert mapping['artist_name'] == 'artist_name'
+
+
+def test_json_paths_must_match_the_raw_columns(tmp_path):
+    json_paths = tmp_path / 'log_json_path.json'
+    json_paths.write_text(json.dumps({'jsonpaths': ["$['artist']", "$.auth"]}))
+
+    with pytest.raises(ValueError, match='2 expressions'):
+        column_mapping('staging_events', str(json_paths))
+
+
+def test_coerce():
+    assert coerce('12', 'BIGINT') == 12
+    assert coerce('', 'FLOAT') is None
+    assert coerce(1.5, 'FLOAT') == 1.5
+    assert coerce(['a'], 'VARCHAR(10)') == '["a"]'
+
+
+def test_convert_file_to_parquet_and_csv(tmp_path):
+    source = tmp_path / 'songs.json'
+    source.write_text(json.dumps({'num_songs': 1, 'artist_id': 'AR1', 'artist_latitude': None,
+                                  'artist_longitude': None, 'artist_location': '', 'artist_name': 'Artist',
+                                  'song_id': 'S1', 'title': 'Title', 'duration': 200.5, 'year': 2000}) + '\n')
+    mapping = column_mapping('staging_songs')
+
+    result = convert_file((str(source), str(tmp_path / 'out' / 'songs.parquet'), mapping, 'parquet', 100))
+    table = pyarrow.parquet.read_table(str(tmp_path / 'out' / 'songs.parquet'))
+    assert result['rows'] == 1
+    assert table.schema == parquet_schema(mapping)
+    assert table.to_pylist()[0]['duration'] == 200.5
+
+    convert_file((str(source), str(tmp_path / 'out' / 'songs.csv.gz'), mapping, 'csv', 100))
+    with gzip.open(tmp_path / 'out' / 'songs.csv.gz', 'rt') as f:
+        assert f.read().strip() == '1,AR1,\\N,\\N,,Artist,S1,Title,200.5,2000'
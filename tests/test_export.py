@@ -0,0 +1,104 @@
+import json
+
+import pyarrow.parquet
+import pytest
+
+import sql_queries
+from export import EXPORT_MANIFEST, export_tables, plan_export, table_prefix, unload_statement
+from incremental import load_incremental
+from instrumentation import execute
+from sample_data import play, write_records
+
+NOVEMBER, DECEMBER = 1541030400000, 1543622400000
+
+
+@pytest.fixture
+def cur(dwh_config, sqlite_conn):
+    cur = sqlite_conn.cursor()
+    for query in sql_queries.create_table_queries:
+        execute(cur, query)
+    execute(cur, "INSERT INTO artists (artist_id, name) VALUES ('AR1', 'Artist One')")
+    execute(cur, "INSERT INTO songs (song_id, title, artist_id, year, duration, song_key) "
+                 "SELECT 'S1', 'One', 'AR1', 2000, 200, " +
+            sql_queries.song_key_expression("'One'", "'Artist One'", '200'))
+    sqlite_conn.commit()
+    return cur
+
+
+def load_plays(dwh_config, cur, conn, day, *timestamps):
+    log_data = dwh_config / 'log_data'
+    write_records(log_data / '2018' / '11' / f"2018-11-{day:02d}-events.json",
+                  [play('One', ts, user_id=index + 1) for index, ts in enumerate(timestamps)])
+    load_incremental(cur, conn, str(log_data), str(dwh_config / 'manifests'))
+
+
+def read_manifest(export):
+    with open(export / EXPORT_MANIFEST) as f:
+        return json.load(f)
+
+
+def test_plan_export():
+    counts = {'songplays': {'2018/11': 5, '2018/12': 2}, 'times': {'2018/11': 5}, 'users': 3, 'songs': 1,
+              'artists': 1}
+    previous = {'tables': {'songplays': {'partitions': {'2018/11': {'rows': 5}}},
+                           'times': {'partitions': {'2018/11': {'rows': 4}}}}}
+
+    assert plan_export(None, counts) == dict.fromkeys(sql_queries.export_selects)
+    assert plan_export(previous, counts) == {'songplays': ['2018/12'], 'times': ['2018/11'], 'users': None,
+                                             'songs': None, 'artists': None}
+    assert plan_export(previous, counts, incremental=False) == dict.fromkeys(sql_queries.export_selects)
+    # A partition that disappeared exports the whole table again
+    assert plan_export(previous, {**counts, 'times': {'2018/12': 1}})['times'] is None
+
+
+def test_unload_statement(dwh_config):
+    query = unload_statement('songplays', "'s3://bucket/export'", '2018/11')
+
+    assert table_prefix("'s3://bucket/export'", 'songplays', '2018/11') == query.params['target'] == \
+        's3://bucket/export/songplays/year=2018/month=11/'
+    assert query.sql == sql_queries.export_table_unload
+    assert unload_statement('songplays', 's3://bucket/export').sql == sql_queries.export_partitioned_unload
+    assert unload_statement('users', 's3://bucket/export').sql == sql_queries.export_table_unload
+
+
+def test_export_writes_the_partition_layout(dwh_config, sqlite_conn, cur):
+    load_plays(dwh_config, cur, sqlite_conn, 1, NOVEMBER, NOVEMBER + 3600000, DECEMBER)
+    export = dwh_config / 'export'
+
+    assert export_tables(cur, sqlite_conn, str(export)) == dict.fromkeys(sql_queries.export_selects, 'all')
+
+    files = sorted(path.relative_to(export).as_posix() for path in export.rglob('*.parquet'))
+    assert files == ['artists/0000_part_00.parquet', 'songplays/year=2018/month=11/0000_part_00.parquet',
+                     'songplays/year=2018/month=12/0000_part_00.parquet', 'songs/0000_part_00.parquet',
+                     'times/year=2018/month=11/0000_part_00.parquet', 'times/year=2018/month=12/0000_part_00.parquet',
+                     'users/0000_part_00.parquet']
+    # PARTITION BY leaves the partition columns out of the files
+    november = pyarrow.parquet.read_table(export / 'songplays' / 'year=2018' / 'month=11' / '0000_part_00.parquet')
+    assert november.num_rows == 2
+    assert november.column_names == [column.name for column in sql_queries.songplay_table.columns]
+
+    manifest = read_manifest(export)
+    assert {key: part['rows'] for key, part in manifest['tables']['songplays']['partitions'].items()} == \
+        {'2018/11': 2, '2018/12': 1}
+    assert [len(part['files']) for part in manifest['tables']['times']['partitions'].values()] == [1, 1]
+    assert manifest['tables']['users']['rows'] == 3
+    assert manifest['tables']['users']['files'][0]['url'].endswith('users/0000_part_00.parquet')
+
+
+def test_incremental_export_only_unloads_the_changed_partitions(dwh_config, sqlite_conn, cur):
+    load_plays(dwh_config, cur, sqlite_conn, 1, NOVEMBER, DECEMBER)
+    export = dwh_config / 'export'
+    export_tables(cur, sqlite_conn, str(export))
+    december = read_manifest(export)['tables']['songplays']['partitions']['2018/12']
+
+    load_plays(dwh_config, cur, sqlite_conn, 2, NOVEMBER + 86400000)
+
+    assert export_tables(cur, sqlite_conn, str(export)) == {'songplays': ['2018/11'], 'times': ['2018/11'],
+                                                            'users': 'all', 'songs': 'all', 'artists': 'all'}
+    partitions = read_manifest(export)['tables']['songplays']['partitions']
+    assert partitions['2018/11']['rows'] == 2 and partitions['2018/12'] == december
+    assert pyarrow.parquet.read_table(
+        export / 'songplays' / 'year=2018' / 'month=11' / '0000_part_00.parquet').num_rows == 2
+
+    # Nothing changed, only the dimensions are exported again
+    assert export_tables(cur, sqlite_conn, str(export)) == {'users': 'all', 'songs': 'all', 'artists': 'all'}
@@ -0,0 +1,22 @@
+import json
+import os
+
+from generate_data import Settings, generate
+
+
+def generated_files(out_dir, name):
+    return sum(len(files) for _, _, files in os.walk(out_dir / name))
+
+
+def test_a_smaller_dataset_replaces_the_earlier_one(tmp_path):
+    (tmp_path / 'notes.txt').write_text('kept')
+    generate(Settings(songs=50, artists=10, users=5, events=200, days=3), str(tmp_path), workers=1, chunk_size=20)
+
+    expected = generate(Settings(songs=20, artists=5, users=5, events=50, days=2, seed=7), str(tmp_path), workers=1,
+                        chunk_size=20)
+
+    assert generated_files(tmp_path, 'song_data') == 20
+    assert generated_files(tmp_path, 'log_data') == 2
+    with open(tmp_path / 'expected_counts.json') as f:
+        assert json.load(f) == expected
+    assert (tmp_path / 'notes.txt').read_text() == 'kept'
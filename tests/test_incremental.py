@@ -0,0 +1,97 @@
+import json
+
+import pytest
+
+import sql_queries
+from incremental import list_log_files, load_incremental, new_log_files
+from instrumentation import execute
+from sample_data import play, write_records
+
+
+@pytest.fixture
+def cur(dwh_config, sqlite_conn):
+    cur = sqlite_conn.cursor()
+    for query in sql_queries.create_table_queries:
+        execute(cur, query)
+    execute(cur, "INSERT INTO artists (artist_id, name) VALUES ('AR1', 'Artist One')")
+    execute(cur, "INSERT INTO songs (song_id, title, artist_id, year, duration, song_key) "
+                 "SELECT 'S1', 'One', 'AR1', 2000, 200, " +
+            sql_queries.song_key_expression("'One'", "'Artist One'", '200'))
+    sqlite_conn.commit()
+    return cur
+
+
+def watermarks(cur):
+    execute(cur, sql_queries.load_watermarks_select)
+    return dict(cur.fetchall())
+
+
+def count(cur, table):
+    execute(cur, f"SELECT COUNT(*) FROM {table}")
+    return cur.fetchone()[0]
+
+
+def test_new_log_files_after_the_watermarks():
+    partitions = {'2018/11': [('2018/11/2018-11-01-events.json', 'a', 1), ('2018/11/2018-11-02-events.json', 'b', 2)],
+                  '2018/12': [('2018/12/2018-12-01-events.json', 'c', 3)]}
+
+    assert new_log_files(partitions, {'2018/11': '2018/11/2018-11-02-events.json'}) == \
+        {'2018/12': [('2018/12/2018-12-01-events.json', 'c', 3)]}
+    assert new_log_files(partitions, {'2018/11': '2018/11/2018-11-01-events.json',
+                                      '2018/12': '2018/12/2018-12-01-events.json'}) == \
+        {'2018/11': [('2018/11/2018-11-02-events.json', 'b', 2)]}
+
+
+def test_list_log_files_skips_files_outside_the_partitions(tmp_path):
+    write_records(tmp_path / '2018' / '11' / '2018-11-01-events.json', [play('One', 1541030400000)])
+    write_records(tmp_path / 'README.json', [{}])
+
+    partitions = list_log_files(str(tmp_path))
+
+    assert list(partitions) == ['2018/11']
+    assert [(key, size) for key, _, size in partitions['2018/11']] == \
+        [('2018/11/2018-11-01-events.json', (tmp_path / '2018' / '11' / '2018-11-01-events.json').stat().st_size)]
+
+
+def test_watermarks_move_with_every_load(dwh_config, sqlite_conn, cur):
+    log_data, manifests = dwh_config / 'log_data', str(dwh_config / 'manifests')
+    write_records(log_data / '2018' / '11' / '2018-11-01-events.json', [play('One', 1541030400000)])
+    write_records(log_data / '2018' / '11' / '2018-11-02-events.json', [play('One', 1541116800000)])
+
+    assert load_incremental(cur, sqlite_conn, str(log_data), manifests) == {'2018/11': 2}
+    assert watermarks(cur) == {'2018/11': '2018/11/2018-11-02-events.json'}
+    with open(dwh_config / 'manifests' / 'staging_events-0000.manifest') as f:
+        assert [entry['url'] for entry in json.load(f)['entries']] == \
+            [str(log_data / '2018' / '11' / f"2018-11-0{day}-events.json") for day in (1, 2)]
+    assert count(cur, 'songplays') == 2
+
+    # Nothing new: no COPY and the watermarks stay
+    assert load_incremental(cur, sqlite_conn, str(log_data), manifests) == {}
+
+    write_records(log_data / '2018' / '11' / '2018-11-03-events.json', [play('One', 1541203200000)])
+    write_records(log_data / '2018' / '12' / '2018-12-01-events.json', [play('One', 1543622400000)])
+    assert load_incremental(cur, sqlite_conn, str(log_data), manifests) == {'2018/11': 1, '2018/12': 1}
+    assert watermarks(cur) == {'2018/11': '2018/11/2018-11-03-events.json', '2018/12': '2018/12/2018-12-01-events.json'}
+    with open(dwh_config / 'manifests' / 'staging_events-0000.manifest') as f:
+        assert len(json.load(f)['entries']) == 2
+    assert count(cur, 'staging_events') == 2
+    assert count(cur, 'songplays') == 4
+
+
+def test_failed_copy_keeps_the_watermarks(dwh_config, sqlite_conn, cur):
+    log_data, manifests = dwh_config / 'log_data', str(dwh_config / 'manifests')
+    write_records(log_data / '2018' / '11' / '2018-11-01-events.json', [play('One', 1541030400000)])
+    load_incremental(cur, sqlite_conn, str(log_data), manifests)
+
+    (log_data / '2018' / '11' / '2018-11-02-events.json').write_text('{"artist": ')
+    with pytest.raises(ValueError):
+        load_incremental(cur, sqlite_conn, str(log_data), manifests)
+    sqlite_conn.rollback()
+
+    assert watermarks(cur) == {'2018/11': '2018/11/2018-11-01-events.json'}
+    assert count(cur, 'songplays') == 1
+
+
+def test_manifest_prefix_is_required(dwh_config, sqlite_conn, cur):
+    with pytest.raises(ValueError, match='MANIFEST_PREFIX'):
+        load_incremental(cur, sqlite_conn, str(dwh_config / 'log_data'), None)
@@ -0,0 +1,118 @@
+import gc
+import weakref
+
+import pytest
+
+from compat import CompatConnection
+from instrumentation import QUERY_IDS_SELECT, RunReport, end_run, start_run, statement_name
+from pool import ConnectionPool
+from scheduler import run_stages
+
+
+class RedshiftCursor:
+    # Answers the version probe like Redshift and logs the queries of the session in STL_QUERY, without DDL
+    def __init__(self, connection):
+        self.connection = connection
+        self.rowcount = 1
+        self._result = []
+
+    def execute(self, query, params=None):
+        self.connection.statements.append(query)
+        if query == "SELECT version()":
+            self._result = [('PostgreSQL 8.0.2 on i686-pc-linux-gnu, Redshift 1.0.50000',)]
+        elif query == "SELECT pg_last_query_id()":
+            self._result = [(self.connection.stl_query[-1][0],)]
+        elif query == QUERY_IDS_SELECT:
+            self._result = [row for row in self.connection.stl_query if row[0] > params[0]]
+        elif query.startswith('FAIL'):
+            raise RuntimeError('syntax error')
+        elif not query.startswith('CREATE'):
+            self.connection.stl_query.append((self.connection.stl_query[-1][0] + 1, query.ljust(40)))
+
+    def fetchone(self):
+        return self._result[0]
+
+    def fetchall(self):
+        return self._result
+
+
+class RedshiftConnection:
+    def __init__(self):
+        self.statements = []
+        # Queries of earlier sessions
+        self.stl_query = [(100, 'SELECT 1')]
+
+    def cursor(self):
+        return RedshiftCursor(self)
+
+
+def test_statement_name():
+    assert statement_name("COPY staging_events FROM 's3://bucket/log_data'") == 'copy staging_events'
+    assert statement_name("INSERT INTO songplays (start_time) SELECT 1") == 'insert songplays'
+    assert statement_name("VACUUM SORT ONLY songplays") == 'vacuum sort'
+
+
+def test_run_stages_on_sqlite_records_the_statements(tmp_path):
+    pool = ConnectionPool(lambda: CompatConnection.sqlite(str(tmp_path / 'run.db')), max_size=2)
+    stages = {
+        'create': ("CREATE TABLE numbers (value INT)", []),
+        'insert': (["INSERT INTO numbers VALUES (1)", "INSERT INTO numbers VALUES (2)"], ['create']),
+    }
+    report = start_run()
+    try:
+        run_stages(pool, stages, workers=2)
+    finally:
+        end_run()
+        pool.close()
+
+    assert [(item['stage'], item['name'], item['query_id']) for item in report.statements] == \
+        [('create', 'create numbers', None), ('insert', 'insert numbers', None), ('insert', 'insert numbers', None)]
+    assert report.to_dict()['stages']['insert']['statements'] == 2
+
+
+def test_query_ids_are_looked_up_once_per_stage():
+    report = RunReport()
+    conn = RedshiftConnection()
+    cur = conn.cursor()
+    with report.stage('numbers'):
+        report.execute(cur, "CREATE TABLE numbers (value INT)")
+        report.execute(cur, "INSERT INTO numbers VALUES (1)")
+        report.execute(cur, "INSERT INTO numbers VALUES (2)")
+    with report.stage('more'):
+        report.execute(cur, "DELETE FROM numbers")
+
+    assert conn.statements == ["SELECT version()", "SELECT pg_last_query_id()", "CREATE TABLE numbers (value INT)",
+                               "INSERT INTO numbers VALUES (1)", "INSERT INTO numbers VALUES (2)", QUERY_IDS_SELECT,
+                               "DELETE FROM numbers", QUERY_IDS_SELECT]
+    assert [item['query_id'] for item in report.statements] == [None, 101, 102, 103]
+
+
+def test_query_id_outside_a_stage_is_looked_up_right_away():
+    report = RunReport()
+    conn = RedshiftConnection()
+    report.execute(conn.cursor(), "INSERT INTO numbers VALUES (1)")
+
+    assert conn.statements[-2:] == ["INSERT INTO numbers VALUES (1)", QUERY_IDS_SELECT]
+    assert report.statements[0]['query_id'] == 101
+
+
+def test_failed_stage_skips_the_lookup():
+    report = RunReport()
+    conn = RedshiftConnection()
+    with pytest.raises(RuntimeError), report.stage('numbers'):
+        report.execute(conn.cursor(), "INSERT INTO numbers VALUES (1)")
+        report.execute(conn.cursor(), "FAIL")
+
+    assert QUERY_IDS_SELECT not in conn.statements
+
+
+def test_probe_does_not_keep_the_connection_alive():
+    report = RunReport()
+    conn = RedshiftConnection()
+    report.execute(conn.cursor(), "INSERT INTO numbers VALUES (1)")
+    closed = weakref.ref(conn)
+
+    del conn
+    gc.collect()
+
+    assert closed() is None
@@ -0,0 +1,126 @@
+import configparser
+import threading
+
+import pytest
+
+from compat import CompatConnection
+from maintenance import Thresholds, plan_maintenance, run_maintenance
+from pool import ConnectionPool
+from stats import parse_table_info
+
+
+def detail(rows=100000, size_mb=1000, unsorted=0.0, stats_off=0.0, deleted=0.0):
+    return {'rows': rows, 'size_mb': size_mb, 'unsorted': unsorted, 'stats_off': stats_off, 'deleted': deleted}
+
+
+def actions(plan):
+    return [(item['table'], item['action']) for item in plan]
+
+
+def test_thresholds_from_config():
+    config = configparser.ConfigParser()
+    config.read_string("[MAINTENANCE]\nUNSORTED = 5\nMIN_ROWS = 10\n")
+
+    thresholds = Thresholds.from_config(config)
+
+    assert (thresholds.stats_off, thresholds.unsorted, thresholds.deleted, thresholds.min_rows) == (10.0, 5.0, 10.0, 10)
+    assert isinstance(thresholds.min_rows, int)
+
+
+def test_parse_table_info():
+    details = parse_table_info([('songplays  ', 900, 12, 35.5, None, 1000)], ['songplays', 'users'])
+
+    assert details['songplays'] == {'rows': 900, 'size_mb': 12, 'unsorted': 35.5, 'stats_off': None, 'deleted': 10.0}
+    assert details['users'] == {'rows': 0, 'size_mb': 0, 'unsorted': None, 'stats_off': None, 'deleted': 0.0}
+
+
+@pytest.mark.parametrize('health, expected', [
+    (detail(), []),
+    (detail(stats_off=9.9, unsorted=19.9, deleted=9.9), []),
+    (detail(stats_off=10.0), ['analyze']),
+    (detail(stats_off=None), ['analyze']),
+    (detail(unsorted=20.0), ['vacuum_sort']),
+    (detail(deleted=10.0), ['vacuum_delete']),
+    (detail(unsorted=30.0, deleted=15.0, stats_off=50.0), ['analyze', 'vacuum_full']),
+    (detail(rows=999, stats_off=None, unsorted=90.0), []),
+])
+def test_plan_maintenance_thresholds(health, expected):
+    assert [item['action'] for item in plan_maintenance({'songplays': health})] == expected
+
+
+def test_plan_maintenance_order_and_estimates():
+    plan = plan_maintenance({'songplays': detail(unsorted=40.0, stats_off=20.0),
+                             'times': detail(size_mb=100, unsorted=60.0, deleted=20.0),
+                             'users': detail(stats_off=None)})
+
+    # The ANALYZE actions first, then the VACUUM actions, the worst table first
+    assert actions(plan) == [('users', 'analyze'), ('songplays', 'analyze'), ('times', 'vacuum_full'),
+                             ('songplays', 'vacuum_sort')]
+    assert plan[0]['reason'] == 'no statistics' and plan[0]['statement'] == "ANALYZE users PREDICATE COLUMNS"
+    # 1000 MB at 50 MB/s, ANALYZE costs 0.05 per MB, VACUUM SORT 1.0 for the unsorted 40%
+    assert plan[1]['estimated_seconds'] == 1.0
+    assert plan[3]['estimated_seconds'] == 8.0
+    assert plan[2]['statement'] == "VACUUM FULL times"
+
+
+def test_run_maintenance_on_sqlite(tmp_path):
+    pool = ConnectionPool(lambda: CompatConnection.sqlite(str(tmp_path / 'maintenance.db')), max_size=1)
+    with pool.session() as conn:
+        conn.cursor().execute("CREATE TABLE songplays (songplay_id INT)")
+        conn.commit()
+    plan = plan_maintenance({'songplays': detail(stats_off=None, unsorted=50.0),
+                             'missing': detail(deleted=50.0)}, Thresholds(mb_per_second=100.0))
+    plan.append({**plan[0], 'action': 'vacuum_full', 'estimated_seconds': 3600.0})
+
+    results = run_maintenance(pool, plan, budget=60.0)
+    pool.close()
+
+    # SQLite vacuums the whole database, VACUUM DELETE ONLY missing runs as well
+    assert [(item['table'], item['action'], item['status']) for item in results] == \
+        [('songplays', 'analyze', 'done'), ('missing', 'vacuum_delete', 'done'), ('songplays', 'vacuum_sort', 'done'),
+         ('songplays', 'vacuum_full', 'skipped')]
+
+
+class BlockingCursor:
+    # A VACUUM that only ends when it is cancelled, the ANALYZE fails
+    def __init__(self, connection):
+        self.connection = connection
+        self.rowcount = -1
+
+    def execute(self, query, params=None):
+        if query.startswith('ANALYZE'):
+            raise RuntimeError('permission denied')
+        if query.startswith('VACUUM') and self.connection.cancelled.wait(5):
+            raise RuntimeError('canceling statement due to user request')
+
+    def fetchone(self):
+        return (1,)
+
+
+class BlockingConnection:
+    def __init__(self):
+        self.cancelled = threading.Event()
+        self.autocommit = False
+
+    def cursor(self):
+        return BlockingCursor(self)
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def test_statement_over_the_budget_is_cancelled():
+    pool = ConnectionPool(BlockingConnection, max_size=1)
+    plan = plan_maintenance({'songplays': detail(size_mb=1, stats_off=50.0, unsorted=50.0)})
+
+    results = run_maintenance(pool, plan, budget=0.2)
+
+    assert [(item['action'], item['status']) for item in results] == \
+        [('analyze', 'failed'), ('vacuum_sort', 'cancelled')]
+    assert results[1]['seconds'] < 5
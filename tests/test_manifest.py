@@ -0,0 +1,115 @@
+import json
+
+import boto3
+import pytest
+from botocore.stub import Stubber
+
+import sql_queries
+from manifest import batch_objects, cluster_slices, manifest_entries, prepare_song_manifests, write_manifests
+from sources import list_objects
+
+
+@pytest.fixture
+def s3_client():
+    return boto3.client('s3', region_name='us-west-2', aws_access_key_id='test', aws_secret_access_key='test')
+
+
+def test_cluster_slices():
+    assert cluster_slices('dc2.large', 4) == 8
+    assert cluster_slices('ra3.16xlarge', 2) == 32
+    with pytest.raises(ValueError, match="Unknown node type 'dc1.large'"):
+        cluster_slices('dc1.large', 2)
+
+
+def test_batch_objects_rounds_the_batches_to_the_slices():
+    objects = [(f"s3://bucket/song_data/{index:02d}.json", size) for index, size in enumerate([9, 1, 8, 2, 7, 3])]
+
+    batches = batch_objects(objects, slices=2, files_per_slice=2)
+
+    assert [len(batch) for batch in batches] == [4, 2]
+    assert [sum(size for _, size in batch) for batch in batches] == [19, 11]
+    assert sorted(item for batch in batches for item in batch) == sorted(objects)
+    assert all(batch == sorted(batch) for batch in batches)
+
+
+@pytest.mark.parametrize('files, slices, files_per_slice, sizes', [
+    (10, 8, 1, [8, 2]),
+    (20, 8, 2, [16, 4]),
+    (33, 4, 3, [12, 12, 9]),
+    (7, 2, 10, [7]),
+])
+def test_batch_objects_fills_every_slice_but_in_the_last_batch(files, slices, files_per_slice, sizes):
+    objects = [(f"{index:02d}.json", index) for index in range(files)]
+
+    assert [len(batch) for batch in batch_objects(objects, slices, files_per_slice)] == sizes
+
+
+def test_batch_objects_keeps_small_listings_in_one_batch():
+    assert batch_objects([('a', 1), ('b', 2)], slices=8) == [[('a', 1), ('b', 2)]]
+    assert batch_objects([], slices=8) == []
+    with pytest.raises(ValueError):
+        batch_objects([('a', 1)], slices=0)
+
+
+def test_manifest_entries():
+    assert manifest_entries([('s3://bucket/a.json', 10)]) == \
+        {'entries': [{'url': 's3://bucket/a.json', 'mandatory': True, 'meta': {'content_length': 10}}]}
+
+
+def test_write_manifests_to_a_local_directory(tmp_path):
+    batches = [[(str(tmp_path / 'a.json'), 1)], [(str(tmp_path / 'b.json'), 2), (str(tmp_path / 'c.json'), 3)]]
+
+    manifests = write_manifests(batches, str(tmp_path / 'manifests'), 'staging_songs')
+
+    assert manifests == [str(tmp_path / 'manifests' / 'staging_songs-0000.manifest'),
+                         str(tmp_path / 'manifests' / 'staging_songs-0001.manifest')]
+    for manifest, batch in zip(manifests, batches):
+        with open(manifest) as f:
+            assert json.load(f) == manifest_entries(batch)
+
+
+def test_write_manifests_to_s3(s3_client):
+    batch = [('s3://bucket/song_data/a.json', 100)]
+    stubber = Stubber(s3_client)
+    stubber.add_response('put_object', {}, {'Bucket': 'bucket', 'Key': 'manifests/staging_songs-0000.manifest',
+                                            'Body': json.dumps(manifest_entries(batch), indent=1).encode('utf-8')})
+
+    with stubber:
+        manifests = write_manifests([batch], "'s3://bucket/manifests/'", 'staging_songs', s3_client)
+
+    stubber.assert_no_pending_responses()
+    assert manifests == ['s3://bucket/manifests/staging_songs-0000.manifest']
+
+
+def test_list_objects_pages_through_s3(s3_client):
+    stubber = Stubber(s3_client)
+    stubber.add_response('list_objects_v2', {'IsTruncated': True, 'NextContinuationToken': 'next',
+                                             'Contents': [{'Key': 'song_data/b.json', 'Size': 2},
+                                                          {'Key': 'song_data/', 'Size': 0}]},
+                         {'Bucket': 'bucket', 'Prefix': 'song_data'})
+    stubber.add_response('list_objects_v2',
+                         {'IsTruncated': False, 'Contents': [{'Key': 'song_data/a.json', 'Size': 1}]},
+                         {'Bucket': 'bucket', 'Prefix': 'song_data', 'ContinuationToken': 'next'})
+
+    with stubber:
+        objects = list_objects('s3://bucket/song_data', s3_client)
+
+    assert objects == [('s3://bucket/song_data/a.json', 1), ('s3://bucket/song_data/b.json', 2)]
+
+
+def test_prepare_song_manifests(dwh_config):
+    for index in range(5):
+        (dwh_config / 'song_data' / f"{index}.json").parent.mkdir(exist_ok=True)
+        (dwh_config / 'song_data' / f"{index}.json").write_text('{}' * (index + 1))
+
+    copies = prepare_song_manifests(str(dwh_config / 'song_data'), str(dwh_config / 'manifests'), 'dc2.large', 1,
+                                    files_per_slice=2)
+
+    assert [copy.params['source'] for copy in copies] == \
+        [str(dwh_config / 'manifests' / f"staging_songs-000{index}.manifest") for index in range(2)]
+    assert all(copy.sql == sql_queries.staging_songs_manifest_json_copy for copy in copies)
+    files = []
+    for copy in copies:
+        with open(copy.params['source']) as f:
+            files += [entry['url'] for entry in json.load(f)['entries']]
+    assert sorted(files) == [str(dwh_config / 'song_data' / f"{index}.json") for index in range(5)]
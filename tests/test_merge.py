@@ -0,0 +1,70 @@
+import pytest
+
+import sql_queries
+from instrumentation import execute
+from registry import Query
+from sample_data import play, song, write_records
+
+
+@pytest.fixture
+def cur(dwh_config, sqlite_conn):
+    cur = sqlite_conn.cursor()
+    for query in sql_queries.create_table_queries:
+        execute(cur, query)
+    sqlite_conn.commit()
+    return cur
+
+
+def merge_batch(cur, conn, directory, events, songs):
+    # One run of merge mode: staging is reloaded with the batch, the dimensions are merged
+    write_records(directory / 'log_data' / 'events.json', events)
+    write_records(directory / 'song_data' / 'songs.json', songs)
+    queries = [sql_queries.staging_events_truncate, sql_queries.staging_songs_truncate,
+               Query(sql_queries.staging_events_json_copy,
+                     sql_queries.copy_parameters(source=str(directory / 'log_data'), json_paths='auto'))]
+    queries += sql_queries.staging_events_derived_insert
+    queries += [Query(sql_queries.staging_songs_json_copy,
+                      sql_queries.copy_parameters(source=str(directory / 'song_data')))]
+    queries += sql_queries.staging_songs_song_key_insert
+    for query in queries:
+        execute(cur, query)
+
+    deleted = {}
+    for table, merge in [('users', sql_queries.user_table_merge), ('songs', sql_queries.song_table_merge)]:
+        for query in merge:
+            execute(cur, query)
+            if query.startswith('DELETE'):
+                deleted[table] = cur.rowcount
+    conn.commit()
+    return deleted
+
+
+def rows(cur, table, columns):
+    # The SQLite rowid changes when a row is deleted and inserted again
+    execute(cur, f"SELECT {columns}, rowid FROM {table} ORDER BY 1")
+    return {row[0]: row[1:] for row in cur.fetchall()}
+
+
+def test_overlapping_batches_keep_the_latest_version(dwh_config, sqlite_conn, cur):
+    first = merge_batch(cur, sqlite_conn, dwh_config / 'run1',
+                        [play('One', 1000, user_id=7), play('One', 2000, user_id=8)],
+                        [song('S1', 'One', year=2000), song('S2', 'Two')])
+    assert first == {'users': 0, 'songs': 0}
+    users, songs = rows(cur, 'users', 'user_id, level'), rows(cur, 'songs', 'song_id, title, year')
+
+    # The second batch overlaps the first: user 8 and S2 are unchanged, user 7 and S1 have a newer version next to
+    # an older one, user 9 and S3 are new
+    second = merge_batch(cur, sqlite_conn, dwh_config / 'run2',
+                         [dict(play('One', 3000, user_id=7), level='paid'), play('One', 500, user_id=7),
+                          play('One', 2000, user_id=8), play('One', 2500, user_id=9)],
+                         [song('S1', 'One (Remastered)', year=2001), song('S1', 'One (Demo)', year=1999),
+                          song('S2', 'Two'), song('S3', 'Three')])
+
+    assert second == {'users': 1, 'songs': 1}
+    merged_users, merged_songs = rows(cur, 'users', 'user_id, level'), rows(cur, 'songs', 'song_id, title, year')
+    assert {user_id: row[0] for user_id, row in merged_users.items()} == {'7': 'paid', '8': 'free', '9': 'free'}
+    assert {song_id: row[:2] for song_id, row in merged_songs.items()} == \
+        {'S1': ('One (Remastered)', 2001), 'S2': ('Two', 2000), 'S3': ('Three', 2000)}
+    # Only the changed keys were deleted and inserted again
+    assert merged_users['8'] == users['8'] and merged_users['7'] != users['7']
+    assert merged_songs['S2'] == songs['S2'] and merged_songs['S1'] != songs['S1']
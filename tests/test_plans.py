@@ -0,0 +1,81 @@
+import os
+
+from plans import check_plans, compare_plans, parse_plan, plan_queries, summarize_plan
+
+PLANS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'plans')
+
+
+def read_plan(name, directory=PLANS):
+    with open(os.path.join(directory, f"{name}.txt")) as f:
+        return f.read()
+
+
+def recorded_plans(directory=PLANS):
+    return {name[:-len('.txt')]: read_plan(name[:-len('.txt')], directory)
+            for name in sorted(os.listdir(directory)) if name.endswith('.txt')}
+
+
+def test_recorded_plans_are_queries_of_the_pipeline():
+    assert set(recorded_plans()) <= set(plan_queries())
+
+
+def test_parse_plan_builds_the_step_tree():
+    root = parse_plan(read_plan('insert_songplays'))
+
+    assert root.operation == 'XN Subquery Scan "*SELECT*"'
+    assert (root.total_cost, root.rows, root.width) == (2481.71, 1688, 316)
+    join = root.children[0]
+    assert (join.operation, join.distribution) == ('XN Hash Join', 'DS_DIST_NONE')
+    assert join.details == ['Hash Cond: ("outer".song_key = "inner".song_key)']
+    assert [child.operation for child in join.children] == ['XN Seq Scan on staging_events se', 'XN Hash']
+    assert [step.operation for step in root.walk()][-1] == 'XN Seq Scan on staging_songs'
+    assert len(list(root.walk())) == 7
+
+
+def test_parse_plan_without_steps():
+    assert parse_plan("") is None
+    assert summarize_plan(None) == {'distributions': [], 'flags': [], 'score': 0, 'total_cost': 0.0}
+
+
+def test_summarize_collocated_plans():
+    summary = summarize_plan(parse_plan(read_plan('top_songs')))
+
+    assert summary == {'distributions': ['XN Hash Join DS_DIST_ALL_NONE', 'XN Hash Join DS_DIST_NONE'], 'flags': [],
+                       'score': 0, 'total_cost': 1000000000341.89}
+    for plan in recorded_plans().values():
+        assert summarize_plan(parse_plan(plan))['score'] == 0
+
+
+def test_summarize_flags_broadcasts_and_nested_loops():
+    plan = "XN Nested Loop DS_BCAST_INNER  (cost=0.00..1200.00 rows=100 width=8)\n" \
+           "  ->  XN Seq Scan on songplays sp  (cost=0.00..10.00 rows=1000 width=4)\n" \
+           "  ->  XN Seq Scan on users u  (cost=0.00..1.00 rows=100 width=4)\n"
+
+    summary = summarize_plan(parse_plan(plan))
+
+    assert summary['flags'] == ['XN Nested Loop', 'XN Nested Loop DS_BCAST_INNER']
+    assert summary['score'] == 5
+
+
+def test_compare_plans_reports_a_broadcast_join():
+    snapshot = summarize_plan(parse_plan(read_plan('insert_songplays')))
+    summary = summarize_plan(parse_plan(read_plan('insert_songplays', os.path.join(PLANS, 'regressed'))))
+
+    assert compare_plans(snapshot, snapshot) == []
+    assert compare_plans(summary, snapshot) == ["new step XN Hash Join DS_BCAST_INNER", "score 0 -> 2"]
+    # A plan that got better is no regression
+    assert compare_plans(snapshot, summary) == []
+
+
+def test_check_plans_against_snapshots(tmp_path):
+    snapshots = str(tmp_path / 'snapshots')
+    first = check_plans(recorded_plans(), snapshots)
+    assert all(not result['regressions'] for result in first.values())
+    assert sorted(os.listdir(snapshots)) == sorted(f"{name}.json" for name in recorded_plans())
+
+    regressed = recorded_plans(os.path.join(PLANS, 'regressed'))
+    assert check_plans(regressed, snapshots)['insert_songplays']['regressions']
+
+    # update accepts the plan as the new snapshot
+    check_plans(regressed, snapshots, update=True)
+    assert check_plans(regressed, snapshots)['insert_songplays']['regressions'] == []
@@ -0,0 +1,152 @@
+import threading
+
+import pytest
+
+from pool import ConnectionPool
+
+
+class StubCursor:
+    def __init__(self, connection):
+        self.connection = connection
+
+    def execute(self, query, params=None):
+        self.connection.statements.append(query)
+        if query == "SELECT 1":
+            self.connection.pinging.set()
+            self.connection.pinged.wait(5)
+            if self.connection.broken:
+                raise ConnectionError("server closed the connection unexpectedly")
+
+    def fetchone(self):
+        return (1,)
+
+
+class StubConnection:
+    def __init__(self):
+        self.statements = []
+        self.broken = False
+        self.closed = 0
+        # Set by default, a test clears it to hold the health check
+        self.pinging = threading.Event()
+        self.pinged = threading.Event()
+        self.pinged.set()
+
+    def cursor(self):
+        return StubCursor(self)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.closed = 1
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+@pytest.fixture
+def pool(clock):
+    pool = ConnectionPool(StubConnection, max_size=2, check_idle_after=30.0, clock=clock)
+    yield pool
+    pool.close()
+
+
+def test_connections_are_reused(pool):
+    with pool.session() as first:
+        pass
+    with pool.session() as second:
+        pass
+    with pool.session() as conn, pool.session() as other:
+        assert other is not conn
+
+    assert second is first
+    assert pool.stats() == {'opened': 2, 'reused': 2, 'discarded': 0, 'idle': 2, 'in_use': 0}
+
+
+def test_acquire_waits_for_a_release_at_max_size(pool):
+    first, second = pool.acquire(), pool.acquire()
+
+    with pytest.raises(TimeoutError):
+        pool.acquire(timeout=0.05)
+
+    threading.Timer(0.1, pool.release, [second]).start()
+    assert pool.acquire(timeout=5) is second
+    assert pool.stats()['opened'] == 2
+    pool.release(first)
+
+
+def test_only_connections_idle_for_a_while_are_checked(pool, clock):
+    with pool.session() as conn:
+        pass
+    with pool.session():
+        pass
+    assert "SELECT 1" not in conn.statements
+
+    clock.now += 30
+    with pool.session():
+        pass
+    assert conn.statements.count("SELECT 1") == 1
+
+
+def test_unhealthy_connection_is_replaced(pool, clock):
+    with pool.session() as broken:
+        pass
+    broken.broken = True
+    clock.now += 60
+
+    with pool.session() as conn:
+        assert conn is not broken
+
+    assert broken.closed
+    assert pool.stats() == {'opened': 2, 'reused': 0, 'discarded': 1, 'idle': 1, 'in_use': 0}
+
+
+def test_health_check_runs_outside_the_lock(pool, clock):
+    with pool.session() as conn:
+        pass
+    conn.pinged.clear()
+    clock.now += 60
+    checking = threading.Thread(target=lambda: pool.release(pool.acquire()))
+    checking.start()
+    assert conn.pinging.wait(5)
+
+    # While the SELECT 1 is waiting for the cluster, other threads can still borrow and return connections
+    borrowed = []
+
+    def borrow():
+        with pool.session():
+            pass
+        borrowed.append(pool.stats())
+
+    other = threading.Thread(target=borrow)
+    other.start()
+    other.join(2)
+    assert not other.is_alive()
+    assert borrowed == [{'opened': 2, 'reused': 0, 'discarded': 0, 'idle': 1, 'in_use': 1}]
+
+    conn.pinged.set()
+    checking.join(5)
+    assert pool.stats() == {'opened': 2, 'reused': 1, 'discarded': 0, 'idle': 2, 'in_use': 0}
+
+
+def test_closed_pool_refuses_connections(pool):
+    conn = pool.acquire()
+    pool.close()
+
+    with pytest.raises(RuntimeError, match="closed"):
+        pool.acquire()
+    pool.release(conn)
+    assert conn.closed and pool.stats()['discarded'] == 1
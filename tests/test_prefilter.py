@@ -0,0 +1,120 @@
+import sql_queries
+from compat import CompatConnection
+from instrumentation import execute
+from prefilter import KeySet, commit_keys, dedupe_songs, fingerprint
+from registry import Query
+from sample_data import play, song, write_records
+
+
+def copy_queries(log_data, song_data):
+    queries = [Query(sql_queries.staging_events_json_copy,
+                     sql_queries.copy_parameters(source=str(log_data), json_paths='auto'))]
+    queries += sql_queries.staging_events_derived_insert
+    queries += [Query(sql_queries.staging_songs_json_copy, sql_queries.copy_parameters(source=str(song_data)))]
+    return queries + sql_queries.staging_songs_song_key_insert
+
+
+def merge_load(cur, conn, log_data, song_data):
+    # The statements of the merge stage graph, in order, from the given directories
+    queries = [sql_queries.staging_events_truncate, sql_queries.staging_songs_truncate]
+    queries += copy_queries(log_data, song_data)
+    queries += sql_queries.user_table_merge + sql_queries.song_table_merge + sql_queries.artist_table_merge
+    queries += [sql_queries.time_table_insert, sql_queries.songplay_table_insert_incremental]
+    for query in queries:
+        execute(cur, query)
+    conn.commit()
+
+
+def full_load(cur, conn, log_data, song_data):
+    for query in sql_queries.create_table_queries + copy_queries(log_data, song_data) + \
+            sql_queries.insert_table_queries:
+        execute(cur, query)
+    conn.commit()
+
+
+def songplays(cur):
+    execute(cur, "SELECT start_time, song_id, artist_id FROM songplays ORDER BY start_time")
+    return cur.fetchall()
+
+
+def test_fingerprint_per_dimension():
+    first, second = song('S1', 'One'), song('S2', 'Two')
+    assert fingerprint('artists', first) == fingerprint('artists', second)
+    assert fingerprint('songs', first) != fingerprint('songs', second)
+    assert fingerprint('songs', first) != fingerprint('songs', dict(first, year=2001))
+    # The extra fields of the record are not part of either dimension
+    assert fingerprint('songs', first) == fingerprint('songs', dict(first, num_songs=3))
+
+
+def test_key_set_round_trip(tmp_path):
+    keys = KeySet()
+    assert keys.add(3) and keys.add(1) and not keys.add(3)
+    keys.save(str(tmp_path / 'keys'))
+
+    loaded = KeySet.load(str(tmp_path / 'keys'))
+    assert len(loaded) == 2 and 1 in loaded and 2 not in loaded
+
+
+def test_dedupe_songs_keeps_records_with_a_new_song_or_artist(tmp_path):
+    write_records(tmp_path / 'songs' / 'a.json', [song('S1', 'One'), song('S1', 'One')])
+    write_records(tmp_path / 'songs' / 'b.json', [song('S2', 'Two'), song('S3', 'Three', 'AR2', 'Artist Two')])
+
+    report = dedupe_songs(str(tmp_path / 'songs'), str(tmp_path / 'out'), workers=1)
+
+    assert (report['rows_in'], report['rows_out']) == (4, 3)
+    assert (report['new_songs'], report['new_artists']) == (3, 2)
+
+
+def test_second_run_loads_plays_of_songs_loaded_before(dwh_config, sqlite_conn):
+    cur = sqlite_conn.cursor()
+    for query in sql_queries.create_table_queries:
+        execute(cur, query)
+    key_path = str(dwh_config / 'song_keys')
+
+    # First run: two songs, one of them played
+    write_records(dwh_config / 'song_data' / 'A' / 'songs.json', [song('S1', 'One'), song('S2', 'Two')])
+    write_records(dwh_config / 'run1' / 'events.json', [play('One', 1541000000000)])
+    dedupe_songs(str(dwh_config / 'song_data'), str(dwh_config / 'filtered1'), key_path, workers=1)
+    merge_load(cur, sqlite_conn, dwh_config / 'run1', dwh_config / 'filtered1')
+    assert commit_keys(key_path)
+
+    # Second run: the same song files and a new song, the plays are of the songs loaded by the first run
+    write_records(dwh_config / 'song_data' / 'B' / 'songs.json', [song('S3', 'Three')])
+    write_records(dwh_config / 'run2' / 'events.json', [play('Two', 1541000100000), play('One', 1541000200000)])
+    report = dedupe_songs(str(dwh_config / 'song_data'), str(dwh_config / 'filtered2'), key_path, workers=1)
+    assert (report['rows_out'], report['new_songs'], report['new_artists']) == (1, 1, 0)
+    merge_load(cur, sqlite_conn, dwh_config / 'run2', dwh_config / 'filtered2')
+
+    execute(cur, "SELECT song_id, artist_id FROM songplays ORDER BY start_time")
+    assert cur.fetchall() == [('S1', 'AR1'), ('S2', 'AR1'), ('S1', 'AR1')]
+    execute(cur, "SELECT COUNT(*) FROM songs")
+    assert cur.fetchone()[0] == 3
+
+
+def test_full_and_merge_load_match_the_songs_of_an_artist_with_two_names(dwh_config, sqlite_conn):
+    # AR1 released S2 under a new name, artists keeps the latest name while the plays of S1 use the first one
+    write_records(dwh_config / 'song_data' / 'A' / 'songs.json', [song('S1', 'One')])
+    write_records(dwh_config / 'song_data' / 'B' / 'songs.json',
+                  [song('S2', 'Two', artist_name='The Artist One', year=2001)])
+    write_records(dwh_config / 'log_data' / 'run1' / 'events.json', [play('One', 1541000000000)])
+    write_records(dwh_config / 'log_data' / 'run2' / 'events.json',
+                  [play('Two', 1541000100000, artist_name='The Artist One'), play('One', 1541000200000)])
+
+    cur = sqlite_conn.cursor()
+    for query in sql_queries.create_table_queries:
+        execute(cur, query)
+    merge_load(cur, sqlite_conn, dwh_config / 'log_data' / 'run1', dwh_config / 'song_data' / 'A')
+    merge_load(cur, sqlite_conn, dwh_config / 'log_data' / 'run2', dwh_config / 'song_data' / 'B')
+
+    full = CompatConnection.sqlite()
+    try:
+        full_cur = full.cursor()
+        full_load(full_cur, full, dwh_config / 'log_data', dwh_config / 'song_data')
+        expected = songplays(full_cur)
+    finally:
+        full.close()
+
+    execute(cur, "SELECT name FROM artists")
+    assert cur.fetchall() == [('The Artist One',)]
+    assert [song_id for _, song_id, _ in expected] == ['S1', 'S2', 'S1']
+    assert songplays(cur) == expected
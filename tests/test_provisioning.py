@@ -0,0 +1,129 @@
+import random
+import threading
+import time
+
+import pytest
+
+from provisioning import backoff_delays, provision_cluster, resize_and_wait, wait_for_cluster
+from redshift import RedshiftCluster
+
+
+def describe_response(status, num_nodes=2):
+    return {'Clusters': [{'ClusterIdentifier': 'local', 'ClusterStatus': status, 'NumberOfNodes': num_nodes}]}
+
+
+@pytest.fixture
+def cluster(dwh_config, redshift_client):
+    return RedshiftCluster(redshift_client=redshift_client)
+
+
+def add_describe(stubber, *statuses, num_nodes=2):
+    for status in statuses:
+        stubber.add_response('describe_clusters', describe_response(status, num_nodes), {'ClusterIdentifier': 'local'})
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+def test_backoff_delays_grow_up_to_the_cap():
+    delays = backoff_delays(base=5, cap=60, rng=random.Random(1))
+    maxima = [5, 10, 20, 40, 60, 60]
+
+    for maximum in maxima:
+        assert 0 <= next(delays) <= maximum
+
+
+def test_wait_for_cluster_until_available(cluster, stubber):
+    add_describe(stubber, 'creating', 'creating', 'available')
+    clock, progress = FakeClock(), []
+
+    props = wait_for_cluster(cluster, sleep=clock.sleep, clock=clock, rng=random.Random(1),
+                             on_progress=lambda status, elapsed: progress.append(status))
+
+    assert props['Clusters'][0]['ClusterStatus'] == 'available'
+    assert progress == ['creating', 'creating'] and len(clock.sleeps) == 2
+    assert cluster.calls['describe_clusters'] == 3
+    stubber.assert_no_pending_responses()
+
+
+def test_wait_for_cluster_times_out(cluster, stubber):
+    add_describe(stubber, *['creating'] * 10)
+    clock = FakeClock()
+
+    with pytest.raises(TimeoutError, match='status: creating'):
+        wait_for_cluster(cluster, timeout=30, base=10, cap=10, sleep=clock.sleep, clock=clock, on_progress=None)
+    assert clock.now <= 30
+
+
+def test_provision_cluster_runs_the_local_work_while_waiting(cluster, stubber):
+    stubber.add_response('create_cluster', {'Cluster': {'ClusterIdentifier': 'local', 'ClusterStatus': 'creating'}})
+    add_describe(stubber, 'creating', 'available')
+    clock = FakeClock()
+
+    props, local_result = provision_cluster(cluster, lambda: 'rendered', sleep=clock.sleep, clock=clock,
+                                            on_progress=None)
+
+    assert props['Clusters'][0]['ClusterStatus'] == 'available'
+    assert local_result == 'rendered'
+    stubber.assert_no_pending_responses()
+
+
+def test_failed_local_work_stops_the_wait(cluster, stubber):
+    stubber.add_response('create_cluster', {'Cluster': {'ClusterIdentifier': 'local', 'ClusterStatus': 'creating'}})
+    add_describe(stubber, 'creating')
+    described = threading.Event()
+
+    def local_work():
+        described.wait(5)
+        raise RuntimeError('no input files')
+
+    start = time.monotonic()
+    with pytest.raises(RuntimeError, match='no input files'):
+        # The waiter sleeps about 50 minutes after the first check, the error is raised without waiting for it
+        provision_cluster(cluster, local_work, timeout=7200, base=3600, cap=3600, rng=random.Random(0),
+                          on_progress=lambda status, elapsed: described.set())
+    assert time.monotonic() - start < 5
+
+
+def test_wait_for_cluster_returns_when_stopped(cluster, stubber):
+    stop = threading.Event()
+    stop.set()
+
+    assert wait_for_cluster(cluster, stop=stop) is None
+    assert cluster.calls['describe_clusters'] == 0
+
+
+def test_resize_waits_for_the_new_number_of_nodes(cluster, stubber):
+    stubber.add_response('resize_cluster', {'Cluster': {'ClusterIdentifier': 'local', 'ClusterStatus': 'resizing'}},
+                         {'ClusterIdentifier': 'local', 'ClusterType': 'multi-node', 'NodeType': 'dc2.large',
+                          'NumberOfNodes': 4, 'Classic': False})
+    # Right after the request the cluster may still report the old size as available
+    add_describe(stubber, 'available', num_nodes=2)
+    add_describe(stubber, 'resizing', num_nodes=2)
+    add_describe(stubber, 'available', num_nodes=4)
+    clock, progress = FakeClock(), []
+
+    props, local_result = resize_and_wait(cluster, 4, lambda: 42, sleep=clock.sleep, clock=clock,
+                                          on_progress=lambda status, elapsed: progress.append(status))
+
+    assert props['Clusters'][0]['NumberOfNodes'] == 4
+    assert local_result == 42
+    assert progress == ['available', 'resizing']
+    stubber.assert_no_pending_responses()
+
+
+def test_refused_resize_only_runs_the_local_work(cluster, stubber):
+    stubber.add_client_error('resize_cluster', 'InvalidClusterState', 'The cluster is not available')
+
+    assert resize_and_wait(cluster, 8, lambda: 'done') == (None, 'done')
+    stubber.assert_no_pending_responses()
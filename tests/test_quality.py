@@ -0,0 +1,102 @@
+import pytest
+
+import sql_queries
+from compat import CompatConnection
+from instrumentation import execute
+from pool import ConnectionPool
+from quality import accepted, compile_checks, format_quality_report, not_null, references, run_quality_checks, \
+    sql_literal, table_checks, unique, value_range
+
+
+def test_check_expressions():
+    assert not_null('user_id').expression == "SUM(CASE WHEN t.user_id IS NULL THEN 1 ELSE 0 END)"
+    assert unique('user_id').expression == "COUNT(t.user_id) - COUNT(DISTINCT t.user_id)"
+    assert value_range('duration', 0).expression == "SUM(CASE WHEN t.duration < 0 THEN 1 ELSE 0 END)"
+    assert value_range('hour', 0, 23).expression == "SUM(CASE WHEN t.hour < 0 OR t.hour > 23 THEN 1 ELSE 0 END)"
+    assert accepted('level', ('free', "pa'id")).expression == \
+        "SUM(CASE WHEN t.level NOT IN ('free', 'pa''id') THEN 1 ELSE 0 END)"
+    assert sql_literal(1.5) == '1.5'
+
+    check = references('song_id', 'songs', 'song_id', 'r3')
+    assert check.join == "LEFT JOIN (SELECT DISTINCT song_id FROM songs) r3 ON r3.song_id = t.song_id"
+    assert check.description == "references song_id -> songs.song_id"
+
+
+def test_checks_follow_the_table_declarations():
+    checks = table_checks(sql_queries.star_schema_tables['songplays'])
+    descriptions = [check.description for check in checks]
+
+    assert descriptions[:2] == ["not_null songplay_id", "unique songplay_id"]
+    assert "references user_id -> users.user_id" in descriptions
+    assert "references start_time -> times.start_time" in descriptions
+    assert descriptions[-1] == "accepted_values level ['free', 'paid']"
+    assert [check.kind for check in table_checks(sql_queries.star_schema_tables['times'])].count('range') == 6
+
+
+def test_compile_checks_scans_the_table_once():
+    statement = compile_checks('users', [not_null('user_id'), unique('user_id'),
+                                         references('user_id', 'accounts', 'id', 'r2')])
+
+    assert statement == "SELECT COUNT(*), SUM(CASE WHEN t.user_id IS NULL THEN 1 ELSE 0 END), " \
+                        "COUNT(t.user_id) - COUNT(DISTINCT t.user_id), " \
+                        "SUM(CASE WHEN t.user_id IS NOT NULL AND r2.id IS NULL THEN 1 ELSE 0 END) " \
+                        "FROM users t LEFT JOIN (SELECT DISTINCT id FROM accounts) r2 ON r2.id = t.user_id"
+
+
+@pytest.fixture
+def pool(tmp_path):
+    path = str(tmp_path / 'dwh.db')
+    conn = CompatConnection.sqlite(path)
+    cur = conn.cursor()
+    for query in sql_queries.create_table_queries:
+        execute(cur, query)
+    for query in ["INSERT INTO users (user_id, first_name, last_name, gender, level) VALUES ('7', 'Ann', 'Lee', 'F', "
+                  "'free')",
+                  "INSERT INTO artists (artist_id, name) VALUES ('AR1', 'Artist One')",
+                  "INSERT INTO songs (song_id, title, artist_id, year, duration) "
+                  "VALUES ('S1', 'One', 'AR1', 2000, 200)",
+                  "INSERT INTO times (start_time, hour, day, week, month, year, weekday) "
+                  "VALUES ('2018-11-01 10:00:00', 10, 1, 44, 11, 2018, 4)",
+                  "INSERT INTO songplays (start_time, user_id, level, song_id, artist_id, session_id) "
+                  "VALUES ('2018-11-01 10:00:00', '7', 'free', 'S1', 'AR1', 11)"]:
+        execute(cur, query)
+    conn.commit()
+    conn.close()
+
+    with ConnectionPool(lambda: CompatConnection.sqlite(path), max_size=4) as pool:
+        yield pool
+
+
+def test_loaded_star_schema_passes(pool):
+    report = run_quality_checks(pool)
+
+    assert report['passed']
+    assert {table: result['rows'] for table, result in report['tables'].items()} == \
+        {'songplays': 1, 'users': 1, 'songs': 1, 'artists': 1, 'times': 1}
+    assert all(check['failed_rows'] == 0 for table in report['tables'].values() for check in table['checks'])
+
+
+def test_broken_rows_fail_their_checks(pool):
+    with pool.session() as conn:
+        cur = conn.cursor()
+        execute(cur, "INSERT INTO songplays (start_time, user_id, level, song_id, artist_id, session_id) "
+                     "VALUES ('2018-11-01 10:00:00', '8', 'gold', 'S1', 'AR1', 12)")
+        execute(cur, "INSERT INTO times (start_time, hour, day, week, month, year, weekday) "
+                     "VALUES ('2018-11-01 25:00:00', 25, 1, 44, 11, 2018, 4)")
+        conn.commit()
+
+    report = run_quality_checks(pool, ['songplays', 'times', 'artists'], min_rows=2)
+
+    assert not report['passed']
+    failed = {table: {check['description']: check['failed_rows'] for check in result['checks'] if not check['passed']}
+              for table, result in report['tables'].items()}
+    assert failed == {'songplays': {"references user_id -> users.user_id": 1,
+                                    "accepted_values level ['free', 'paid']": 1},
+                      'times': {"range hour [0, 23]": 1},
+                      'artists': {"min_rows 2": 1}}
+
+    # Only the failed checks are listed
+    text = format_quality_report(report)
+    assert " artists    rows=1" in text
+    assert "     FAILED references user_id -> users.user_id: 1 rows" in text
+    assert "not_null" not in text
@@ -0,0 +1,100 @@
+import time
+
+import pytest
+from botocore.exceptions import ClientError
+
+from redshift import RedshiftCluster
+
+DESCRIPTION = {'Clusters': [{'ClusterIdentifier': 'local', 'ClusterStatus': 'available', 'NumberOfNodes': 2,
+                             'Endpoint': {'Address': 'local.redshift.amazonaws.com', 'Port': 5439},
+                             'IamRoles': [{'IamRoleArn': 'arn:aws:iam::123456789012:role/dwh'}]}]}
+
+
+def add_describe(stubber, times=1):
+    for _ in range(times):
+        stubber.add_response('describe_clusters', DESCRIPTION, {'ClusterIdentifier': 'local'})
+
+
+def test_clients_are_created_once(dwh_config):
+    cluster = RedshiftCluster()
+
+    assert cluster.client('redshift') is cluster.client('redshift')
+    assert cluster.client('iam') is cluster.client('iam')
+    assert cluster.calls['clients_created'] == 2
+
+
+def test_injected_client_is_used(dwh_config, redshift_client):
+    cluster = RedshiftCluster(redshift_client=redshift_client)
+
+    assert cluster.client('redshift') is redshift_client
+    assert cluster.calls['clients_created'] == 0
+
+
+def test_description_is_cached_for_the_ttl(dwh_config, redshift_client, stubber):
+    add_describe(stubber)
+    cluster = RedshiftCluster(redshift_client=redshift_client, ttl=30)
+
+    assert cluster.get_redshift_cluster_props() == DESCRIPTION
+    assert cluster.get_redshift_cluster_endpoint() == 'local.redshift.amazonaws.com'
+    assert cluster.get_redshift_cluster_role_arn() == 'arn:aws:iam::123456789012:role/dwh'
+    assert cluster.calls == {'clients_created': 0, 'describe_clusters': 1, 'cache_hits': 2}
+    stubber.assert_no_pending_responses()
+
+
+def test_description_expires(dwh_config, redshift_client, stubber):
+    add_describe(stubber, 2)
+    cluster = RedshiftCluster(redshift_client=redshift_client, ttl=0.05)
+
+    cluster.describe()
+    time.sleep(0.06)
+    cluster.describe()
+
+    assert cluster.calls['describe_clusters'] == 2
+    stubber.assert_no_pending_responses()
+
+
+def test_refresh_and_changes_describe_again(dwh_config, redshift_client, stubber):
+    add_describe(stubber)
+    add_describe(stubber)
+    stubber.add_response('delete_cluster', {'Cluster': {'ClusterIdentifier': 'local', 'ClusterStatus': 'deleting'}},
+                         {'ClusterIdentifier': 'local', 'SkipFinalClusterSnapshot': True})
+    add_describe(stubber)
+    cluster = RedshiftCluster(redshift_client=redshift_client)
+
+    cluster.describe()
+    cluster.describe(refresh=True)
+    cluster.delete_redshift_cluster()
+    cluster.describe()
+
+    assert cluster.calls['describe_clusters'] == 3 and cluster.calls['cache_hits'] == 0
+    stubber.assert_no_pending_responses()
+
+
+def test_missing_cluster_has_no_props(dwh_config, redshift_client, stubber):
+    stubber.add_client_error('describe_clusters', 'ClusterNotFound', 'Cluster local not found')
+    cluster = RedshiftCluster(redshift_client=redshift_client)
+
+    assert cluster.get_redshift_cluster_props() is None
+    stubber.assert_no_pending_responses()
+
+
+def test_failed_create_is_raised(dwh_config, redshift_client, stubber):
+    stubber.add_client_error('create_cluster', 'ClusterQuotaExceeded', 'Cluster quota exceeded')
+    cluster = RedshiftCluster(redshift_client=redshift_client)
+
+    with pytest.raises(ClientError, match='ClusterQuotaExceeded'):
+        cluster.create_redshift_cluster()
+    stubber.assert_no_pending_responses()
+
+
+def test_cluster_type_follows_the_number_of_nodes(dwh_config, redshift_client, stubber):
+    # dwh.cfg declares a multi-node cluster, the sizing picked a single node for this run
+    cluster = RedshiftCluster(redshift_client=redshift_client)
+    cluster.NUM_NODES = 1
+    stubber.add_response('create_cluster', {'Cluster': {'ClusterIdentifier': 'local', 'ClusterStatus': 'creating'}},
+                         {'ClusterType': 'single-node', 'NodeType': 'dc2.large', 'NumberOfNodes': 1,
+                          'DBName': 'local', 'ClusterIdentifier': 'local', 'MasterUsername': 'local',
+                          'MasterUserPassword': 'local', 'IamRoles': [cluster.ARN]})
+
+    assert cluster.create_redshift_cluster()['Cluster']['ClusterStatus'] == 'creating'
+    stubber.assert_no_pending_responses()
@@ -0,0 +1,148 @@
+import threading
+
+import pytest
+
+from pool import ConnectionPool
+from scheduler import run_stages, select_stages, validate_stage_graph
+
+
+class StubCursor:
+    def __init__(self, connection):
+        self.connection = connection
+        self.rowcount = -1
+
+    def execute(self, query, params=None):
+        if query == "SELECT 1":
+            return
+        self.connection.database.execute(self.connection, query)
+
+    def fetchone(self):
+        return None
+
+
+class StubConnection:
+    def __init__(self, database):
+        self.database = database
+        self.transaction = []
+        self.closed = 0
+
+    def cursor(self):
+        return StubCursor(self)
+
+    def commit(self):
+        self.database.commit(self)
+
+    def rollback(self):
+        self.transaction = []
+
+    def close(self):
+        self.closed = 1
+
+
+class StubDatabase:
+    """
+    Records the committed statements in order. Statements can fail or wait for each other, e.g. on a barrier that only
+    opens when two stages run at the same time.
+    """
+
+    def __init__(self, fail=(), barriers=None):
+        self.fail = set(fail)
+        self.barriers = barriers or {}
+        self.committed = []
+        self.executed = []
+        self._lock = threading.Lock()
+
+    def connect(self):
+        return StubConnection(self)
+
+    def execute(self, conn, query):
+        with self._lock:
+            self.executed.append(query)
+        if query in self.barriers:
+            self.barriers[query].wait()
+        if query in self.fail:
+            raise RuntimeError(f"{query} failed")
+        conn.transaction.append(query)
+
+    def commit(self, conn):
+        with self._lock:
+            self.committed.extend(conn.transaction)
+        conn.transaction = []
+
+
+def run(database, stages, workers=4):
+    with ConnectionPool(database.connect, max_size=workers) as pool:
+        return run_stages(pool, stages, workers)
+
+
+def test_stages_start_after_their_dependencies_are_committed():
+    database = StubDatabase()
+    stages = {
+        'songplays': ("insert songplays", ['staging_events', 'songs']),
+        'songs': ("insert songs", ['staging_songs']),
+        'staging_events': (["copy staging_events", "update staging_events"], []),
+        'staging_songs': ("copy staging_songs", []),
+    }
+
+    timings = run(database, stages)
+
+    committed = database.committed
+    assert committed.index("copy staging_songs") < committed.index("insert songs")
+    assert committed.index("update staging_events") == committed.index("copy staging_events") + 1
+    assert committed[-1] == "insert songplays"
+    assert set(timings) == set(stages)
+    assert timings['songplays']['start'] >= max(timings['songs']['end'], timings['staging_events']['end'])
+
+
+def test_independent_stages_run_at_the_same_time():
+    # Both COPY statements wait for each other, the run only finishes when they run on separate connections
+    barrier = threading.Barrier(2, timeout=5)
+    database = StubDatabase(barriers={"copy staging_events": barrier, "copy staging_songs": barrier})
+    stages = {'staging_events': ("copy staging_events", []), 'staging_songs': ("copy staging_songs", []),
+              'songs': ("insert songs", ['staging_songs'])}
+
+    run(database, stages, workers=2)
+
+    assert sorted(database.committed) == ["copy staging_events", "copy staging_songs", "insert songs"]
+
+
+def test_failed_stage_skips_its_dependents_and_is_raised():
+    database = StubDatabase(fail={"copy staging_songs"})
+    stages = {'staging_songs': ("copy staging_songs", []), 'songs': ("insert songs", ['staging_songs']),
+              'artists': ("insert artists", ['staging_songs']), 'staging_events': ("copy staging_events", [])}
+
+    with pytest.raises(RuntimeError, match="Stage 'staging_songs' failed") as error:
+        run(database, stages)
+
+    assert str(error.value.__cause__) == "copy staging_songs failed"
+    assert "insert songs" not in database.executed and "insert artists" not in database.executed
+    assert "copy staging_songs" not in database.committed
+
+
+def test_running_stages_finish_when_another_stage_fails():
+    finish = threading.Event()
+    database = StubDatabase(fail={"copy staging_songs"}, barriers={"copy staging_events": finish})
+    stages = {'staging_songs': ("copy staging_songs", []), 'staging_events': ("copy staging_events", [])}
+    threading.Timer(0.2, finish.set).start()
+
+    with pytest.raises(RuntimeError, match="Stage 'staging_songs' failed"):
+        run(database, stages, workers=2)
+
+    assert database.committed == ["copy staging_events"]
+
+
+def test_invalid_stage_graphs_are_refused():
+    with pytest.raises(ValueError, match="unknown stage 'times'"):
+        validate_stage_graph({'songplays': ("insert songplays", ['times'])})
+    with pytest.raises(ValueError, match="cycle"):
+        validate_stage_graph({'songs': ("insert songs", ['artists']), 'artists': ("insert artists", ['songs'])})
+    with pytest.raises(ValueError, match="At least one worker"), ConnectionPool(StubDatabase().connect) as pool:
+        run_stages(pool, {'songs': ("insert songs", [])}, workers=0)
+
+
+def test_select_stages_drops_dependencies_outside_the_selection():
+    stages = {'staging_songs': ("copy staging_songs", []), 'songs': ("insert songs", ['staging_songs']),
+              'songplays': ("insert songplays", ['songs', 'staging_events'])}
+
+    assert select_stages(stages, ['songs', 'songplays']) == {'songs': ("insert songs", []),
+                                                             'songplays': ("insert songplays", ['songs'])}
@@ -0,0 +1,98 @@
+import pytest
+
+from sizing import HISTORY_SIZE, SizingModel, elastic_range, estimate_inputs, resize_pays_off, stage_work
+
+STAGES = {'staging_events': ([], []), 'staging_songs': ([], []),
+          'songplays': ([], ['staging_events', 'staging_songs'])}
+
+INPUTS = {'staging_events': {'files': 4, 'bytes': 4000000, 'rows': 10000},
+          'staging_songs': {'files': 2, 'bytes': 1000000, 'rows': 2000}}
+
+# On 2 dc2.large nodes (4 slices): 100000 bytes/s per slice for the events, 50000 for the songs, 1000 rows/s per slice
+# for the songplays
+STAGE_SECONDS = {'staging_events': 10.0, 'staging_songs': 5.0, 'songplays': 3.0}
+
+
+@pytest.fixture
+def model(tmp_path):
+    model = SizingModel()
+    model.record_run(str(tmp_path / 'history.json'), 'dc2.large', 2, INPUTS, {}, STAGE_SECONDS)
+    return model
+
+
+def test_estimate_inputs_of_local_directories(tmp_path):
+    for index in range(3):
+        (tmp_path / 'log_data' / f"{index}.json").parent.mkdir(exist_ok=True)
+        (tmp_path / 'log_data' / f"{index}.json").write_text('x' * 300)
+    (tmp_path / 'song_data').mkdir()
+
+    inputs = estimate_inputs({'staging_events': str(tmp_path / 'log_data'),
+                              'staging_songs': str(tmp_path / 'song_data')}, {'staging_events': 100.0})
+
+    assert inputs == {'staging_events': {'files': 3, 'bytes': 900, 'rows': 9},
+                      'staging_songs': {'files': 0, 'bytes': 0, 'rows': 0}}
+
+
+def test_stage_work():
+    assert stage_work('staging_events', INPUTS) == 4000000
+    assert stage_work('songplays', INPUTS) == 12000
+
+
+def test_history_round_trip(tmp_path, model):
+    path = str(tmp_path / 'history.json')
+    model.record_run(path, 'dc2.large', 4, INPUTS, {'staging_events': 20000}, STAGE_SECONDS)
+
+    loaded = SizingModel.load(path)
+
+    assert loaded.history == model.history
+    assert [run['slices'] for run in loaded.history] == [4, 8]
+    assert loaded.history[1]['inputs']['staging_events'] == {'bytes': 4000000, 'rows': 20000}
+    # The median of 400 and 200 bytes per row
+    assert loaded.bytes_per_row() == {'staging_events': 300.0, 'staging_songs': 500.0}
+    assert SizingModel.load(str(tmp_path / 'missing.json')).history == []
+
+
+def test_history_keeps_the_last_runs(tmp_path):
+    model = SizingModel()
+    for num_nodes in range(1, HISTORY_SIZE + 3):
+        model.record_run(str(tmp_path / 'history.json'), 'dc2.large', num_nodes, INPUTS, {}, STAGE_SECONDS)
+
+    assert len(SizingModel.load(str(tmp_path / 'history.json')).history) == HISTORY_SIZE
+    assert model.history[0]['slices'] == 6
+
+
+def test_rates_and_predict(model):
+    assert model.rates() == {'staging_events': 100000.0, 'staging_songs': 50000.0, 'songplays': 1000.0}
+    # The songplays wait for the slower COPY
+    assert model.predict(STAGES, INPUTS, 4) == 13.0
+    assert model.predict(STAGES, INPUTS, 8) == 6.5
+
+
+def test_predict_without_history_uses_the_defaults():
+    seconds = SizingModel().predict(STAGES, INPUTS, 4)
+
+    assert seconds == pytest.approx(4000000 / (4 * 2 ** 20 * 4) + 12000 / (200000.0 * 4))
+
+
+def test_recommend(model):
+    assert model.recommend(STAGES, INPUTS, 'dc2.large', 13.0, 1, 8) == (2, 13.0)
+    assert model.recommend(STAGES, INPUTS, 'dc2.large', 7.0, 1, 8) == (4, 6.5)
+    # No size meets the target, the largest is recommended
+    assert model.recommend(STAGES, INPUTS, 'dc2.large', 1.0, 1, 3) == (3, pytest.approx(26 / 3))
+
+
+@pytest.mark.parametrize('node_type, num_nodes, expected', [
+    ('dc2.large', 4, (2, 8)),
+    ('dc2.large', 3, (2, 6)),
+    ('ra3.4xlarge', 4, (1, 16)),
+    ('ra3.xlplus', 1, (1, 4)),
+])
+def test_elastic_range(node_type, num_nodes, expected):
+    assert elastic_range(node_type, num_nodes) == expected
+
+
+def test_resize_pays_off(model):
+    # 2 -> 4 nodes saves 6.5 seconds
+    assert resize_pays_off(model, STAGES, INPUTS, 'dc2.large', 2, 4, resize_seconds=5.0)
+    assert not resize_pays_off(model, STAGES, INPUTS, 'dc2.large', 2, 4, resize_seconds=10.0)
+    assert not resize_pays_off(model, STAGES, INPUTS, 'dc2.large', 4, 2, resize_seconds=0.0)
@@ -0,0 +1,40 @@
+import pytest
+
+from compat import CompatConnection
+from instrumentation import execute
+from pool import ConnectionPool
+from stats import TableStats
+
+
+@pytest.fixture
+def pool(tmp_path):
+    pool = ConnectionPool(lambda: CompatConnection.sqlite(str(tmp_path / 'stats.db')), max_size=2)
+    with pool.session() as conn:
+        cur = conn.cursor()
+        for table, rows in [('songs', 3), ('users', 1), ('artists', 0)]:
+            execute(cur, f"CREATE TABLE {table} (id INT)")
+            for index in range(rows):
+                execute(cur, f"INSERT INTO {table} VALUES ({index})")
+        conn.commit()
+    yield pool
+    pool.close()
+
+
+@pytest.mark.parametrize('backend, queries', [('threads', 1), ('asyncio', 3)])
+def test_counts_per_backend(pool, backend, queries):
+    table_stats = TableStats(pool, ['songs', 'users', 'artists'], backend=backend, workers=2)
+
+    assert table_stats.counts() == {'songs': 3, 'users': 1, 'artists': 0}
+    assert table_stats.queries == queries
+
+
+@pytest.mark.parametrize('backend', ['threads', 'asyncio'])
+def test_counts_are_cached_until_refresh(pool, backend):
+    table_stats = TableStats(pool, ['songs', 'users'], backend=backend, workers=2)
+    table_stats.counts()
+    with pool.session() as conn:
+        execute(conn.cursor(), "INSERT INTO users VALUES (1)")
+        conn.commit()
+
+    assert table_stats.counts()['users'] == 1
+    assert table_stats.counts(refresh=True)['users'] == 2
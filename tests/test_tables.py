@@ -0,0 +1,116 @@
+import re
+
+import pytest
+
+from sql_queries import insert_table_queries, songplay_table_insert, staging_raw_tables, \
+    staging_songs_song_key_insert, star_schema_tables
+from tables import Column, Table, advise_keys, derived_column, join_columns
+
+
+def test_staging_tables_are_distributed_on_the_songplays_join():
+    assert star_schema_tables['staging_events'].distkey == 'song_key'
+    assert star_schema_tables['staging_songs'].distkey == 'song_key'
+    assert advise_keys(star_schema_tables, insert_table_queries)['staging_events']['matches']
+
+
+def test_files_are_copied_to_evenly_distributed_raw_tables():
+    # song_key is NULL at COPY time, the raw tables spread the rows over the slices and the key is computed on insert
+    assert {table.diststyle for table in staging_raw_tables.values()} == {'EVEN'}
+    assert 'song_key' not in [column.name for column in staging_raw_tables['staging_songs'].columns]
+    insert, delete = staging_songs_song_key_insert
+    assert insert.startswith("INSERT INTO staging_songs (num_songs") and "FROM staging_songs_raw" in insert
+    assert delete == "DELETE FROM staging_songs_raw"
+
+
+def table(**design):
+    return Table('plays', [Column('play_id', 'BIGINT', 'NOT NULL', encode='raw'),
+                           Column('song_id', 'VARCHAR(18)', encode='ZSTD'),
+                           Column('start_time', 'TIMESTAMP')], **design)
+
+
+def test_create_statement_with_key_distribution():
+    statement = table(distkey='song_id', sortkey=['start_time', 'play_id']).create_statement()
+
+    assert statement == "CREATE TABLE IF NOT EXISTS plays (play_id BIGINT NOT NULL ENCODE RAW, " \
+                        "song_id VARCHAR(18) ENCODE ZSTD, start_time TIMESTAMP) " \
+                        "DISTSTYLE KEY DISTKEY(song_id) COMPOUND SORTKEY(start_time, play_id)"
+
+
+def test_create_statement_with_all_distribution_and_interleaved_sortkey():
+    statement = table(diststyle='all', sortkey=['song_id', 'start_time'], sortkey_style='interleaved') \
+        .create_statement()
+
+    assert statement.endswith(") DISTSTYLE ALL INTERLEAVED SORTKEY(song_id, start_time)")
+    assert 'DISTKEY' not in statement
+
+
+def test_create_statement_without_physical_design():
+    assert table().create_statement().endswith("start_time TIMESTAMP)")
+    assert table().drop_statement() == "DROP TABLE IF EXISTS plays"
+
+
+@pytest.mark.parametrize('design, message', [
+    ({'distkey': 'artist_id'}, "Key column 'artist_id' is not a column of table 'plays'"),
+    ({'sortkey': ['play_id', 'ts']}, "Key column 'ts' is not a column of table 'plays'"),
+    ({'diststyle': 'ALL', 'distkey': 'song_id'}, "needs a distkey exactly when its diststyle is KEY"),
+    ({'diststyle': 'KEY'}, "needs a distkey exactly when its diststyle is KEY"),
+    ({'diststyle': 'RANDOM'}, "Unknown diststyle 'RANDOM'"),
+    ({'sortkey': ['play_id'], 'sortkey_style': 'MIXED'}, "Unknown sortkey style 'MIXED'"),
+])
+def test_invalid_physical_design(design, message):
+    with pytest.raises(ValueError, match=re.escape(message)):
+        table(**design)
+
+
+def test_unknown_encoding():
+    with pytest.raises(ValueError, match="Unknown encoding 'GZIP' for column 'title'"):
+        Column('title', 'VARCHAR(100)', encode='GZIP')
+
+
+def test_join_columns_resolve_aliases():
+    query = "INSERT INTO plays SELECT * FROM events e JOIN songs AS s ON s.song_key = e.song_key " \
+            "JOIN artists a ON a.artist_id = s.artist_id"
+
+    assert join_columns([query]) == [(('songs', 'song_key'), ('events', 'song_key')),
+                                     (('artists', 'artist_id'), ('songs', 'artist_id'))]
+
+
+def test_join_columns_trace_subquery_columns_to_their_table():
+    assert join_columns([songplay_table_insert]) == [(('staging_songs', 'song_key'), ('staging_events', 'song_key'))]
+
+    advice = advise_keys(star_schema_tables, [songplay_table_insert])
+    assert set(advice) == {'staging_songs', 'staging_events'}
+    assert all(suggestion['suggested_distkey'] == 'song_key' for suggestion in advice.values())
+
+
+def test_join_columns_skip_computed_subquery_columns():
+    query = "SELECT * FROM plays p " \
+            "JOIN (SELECT MD5(s.title || a.name) AS song_key, s.song_id " \
+            "FROM songs s JOIN artists a ON a.artist_id = s.artist_id) ds ON ds.song_key = p.song_key " \
+            "JOIN (SELECT id AS user_id FROM (SELECT user_id AS id FROM users) u) lu ON lu.user_id = p.user_id"
+
+    assert join_columns([query]) == [(('artists', 'artist_id'), ('songs', 'artist_id')),
+                                     (('users', 'user_id'), ('plays', 'user_id'))]
+
+
+def test_derived_column():
+    subquery = "SELECT song_key, s.song_id AS id, ROW_NUMBER() OVER (PARTITION BY song_key, year) AS song_rank " \
+               "FROM staging_songs s"
+
+    assert derived_column(subquery, 'song_key') == ('staging_songs', 'song_key')
+    assert derived_column(subquery, 'id') == ('staging_songs', 'song_id')
+    assert derived_column(subquery, 'song_rank') is None
+    assert derived_column("SELECT song_id FROM songs s JOIN artists a ON a.artist_id = s.artist_id", 'song_id') is None
+
+
+def test_advise_keys():
+    tables = {'plays': table(distkey='song_id'), 'songs': Table('songs', [Column('song_id', 'VARCHAR(18)')],
+                                                                diststyle='EVEN')}
+    query = "SELECT * FROM plays p JOIN songs s ON s.song_id = p.song_id JOIN users u ON u.user_id = p.user_id"
+
+    advice = advise_keys(tables, [query])
+
+    assert set(advice) == {'plays', 'songs'}
+    assert advice['plays'] == {'distkey': 'song_id', 'sortkey': [], 'suggested_distkey': 'song_id',
+                               'suggested_sortkey': ['song_id'], 'matches': True}
+    assert advice['songs']['distkey'] is None and not advice['songs']['matches']